@@ -0,0 +1,55 @@
+#
+# Copyright (c) 2022, Takahiro Miki. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for details.
+#
+import numpy as np
+from typing import Union
+
+try:
+    import cupy as cp
+    ndarray = Union[np.ndarray, cp.ndarray]
+except ImportError:
+    cp = None
+    ndarray = np.ndarray
+
+BACKENDS = ["cupy", "numpy"]
+
+_managed_memory_pool = None
+
+
+def get_backend(name: str):
+    """
+    Return the array module of a backend.
+    Args:
+    name: one of BACKENDS.
+    """
+    assert name in BACKENDS, "backend should be chosen from {}".format(BACKENDS)
+    if name == "cupy":
+        assert cp is not None, "cupy backend is selected but cupy is not installed."
+        use_managed_memory()
+        return cp
+    return np
+
+
+def use_managed_memory():
+    # Use managed memory for cupy allocations. This is done only once per process.
+    global _managed_memory_pool
+    if _managed_memory_pool is None:
+        _managed_memory_pool = cp.cuda.MemoryPool(cp.cuda.malloc_managed)
+        cp.cuda.set_allocator(_managed_memory_pool.malloc)
+
+
+def is_cupy_array(array) -> bool:
+    return cp is not None and isinstance(array, cp.ndarray)
+
+
+def get_array_module(array):
+    if is_cupy_array(array):
+        return cp
+    return np
+
+
+def asnumpy(array, stream=None) -> np.ndarray:
+    if is_cupy_array(array):
+        return cp.asnumpy(array, stream=stream)
+    return np.asarray(array)
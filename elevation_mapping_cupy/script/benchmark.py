@@ -0,0 +1,221 @@
+#
+# Copyright (c) 2022, Takahiro Miki. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for details.
+#
+# Benchmarks of the elevation map.
+#  $ python benchmark.py ingest --backend numpy
+#  $ python benchmark.py ingest --compact-layers
+#  $ python benchmark.py startup
+#  $ python benchmark.py import
+#  $ python benchmark.py inpaint
+#  $ python benchmark.py min_filter
+#
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+
+from backend import get_backend, asnumpy
+from elevation_mapping import ElevationMap
+from parameter import Parameter
+from plugins.inpainting import Inpainting
+from plugins.min_filter import MinFilter
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+CONFIG_DIR = os.path.join(SCRIPT_DIR, "..", "config")
+# Modules which should only be imported when the feature using them is used.
+HEAVY_MODULES = ["torch", "chainer", "cupyx.scipy.ndimage", "scipy.ndimage", "scipy.interpolate", "shapely", "cv2",
+                 "ruamel.yaml"]
+# Run in a new python process by benchmark_import.
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import elevation_mapping
+imported = time.perf_counter()
+import_modules = [name for name in json.loads(sys.argv[2]) if name in sys.modules]
+from benchmark import create_map
+create_map(sys.argv[1])
+created = time.perf_counter()
+create_modules = [name for name in json.loads(sys.argv[2]) if name in sys.modules]
+print(json.dumps([imported - start, created - imported, import_modules, create_modules]))
+"""
+
+
+def create_map(backend, **kwargs):
+    param = Parameter(use_chainer=False, backend=backend,
+                      weight_file=os.path.join(CONFIG_DIR, "weights.dat"),
+                      plugin_config_file=os.path.join(CONFIG_DIR, "plugin_config.yaml"),
+                      **kwargs)
+    param.load_weights(param.weight_file)
+    return ElevationMap(param)
+
+
+def synchronize(xp):
+    if xp is not np:
+        xp.cuda.Stream.null.synchronize()
+
+
+def create_points(point_n, seed=0):
+    # Ground plane with a step in front of the sensor.
+    rng = np.random.default_rng(seed)
+    xy = rng.uniform(-4.0, 4.0, (point_n, 2))
+    z = np.where(xy[:, 0] > 1.0, -0.2, -0.5) + rng.normal(0, 0.01, point_n)
+    return np.c_[xy, z]
+
+
+def benchmark_ingest(backend, point_n, repeat, **kwargs):
+    """
+    Time of the point update with and without the fused ingest, and the size of the map layers.
+    Each map is warmed up with one update before timing. kwargs are passed to Parameter.
+    """
+    xp = get_backend(backend)
+    points = create_points(point_n)
+    R = np.eye(3)
+    t = np.array([0.0, 0.0, 0.3])
+    for fused in [False, True]:
+        elevation_map = create_map(backend, enable_fused_ingest=fused, **kwargs)
+        elevation_map.input(points, R, t, 0, 0)
+        synchronize(xp)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            elevation_map.input(points, R, t, 0, 0)
+        synchronize(xp)
+        elapsed = (time.perf_counter() - start) / repeat
+        print("fused_ingest={:<5} {:8.2f} ms / update  {:8.1f} ns / point".format(
+            str(fused), elapsed * 1e3, elapsed * 1e9 / point_n))
+    print("map layers {:8.2f} MB".format(sum(layer.nbytes for layer in elevation_map.map_layers) / 1e6))
+
+
+def benchmark_startup(backend, **kwargs):
+    """
+    Time to create a map and warm up its kernels. The second map uses the kernels cached by the first map.
+    Also the time to change the runtime kernel parameters, which does not compile the kernels.
+    """
+    xp = get_backend(backend)
+    for name in ["first", "second"]:
+        start = time.perf_counter()
+        elevation_map = create_map(backend, **kwargs)
+        created = time.perf_counter()
+        elevation_map.warm_up()
+        synchronize(xp)
+        warmed_up = time.perf_counter()
+        print("{:<6} map: create {:8.2f} ms  warm_up {:8.2f} ms".format(
+            name, (created - start) * 1e3, (warmed_up - created) * 1e3))
+    start = time.perf_counter()
+    elevation_map.param.mahalanobis_thresh *= 2
+    elevation_map.update_kernel_params()
+    synchronize(xp)
+    print("update_kernel_params {:8.2f} ms".format((time.perf_counter() - start) * 1e3))
+
+
+def benchmark_import(backend, repeat):
+    """
+    Time to import elevation_mapping and to create a map in a new python process,
+    and the heavy modules loaded by each of them.
+    """
+    results = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, "-c", IMPORT_SCRIPT, backend, json.dumps(HEAVY_MODULES)],
+                                         cwd=SCRIPT_DIR, text=True, stderr=subprocess.DEVNULL)
+        results.append(json.loads(output.splitlines()[-1]))
+    print("import elevation_mapping {:8.2f} ms".format(np.mean([r[0] for r in results]) * 1e3))
+    print("create map               {:8.2f} ms".format(np.mean([r[1] for r in results]) * 1e3))
+    print("heavy modules after import:", ", ".join(results[-1][2]) or "none")
+    print("heavy modules after create:", ", ".join(results[-1][3]) or "none")
+
+
+def create_terrain(xp, cell_n):
+    # Terrain with 5 m of height range, the valid cells, and the elevation map with holes.
+    rng = np.random.default_rng(0)
+    x, y = np.meshgrid(np.linspace(0, 8, cell_n), np.linspace(0, 8, cell_n), indexing="ij")
+    terrain = 1.5 * np.sin(x * 0.8) + 1.0 * np.cos(y * 0.6) + 0.25 * x
+    valid = np.ones((cell_n, cell_n), dtype=bool)
+    for _ in range(40):
+        cx, cy = rng.integers(0, cell_n, 2)
+        r = rng.integers(2, cell_n // 12)
+        valid[(np.arange(cell_n)[:, None] - cx) ** 2 + (np.arange(cell_n)[None, :] - cy) ** 2 < r * r] = False
+    # Unobserved area at the border of the map.
+    valid[:, :cell_n // 10] = False
+    elevation_map = np.zeros((7, cell_n, cell_n))
+    elevation_map[0] = np.where(valid, terrain, 0.0)
+    elevation_map[2] = valid
+    return terrain, valid, xp.asarray(elevation_map)
+
+
+def benchmark_inpaint(backend, cell_n, repeat):
+    """
+    Time and error of the inpainting methods on a terrain with 5 m of height range and holes.
+    The error is measured against the terrain at the valid cells, which should not change, and in the holes.
+    """
+    xp = get_backend(backend)
+    terrain, valid, elevation_map = create_terrain(xp, cell_n)
+    for method in ["laplace", "telea", "ns"]:
+        inpainting = Inpainting(cell_n=cell_n, method=method, xp=xp)
+        out = xp.empty_like(elevation_map[0])
+        inpainting(elevation_map, [], None, [], out=out)
+        synchronize(xp)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            inpainting(elevation_map, [], None, [], out=out)
+        synchronize(xp)
+        elapsed = (time.perf_counter() - start) / repeat
+        error = np.abs(asnumpy(out) - terrain)
+        print("{:<8} {:8.2f} ms  max error at valid cells {:.4f} m  mean error in holes {:.4f} m".format(
+            method, elapsed * 1e3, error[valid].max(), error[~valid].mean()))
+
+
+def benchmark_min_filter(backend, cell_n, repeat, dilation_size=1, iteration_n=30):
+    """
+    Time of the fill modes of the min filter on the terrain of the inpaint benchmark,
+    and the cells where the window mode differs from the iterations.
+    """
+    xp = get_backend(backend)
+    _, _, elevation_map = create_terrain(xp, cell_n)
+    results = {}
+    for fill_mode in ["iterative", "window"]:
+        min_filter = MinFilter(cell_n=cell_n, dilation_size=dilation_size, iteration_n=iteration_n,
+                               fill_mode=fill_mode, xp=xp)
+        out = xp.empty_like(elevation_map[0])
+        min_filter(elevation_map, [], None, [], out=out)
+        synchronize(xp)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            min_filter(elevation_map, [], None, [], out=out)
+        synchronize(xp)
+        elapsed = (time.perf_counter() - start) / repeat
+        results[fill_mode] = asnumpy(out)
+        print("{:<10} {:8.2f} ms".format(fill_mode, elapsed * 1e3))
+    a, b = results["iterative"], results["window"]
+    same = (a == b) | (np.isnan(a) & np.isnan(b))
+    both = ~np.isnan(a) & ~np.isnan(b)
+    print("cells differing from the iterations: {:.4f}  mean difference {:.4f} m  filled only by one mode {:.4f}".format(
+        1 - same.mean(), np.abs(a - b)[both].mean(), (np.isnan(a) != np.isnan(b)).mean()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks of the elevation map.")
+    parser.add_argument("benchmark", choices=["ingest", "startup", "import", "inpaint", "min_filter"])
+    parser.add_argument("--backend", default="cupy")
+    parser.add_argument("--points", type=int, default=200000)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--cells", type=int, default=500, help="Width of the map for the inpaint and min_filter benchmarks.")
+    parser.add_argument("--disable-visibility-cleanup", action="store_true",
+                        help="Exclude the ray casting, which dominates the update on the numpy backend.")
+    parser.add_argument("--compact-layers", action="store_true",
+                        help="Store is_valid and is_upper_bound in narrow planes. (enable_compact_layers)")
+    args = parser.parse_args()
+    if args.benchmark == "ingest":
+        benchmark_ingest(args.backend, args.points, args.repeat,
+                         enable_visibility_cleanup=not args.disable_visibility_cleanup,
+                         enable_compact_layers=args.compact_layers)
+    elif args.benchmark == "startup":
+        benchmark_startup(args.backend)
+    elif args.benchmark == "import":
+        benchmark_import(args.backend, args.repeat)
+    elif args.benchmark == "inpaint":
+        benchmark_inpaint(args.backend, args.cells, args.repeat)
+    elif args.benchmark == "min_filter":
+        benchmark_min_filter(args.backend, args.cells, args.repeat)
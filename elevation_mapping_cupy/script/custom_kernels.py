@@ -3,11 +3,26 @@
 # Licensed under the MIT license. See LICENSE file in the project root for details.
 #
 import cupy as cp
+import functools
 import string
 
+from parameter import KERNEL_PARAMS, MAP_LAYER_INDEX, COMPACT_MAP_LAYER_INDEX
 
-def map_utils(resolution, width, height, sensor_noise_factor, min_valid_distance, max_height_range,
-              ramped_height_range_a, ramped_height_range_b, ramped_height_range_c):
+# point_idx of the points which are not valid in the fused kernels.
+INVALID_POINT = -2
+
+# The runtime parameters are read from the params kernel argument. (See Parameter.get_kernel_params)
+# The kernel sources do not depend on them, so changing them does not compile the kernels again.
+KERNEL_PARAM_ARGS = {name: "params[%d]" % i for i, name in enumerate(KERNEL_PARAMS)}
+
+
+def map_layer_args(compact):
+    # Layers of the float map used in the kernel sources. is_valid and is_upper_bound are separate arguments.
+    layer_index = COMPACT_MAP_LAYER_INDEX if compact else MAP_LAYER_INDEX
+    return dict(traversability_layer=layer_index[3], time_layer=layer_index[4], upper_bound_layer=layer_index[5])
+
+
+def map_utils(resolution, width, height):
     util_preamble = string.Template('''
         __device__ float16 clamp(float16 x, float16 min_x, float16 max_x) {
 
@@ -41,11 +56,18 @@ def map_utils(resolution, width, height, sensor_noise_factor, min_valid_distance
             const int layer = ${width} * ${height};
             return layer * layer_n + idx;
         }
+        __device__ int get_buffer_idx(int idx, int offset_x, int offset_y) {
+            // Convert the index in the map to the index in the ring buffer.
+            int idx_x = (idx / ${width} + offset_x) % ${width};
+            int idx_y = (idx % ${width} + offset_y) % ${height};
+            return ${width} * idx_x + idx_y;
+        }
         __device__ float transform_p(float16 x, float16 y, float16 z,
                                      float16 r0, float16 r1, float16 r2, float16 t) {
             return r0 * x + r1 * y + r2 * z + t;
         }
-        __device__ float z_noise(float16 z){
+        template <typename P>
+        __device__ float z_noise(float16 z, P params){
             return ${sensor_noise_factor} * z * z;
         }
 
@@ -55,11 +77,15 @@ def map_utils(resolution, width, height, sensor_noise_factor, min_valid_distance
             return d;
         }
 
+        template <typename P>
         __device__ bool is_valid(float16 x, float16 y, float16 z,
-                               float16 sx, float16 sy, float16 sz) {
+                               float16 sx, float16 sy, float16 sz, P params) {
             float d = point_sensor_distance(x, y, z, sx, sy, sz);
             float dxy = max(sqrt(x * x + y * y) - ${ramped_height_range_b}, 0.0);
-            if (d < ${min_valid_distance} * ${min_valid_distance}) {
+            if (isnan(d)) {
+                return false;
+            }
+            else if (d < ${min_valid_distance} * ${min_valid_distance}) {
                 return false;
             }
             else if (z - sz > dxy * ${ramped_height_range_a} + ${ramped_height_range_c} || z - sz > ${max_height_range}) {
@@ -97,42 +123,64 @@ def map_utils(resolution, width, height, sensor_noise_factor, min_valid_distance
             return product;
        }
 
-        ''').substitute(resolution=resolution, width=width, height=height,
-                        sensor_noise_factor=sensor_noise_factor,
-                        min_valid_distance=min_valid_distance,
-                        max_height_range=max_height_range,
-                        ramped_height_range_a=ramped_height_range_a,
-                        ramped_height_range_b=ramped_height_range_b,
-                        ramped_height_range_c=ramped_height_range_c,
-                        )
+        ''').substitute(resolution=resolution, width=width, height=height, **KERNEL_PARAM_ARGS)
     return util_preamble
 
 
-def add_points_kernel(resolution, width, height, sensor_noise_factor,
-                      mahalanobis_thresh, outlier_variance, wall_num_thresh,
-                      max_ray_length, cleanup_step, min_valid_distance,
-                      max_height_range, cleanup_cos_thresh,
-                      ramped_height_range_a, ramped_height_range_b, ramped_height_range_c,
-                      enable_edge_shaped=True, enable_visibility_cleanup=True):
-
-    add_points_kernel = cp.ElementwiseKernel(
-            in_params='raw U p, raw U center_x, raw U center_y, raw U R, raw U t, raw U norm_map',
-            out_params='raw U map, raw T newmap',
-            preamble=map_utils(resolution, width, height, sensor_noise_factor, min_valid_distance, max_height_range,
-                               ramped_height_range_a, ramped_height_range_b, ramped_height_range_c),
-            operation=\
-            string.Template(
+@functools.lru_cache(maxsize=None)
+def add_points_kernel(resolution, width, height,
+                      enable_edge_shaped=True, enable_visibility_cleanup=True, ray_skip_block_size=0, fused=False,
+                      compact=False):
+    """
+    params is the array of the runtime parameters. (See Parameter.get_kernel_params)
+    valid_map and is_upper_bound_map are the is_valid and is_upper_bound layers, which are views of map
+    or the narrow planes of the compact layout. In the compact layout, the cleanup lowers the confidence
+    through newmap layer 5, since there is no atomicAdd for float16. average_map_kernel applies it.
+    The visibility cleanup skips the cells of a ray_skip_block_size block of skip_map,
+    if the ray in the block is higher than the value of the block. (See ElevationMap.get_ray_skip_map)
+    skip_region is [x0, y0, block rows, block cols] of skip_map in the map.
+    If fused, the kernel takes the transformed points and their cells stored by the fused error_counting_kernel
+    instead of transforming and validating the points again. Its arguments are
+    (p, point_idx, center_x, center_y, t, norm_map, offset, skip_map, skip_region, params).
+    """
+    if fused:
+        in_params = 'raw U p, raw int32 point_idx, raw U center_x, raw U center_y, raw U t, raw U norm_map, ' \
+                    'raw int32 offset, raw U skip_map, raw int32 skip_region, raw U params'
+        point_operation = '''
+            // Transformed point and its cell in the ring buffer.
+            U x = p[i * 4];
+            U y = p[i * 4 + 1];
+            U z = p[i * 4 + 2];
+            U v = p[i * 4 + 3];
+            int idx = point_idx[i];
+            if (idx >= 0) {
+                ${fusion_operation}
+            }
             '''
+        # The validity of the point is stored in point_idx.
+        point_is_valid = 'idx != %d' % INVALID_POINT
+    else:
+        in_params = 'raw U p, raw U center_x, raw U center_y, raw U R, raw U t, raw U norm_map, raw int32 offset, ' \
+                    'raw U skip_map, raw int32 skip_region, raw U params'
+        point_operation = '''
             U rx = p[i * 3];
             U ry = p[i * 3 + 1];
             U rz = p[i * 3 + 2];
             U x = transform_p(rx, ry, rz, R[0], R[1], R[2], t[0]);
             U y = transform_p(rx, ry, rz, R[3], R[4], R[5], t[1]);
             U z = transform_p(rx, ry, rz, R[6], R[7], R[8], t[2]);
-            U v = z_noise(rz);
-            if (is_valid(x, y, z, t[0], t[1], t[2])) {
+            U v = z_noise(rz, params);
+            if (is_valid(x, y, z, t[0], t[1], t[2], params)) {
                 int idx = get_idx(x, y, center_x[0], center_y[0]);
                 if (is_inside(idx)) {
+                    idx = get_buffer_idx(idx, offset[0], offset[1]);
+                    ${fusion_operation}
+                }
+            }
+            '''
+        point_is_valid = 'is_valid(x, y, z, t[0], t[1], t[2], params)'
+
+    fusion_operation = '''
                     U map_h = map[get_map_idx(idx, 0)];
                     U map_v = map[get_map_idx(idx, 1)];
                     U num_points = newmap[get_map_idx(idx, 4)];
@@ -150,52 +198,114 @@ def add_points_kernel(resolution, width, height, sensor_noise_factor,
                             atomicAdd(&newmap[get_map_idx(idx, 1)], new_v);
                             atomicAdd(&newmap[get_map_idx(idx, 2)], 1.0);
                             // is Valid
-                            map[get_map_idx(idx, 2)] = 1;
+                            valid_map[idx] = V(1);
                             // Time layer
-                            map[get_map_idx(idx, 4)] = 0.0;
+                            map[get_map_idx(idx, ${time_layer})] = 0.0;
                             // Upper bound
-                            map[get_map_idx(idx, 5)] = new_h;
-                            map[get_map_idx(idx, 6)] = 0.0;
+                            map[get_map_idx(idx, ${upper_bound_layer})] = new_h;
+                            is_upper_bound_map[idx] = W(0);
                         }
                         // visibility cleanup
                     }
-                }
-            }
-            if (${enable_visibility_cleanup}) {
+            '''
+
+    cleanup_operation = '''
+            if (${enable_visibility_cleanup} && ${point_is_valid}) {
                 float16 ray_x, ray_y, ray_z;
                 float16 ray_length = ray_vector(t[0], t[1], t[2], x, y, z, ray_x, ray_y, ray_z);
                 ray_length = min(ray_length, (float16)${max_ray_length});
-                int last_nidx = -1;
-                for (float16 s=${ray_step}; s < ray_length; s+=${ray_step}) {
-                    // iterate through ray
-                    U nx = t[0] + ray_x * s;
-                    U ny = t[1] + ray_y * s;
-                    U nz = t[2] + ray_z * s;
-                    int nidx = get_idx(nx, ny, center_x[0], center_y[0]);
-                    if (last_nidx == nidx) {continue;}  // Skip if we're still in the same cell
-                    else {last_nidx = nidx;}
-                    if (!is_inside(nidx)) {continue;}
+                // Visit each cell crossed by the ray once. (Amanatides and Woo)
+                // Positions are in grid units where the cell idx_x covers [idx_x, idx_x + 1).
+                const float ux = (t[0] - center_x[0]) / ${resolution} + ${width} / 2 + 0.5;
+                const float uy = (t[1] - center_y[0]) / ${resolution} + ${height} / 2 + 0.5;
+                const float dux = ray_x / ${resolution};
+                const float duy = ray_y / ${resolution};
+                const int step_x = (dux > 0) - (dux < 0);
+                const int step_y = (duy > 0) - (duy < 0);
+                int idx_x = floor(ux);
+                int idx_y = floor(uy);
+                // Ray parameters where the ray crosses the next cell border.
+                float tmax_x = step_x == 0 ? ${max_ray_length} + 1 : (idx_x + (step_x > 0) - ux) / dux;
+                float tmax_y = step_y == 0 ? ${max_ray_length} + 1 : (idx_y + (step_y > 0) - uy) / duy;
+                const float tdelta_x = step_x == 0 ? 0 : fabs(1 / dux);
+                const float tdelta_y = step_y == 0 ? 0 : fabs(1 / duy);
+                int block_x = -1;
+                int block_y = -1;
+                bool skip_block = false;
+                for (float s = 0; s < ray_length;) {
+                    // The ray is in the cell between s_enter and s_exit.
+                    const int cell_x = idx_x;
+                    const int cell_y = idx_y;
+                    const float s_enter = s;
+                    const float s_exit = min(min(tmax_x, tmax_y), (float)ray_length);
+                    // Step to the next cell first, so that the cell can be skipped with continue.
+                    if (tmax_x < tmax_y) {
+                        idx_x += step_x;
+                        s = tmax_x;
+                        tmax_x += tdelta_x;
+                    }
+                    else {
+                        idx_y += step_y;
+                        s = tmax_y;
+                        tmax_y += tdelta_y;
+                    }
+                    // The ray does not come back once it leaves the map.
+                    if ((cell_x <= 0 && step_x <= 0) || (cell_x >= ${width} - 1 && step_x >= 0)
+                        || (cell_y <= 0 && step_y <= 0) || (cell_y >= ${height} - 1 && step_y >= 0)) {break;}
+                    if (cell_x <= 0 || cell_x >= ${width} - 1 || cell_y <= 0 || cell_y >= ${height} - 1) {continue;}
+
+                    if (${ray_skip_block_size} > 0) {
+                        const int bx = cell_x >= skip_region[0] ? (cell_x - skip_region[0]) / ${ray_skip_block_size} : -1;
+                        const int by = cell_y >= skip_region[1] ? (cell_y - skip_region[1]) / ${ray_skip_block_size} : -1;
+                        if (bx != block_x || by != block_y) {
+                            // Entering a block. Its cells are skipped if the ray is higher than any cell it can change.
+                            block_x = bx;
+                            block_y = by;
+                            skip_block = false;
+                            if (bx >= 0 && by >= 0 && bx < skip_region[2] && by < skip_region[3]) {
+                                float s_block = ray_length;
+                                if (step_x != 0) {
+                                    const int border_x = skip_region[0] + (bx + (step_x > 0)) * ${ray_skip_block_size};
+                                    s_block = min(s_block, (border_x - ux) / dux);
+                                }
+                                if (step_y != 0) {
+                                    const int border_y = skip_region[1] + (by + (step_y > 0)) * ${ray_skip_block_size};
+                                    s_block = min(s_block, (border_y - uy) / duy);
+                                }
+                                const float z_min = t[2] + ray_z * (ray_z > 0 ? s_enter : s_block);
+                                skip_block = z_min >= skip_map[bx * skip_region[3] + by];
+                            }
+                        }
+                        if (skip_block) {continue;}
+                    }
+
+                    // Check the ray at the middle of the cell.
+                    const float s_mid = (s_enter + s_exit) / 2;
+                    U nx = t[0] + ray_x * s_mid;
+                    U ny = t[1] + ray_y * s_mid;
+                    U nz = t[2] + ray_z * s_mid;
+                    int nidx = get_buffer_idx(${width} * cell_x + cell_y, offset[0], offset[1]);
 
                     U nmap_h = map[get_map_idx(nidx, 0)];
                     U nmap_v = map[get_map_idx(nidx, 1)];
-                    U nmap_valid = map[get_map_idx(nidx, 2)];
+                    U nmap_valid = valid_map[nidx];
                     // traversability
-                    U nmap_trav = map[get_map_idx(nidx, 3)];
+                    U nmap_trav = map[get_map_idx(nidx, ${traversability_layer})];
                     // Time layer
-                    U non_updated_t = map[get_map_idx(nidx, 4)];
+                    U non_updated_t = map[get_map_idx(nidx, ${time_layer})];
                     // upper bound
-                    U nmap_upper = map[get_map_idx(nidx, 5)];
-                    U nmap_is_upper = map[get_map_idx(nidx, 6)];
+                    U nmap_upper = map[get_map_idx(nidx, ${upper_bound_layer})];
+                    U nmap_is_upper = is_upper_bound_map[nidx];
 
                     // If point is close or is farther away than ray length, skip.
                     float16 d = (x - nx) * (x - nx) + (y - ny) * (y - ny) + (z - nz) * (z - nz);
-                    if (d < 0.1 || !is_valid(x, y, z, t[0], t[1], t[2])) {continue;}
+                    if (d < 0.1) {continue;}
 
                     // If invalid, do upper bound check, then skip
                     if (nmap_valid < 0.5) {
                       if (nz < nmap_upper || nmap_is_upper < 0.5) {
-                        map[get_map_idx(nidx, 5)] = nz;
-                        map[get_map_idx(nidx, 6)] = 1.0f;
+                        map[get_map_idx(nidx, ${upper_bound_layer})] = nz;
+                        is_upper_bound_map[nidx] = W(1);
                       }
                       continue;
                     }
@@ -213,40 +323,64 @@ def add_points_kernel(resolution, width, height, sensor_noise_factor,
                         if (num_points > ${wall_num_thresh} && non_updated_t < 1.0) {continue;}
 
                         // Finally, this cell is penetrated by the ray.
-                        atomicAdd(&map[get_map_idx(nidx, 2)], -${cleanup_step}/(ray_length / ${max_ray_length}));
+                        atomicAdd(${cleanup_target}, -${cleanup_step}/(ray_length / ${max_ray_length}));
                         atomicAdd(&map[get_map_idx(nidx, 1)], ${outlier_variance});
                         // Do upper bound check.
                         if (nz < nmap_upper || nmap_is_upper < 0.5) {
-                            map[get_map_idx(nidx, 5)] = nz;
-                            map[get_map_idx(nidx, 6)] = 1.0f;
+                            map[get_map_idx(nidx, ${upper_bound_layer})] = nz;
+                            is_upper_bound_map[nidx] = W(1);
                         }
                     }
                 }
             }
-            ''').substitute(mahalanobis_thresh=mahalanobis_thresh,
-                            outlier_variance=outlier_variance,
-                            wall_num_thresh=wall_num_thresh,
-                            ray_step=resolution / 2**0.5,
-                            max_ray_length=max_ray_length,
-                            cleanup_step=cleanup_step,
-                            cleanup_cos_thresh=cleanup_cos_thresh,
+            '''
+
+    add_points_kernel = cp.ElementwiseKernel(
+            in_params=in_params,
+            out_params='raw U map, raw V valid_map, raw W is_upper_bound_map, raw T newmap',
+            preamble=map_utils(resolution, width, height),
+            operation=\
+            string.Template(
+                string.Template(point_operation).substitute(fusion_operation=fusion_operation)
+                + cleanup_operation
+            ).substitute(resolution=resolution,
+                            width=width,
+                            height=height,
+                            ray_skip_block_size=int(ray_skip_block_size),
                             enable_edge_shaped=int(enable_edge_shaped),
-                            enable_visibility_cleanup=int(enable_visibility_cleanup)),
-            name='add_points_kernel')
+                            enable_visibility_cleanup=int(enable_visibility_cleanup),
+                            point_is_valid=point_is_valid,
+                            cleanup_target='&newmap[get_map_idx(nidx, 5)]' if compact else '&valid_map[nidx]',
+                            **map_layer_args(compact),
+                            **KERNEL_PARAM_ARGS),
+            name='fused_add_points_kernel' if fused else 'add_points_kernel')
     return add_points_kernel
 
 
-def error_counting_kernel(resolution, width, height, sensor_noise_factor,
-                          mahalanobis_thresh, outlier_variance,
-                          traversability_inlier, min_valid_distance, max_height_range,
-                          ramped_height_range_a, ramped_height_range_b, ramped_height_range_c,
-                          ):
-
+@functools.lru_cache(maxsize=None)
+def error_counting_kernel(resolution, width, height, fused=False, compact=False):
+    """
+    params is the array of the runtime parameters. (See Parameter.get_kernel_params)
+    If fused, the kernel also stores the transformed points with their noise (x, y, z, v) in points,
+    and the cell of each point in the ring buffer in point_idx, for the fused add_points_kernel.
+    The cell is -1 if the point is outside of the map and INVALID_POINT if the point is not valid.
+    """
+    out_params = 'raw U newmap, raw T error, raw T error_cnt'
+    store_operations = dict(store_point='', store_outside='', store_idx='')
+    if fused:
+        out_params += ', raw U points, raw int32 point_idx'
+        store_operations = dict(store_point='''points[i * 4] = x;
+            points[i * 4 + 1] = y;
+            points[i * 4 + 2] = z;
+            points[i * 4 + 3] = v;
+            point_idx[i] = %d;''' % INVALID_POINT,
+                                store_outside='point_idx[i] = -1;',
+                                store_idx='point_idx[i] = idx;')
     error_counting_kernel = cp.ElementwiseKernel(
-            in_params='raw U map, raw U p, raw U center_x, raw U center_y, raw U R, raw U t',
-            out_params='raw U newmap, raw T error, raw T error_cnt',
-            preamble=map_utils(resolution, width, height, sensor_noise_factor, min_valid_distance, max_height_range,
-                               ramped_height_range_a, ramped_height_range_b, ramped_height_range_c),
+            in_params='raw U map, raw V valid_map, raw U p, raw U center_x, raw U center_y, raw U R, raw U t, '
+                      'raw int32 offset, raw U params',
+            out_params=out_params,
+            preamble=map_utils(resolution, width, height),
             operation=\
             string.Template(
             '''
@@ -256,20 +390,24 @@ def error_counting_kernel(resolution, width, height, sensor_noise_factor,
             U x = transform_p(rx, ry, rz, R[0], R[1], R[2], t[0]);
             U y = transform_p(rx, ry, rz, R[3], R[4], R[5], t[1]);
             U z = transform_p(rx, ry, rz, R[6], R[7], R[8], t[2]);
-            U v = z_noise(rz);
+            U v = z_noise(rz, params);
+            ${store_point}
             // if (!is_valid(z, t[2])) {return;}
-            if (!is_valid(x, y, z, t[0], t[1], t[2])) {return;}
+            if (!is_valid(x, y, z, t[0], t[1], t[2], params)) {return;}
             // if ((x - t[0]) * (x - t[0]) + (y - t[1]) * (y - t[1]) + (z - t[2]) * (z - t[2]) < 0.5) {return;}
             int idx = get_idx(x, y, center_x[0], center_y[0]);
             if (!is_inside(idx)) {
+                ${store_outside}
                 return;
             }
+            idx = get_buffer_idx(idx, offset[0], offset[1]);
+            ${store_idx}
             U map_h = map[get_map_idx(idx, 0)];
             U map_v = map[get_map_idx(idx, 1)];
-            U map_valid = map[get_map_idx(idx, 2)];
-            U map_t = map[get_map_idx(idx, 3)];
+            U map_valid = valid_map[idx];
+            U map_t = map[get_map_idx(idx, ${traversability_layer})];
             if (map_valid > 0.5 && (abs(map_h - z) < (map_v * ${mahalanobis_thresh}))
-                && map_v < ${outlier_variance} / 2.0
+                && map_v < ${drift_compensation_variance_inlier} / 2.0
                 && map_t > ${traversability_inlier}) {
                 T e = z - map_h;
                 atomicAdd(&error[0], e);
@@ -277,58 +415,74 @@ def error_counting_kernel(resolution, width, height, sensor_noise_factor,
                 atomicAdd(&newmap[get_map_idx(idx, 3)], 1.0);
             }
             atomicAdd(&newmap[get_map_idx(idx, 4)], 1.0);
-            ''').substitute(mahalanobis_thresh=mahalanobis_thresh,
-                            outlier_variance=outlier_variance,
-                            traversability_inlier=traversability_inlier),
-            name='error_counting_kernel')
+            ''').substitute(**KERNEL_PARAM_ARGS, **store_operations, **map_layer_args(compact)),
+            name='fused_error_counting_kernel' if fused else 'error_counting_kernel')
     return error_counting_kernel
 
 
-def average_map_kernel(width, height, max_variance, initial_variance):
+@functools.lru_cache(maxsize=None)
+def average_map_kernel(width, height, compact=False):
+    """
+    In the compact layout, the cleanup of the cells without new points is applied to the confidence here.
+    (See add_points_kernel)
+    """
     average_map_kernel = cp.ElementwiseKernel(
-            in_params='raw U newmap',
-            out_params='raw U map',
+            in_params='raw U newmap, raw int32 offset, raw int32 region, raw U params',
+            out_params='raw U map, raw V valid_map',
             preamble=\
             string.Template('''
             __device__ int get_map_idx(int idx, int layer_n) {
                 const int layer = ${width} * ${height};
                 return layer * layer_n + idx;
             }
+
+            __device__ int get_region_idx(int i, int x0, int y0, int region_width, int offset_x, int offset_y) {
+                // Index in the ring buffer of the i-th cell of the region [x0:, y0:y0 + region_width] of the map.
+                const int idx_x = (x0 + i / region_width + offset_x) % ${width};
+                const int idx_y = (y0 + i % region_width + offset_y) % ${height};
+                return ${width} * idx_x + idx_y;
+            }
             ''').substitute(width=width, height=height),
             operation=\
             string.Template('''
-            U h = map[get_map_idx(i, 0)];
-            U v = map[get_map_idx(i, 1)];
-            U valid = map[get_map_idx(i, 2)];
-            U new_h = newmap[get_map_idx(i, 0)];
-            U new_v = newmap[get_map_idx(i, 1)];
-            U new_cnt = newmap[get_map_idx(i, 2)];
+            const int idx = get_region_idx(i, region[0], region[1], region[3], offset[0], offset[1]);
+            U h = map[get_map_idx(idx, 0)];
+            U v = map[get_map_idx(idx, 1)];
+            U valid = valid_map[idx];
+            U new_h = newmap[get_map_idx(idx, 0)];
+            U new_v = newmap[get_map_idx(idx, 1)];
+            U new_cnt = newmap[get_map_idx(idx, 2)];
+            // The cleanup of the compact layout. Cells with new points are valid again as in add_points_kernel.
+            if (${compact} && new_cnt == 0) {
+                valid += newmap[get_map_idx(idx, 5)];
+                valid_map[idx] = V(valid);
+            }
             if (new_cnt > 0) {
                 if (new_v / new_cnt > ${max_variance}) {
-                    map[get_map_idx(i, 0)] = 0;
-                    map[get_map_idx(i, 1)] = ${initial_variance};
-                    map[get_map_idx(i, 2)] = 0;
+                    map[get_map_idx(idx, 0)] = 0;
+                    map[get_map_idx(idx, 1)] = ${initial_variance};
+                    valid_map[idx] = V(0);
                 }
                 else {
-                    map[get_map_idx(i, 0)] = new_h / new_cnt;
-                    map[get_map_idx(i, 1)] = new_v / new_cnt;
-                    map[get_map_idx(i, 2)] = 1;
+                    map[get_map_idx(idx, 0)] = new_h / new_cnt;
+                    map[get_map_idx(idx, 1)] = new_v / new_cnt;
+                    valid_map[idx] = V(1);
                 }
             }
             if (valid < 0.5) {
-                map[get_map_idx(i, 0)] = 0;
-                map[get_map_idx(i, 1)] = ${initial_variance};
-                map[get_map_idx(i, 2)] = 0;
+                map[get_map_idx(idx, 0)] = 0;
+                map[get_map_idx(idx, 1)] = ${initial_variance};
+                valid_map[idx] = V(0);
             }
-            ''').substitute(max_variance=max_variance,
-                            initial_variance=initial_variance),
+            ''').substitute(compact=int(compact), **KERNEL_PARAM_ARGS),
             name='average_map_kernel')
     return average_map_kernel
 
 
+@functools.lru_cache(maxsize=None)
 def dilation_filter_kernel(width, height, dilation_size):
     dilation_filter_kernel = cp.ElementwiseKernel(
-            in_params='raw U map, raw U mask',
+            in_params='raw U map, raw U mask, raw int32 offset, raw int32 region',
             out_params='raw U newmap, raw U newmask',
             preamble=\
             string.Template('''
@@ -338,13 +492,16 @@ def dilation_filter_kernel(width, height, dilation_size):
             }
 
             __device__ int get_relative_map_idx(int idx, int dx, int dy, int layer_n) {
+                // The neighbor in the ring buffer.
                 const int layer = ${width} * ${height};
-                const int relative_idx = idx + ${width} * dy + dx;
-                return layer * layer_n + relative_idx;
-            }
-            __device__ bool is_inside(int idx) {
-                int idx_x = idx / ${width};
-                int idx_y = idx % ${width};
+                const int idx_x = (idx / ${width} + dy + ${width}) % ${width};
+                const int idx_y = (idx % ${width} + dx + ${height}) % ${height};
+                return layer * layer_n + ${width} * idx_x + idx_y;
+            }
+            __device__ bool is_inside_relative(int idx, int dx, int dy, int offset_x, int offset_y) {
+                // Check if the neighbor is inside of the map. (not in the ring buffer)
+                int idx_x = (idx / ${width} - offset_x + ${width}) % ${width} + dy;
+                int idx_y = (idx % ${width} - offset_y + ${height}) % ${height} + dx;
                 if (idx_x <= 0 || idx_x >= ${width} - 1) {
                     return false;
                 }
@@ -353,29 +510,37 @@ def dilation_filter_kernel(width, height, dilation_size):
                 }
                 return true;
             }
+
+            __device__ int get_region_idx(int i, int x0, int y0, int region_width, int offset_x, int offset_y) {
+                // Index in the ring buffer of the i-th cell of the region [x0:, y0:y0 + region_width] of the map.
+                const int idx_x = (x0 + i / region_width + offset_x) % ${width};
+                const int idx_y = (y0 + i % region_width + offset_y) % ${height};
+                return ${width} * idx_x + idx_y;
+            }
             ''').substitute(width=width, height=height),
             operation=\
             string.Template('''
-            U h = map[get_map_idx(i, 0)];
-            U valid = mask[get_map_idx(i, 0)];
-            newmap[get_map_idx(i, 0)] = h;
+            const int idx = get_region_idx(i, region[0], region[1], region[3], offset[0], offset[1]);
+            U h = map[get_map_idx(idx, 0)];
+            U valid = mask[get_map_idx(idx, 0)];
+            newmap[get_map_idx(idx, 0)] = h;
             if (valid < 0.5) {
                 U distance = 100;
                 U near_value = 0;
                 for (int dy = -${dilation_size}; dy <= ${dilation_size}; dy++) {
                     for (int dx = -${dilation_size}; dx <= ${dilation_size}; dx++) {
-                        int idx = get_relative_map_idx(i, dx, dy, 0);
-                        if (!is_inside(idx)) {continue;}
-                        U valid = mask[idx];
+                        if (!is_inside_relative(idx, dx, dy, offset[0], offset[1])) {continue;}
+                        int nidx = get_relative_map_idx(idx, dx, dy, 0);
+                        U valid = mask[nidx];
                         if(valid > 0.5 && dx + dy < distance) {
                             distance = dx + dy;
-                            near_value = map[idx];
+                            near_value = map[nidx];
                         }
                     }
                 }
                 if(distance < 100) {
-                    newmap[get_map_idx(i, 0)] = near_value;
-                    newmask[get_map_idx(i, 0)] = 1.0;
+                    newmap[get_map_idx(idx, 0)] = near_value;
+                    newmask[get_map_idx(idx, 0)] = 1.0;
                 }
             }
             ''').substitute(dilation_size=dilation_size),
@@ -383,9 +548,10 @@ def dilation_filter_kernel(width, height, dilation_size):
     return dilation_filter_kernel
 
 
+@functools.lru_cache(maxsize=None)
 def normal_filter_kernel(width, height, resolution):
     normal_filter_kernel = cp.ElementwiseKernel(
-            in_params='raw U map, raw U mask',
+            in_params='raw U map, raw U mask, raw int32 offset, raw int32 region',
             out_params='raw U newmap',
             preamble=\
             string.Template('''
@@ -395,13 +561,16 @@ def normal_filter_kernel(width, height, resolution):
             }
 
             __device__ int get_relative_map_idx(int idx, int dx, int dy, int layer_n) {
+                // The neighbor in the ring buffer.
                 const int layer = ${width} * ${height};
-                const int relative_idx = idx + ${width} * dy + dx;
-                return layer * layer_n + relative_idx;
-            }
-            __device__ bool is_inside(int idx) {
-                int idx_x = idx / ${width};
-                int idx_y = idx % ${width};
+                const int idx_x = (idx / ${width} + dy + ${width}) % ${width};
+                const int idx_y = (idx % ${width} + dx + ${height}) % ${height};
+                return layer * layer_n + ${width} * idx_x + idx_y;
+            }
+            __device__ bool is_inside_relative(int idx, int dx, int dy, int offset_x, int offset_y) {
+                // Check if the neighbor is inside of the map. (not in the ring buffer)
+                int idx_x = (idx / ${width} - offset_x + ${width}) % ${width} + dy;
+                int idx_y = (idx % ${width} - offset_y + ${height}) % ${height} + dx;
                 if (idx_x <= 0 || idx_x >= ${width} - 1) {
                     return false;
                 }
@@ -410,33 +579,42 @@ def normal_filter_kernel(width, height, resolution):
                 }
                 return true;
             }
+            __device__ int get_region_idx(int i, int x0, int y0, int region_width, int offset_x, int offset_y) {
+                // Index in the ring buffer of the i-th cell of the region [x0:, y0:y0 + region_width] of the map.
+                const int idx_x = (x0 + i / region_width + offset_x) % ${width};
+                const int idx_y = (y0 + i % region_width + offset_y) % ${height};
+                return ${width} * idx_x + idx_y;
+            }
             __device__ float resolution() {
                 return ${resolution};
             }
             ''').substitute(width=width, height=height, resolution=resolution),
             operation=\
             string.Template('''
-            U h = map[get_map_idx(i, 0)];
-            U valid = mask[get_map_idx(i, 0)];
+            const int idx = get_region_idx(i, region[0], region[1], region[3], offset[0], offset[1]);
+            U h = map[get_map_idx(idx, 0)];
+            U valid = mask[get_map_idx(idx, 0)];
             if (valid > 0.5) {
-                int idx_x = get_relative_map_idx(i, 1, 0, 0);
-                int idx_y = get_relative_map_idx(i, 0, 1, 0);
-                if (!is_inside(idx_x) || !is_inside(idx_y)) { return; }
+                if (!is_inside_relative(idx, 1, 0, offset[0], offset[1])
+                    || !is_inside_relative(idx, 0, 1, offset[0], offset[1])) { return; }
+                int idx_x = get_relative_map_idx(idx, 1, 0, 0);
+                int idx_y = get_relative_map_idx(idx, 0, 1, 0);
                 float dzdx = (map[idx_x] - h);
                 float dzdy = (map[idx_y] - h);
                 float nx = -dzdy / resolution();
                 float ny = -dzdx / resolution();
                 float nz = 1;
                 float norm = sqrt((nx * nx) + (ny * ny) + 1);
-                newmap[get_map_idx(i, 0)] = nx / norm;
-                newmap[get_map_idx(i, 1)] = ny / norm;
-                newmap[get_map_idx(i, 2)] = nz / norm;
+                newmap[get_map_idx(idx, 0)] = nx / norm;
+                newmap[get_map_idx(idx, 1)] = ny / norm;
+                newmap[get_map_idx(idx, 2)] = nz / norm;
             }
             ''').substitute(),
             name='normal_filter_kernel')
     return normal_filter_kernel
 
 
+@functools.lru_cache(maxsize=None)
 def polygon_mask_kernel(width, height, resolution):
     polygon_mask_kernel = cp.ElementwiseKernel(
             in_params='raw U polygon, raw U center_x, raw U center_y, raw int16 polygon_n, raw U polygon_bbox',
@@ -575,6 +753,41 @@ def polygon_mask_kernel(width, height, resolution):
     return polygon_mask_kernel
 
 
+@functools.lru_cache(maxsize=None)
+def traversability_filter_kernel():
+    """
+    The traversability filter in one pass. Three 3x3 convolutions with the dilations 1, 2 and 3,
+    absolute value, 1x1 convolution and exp(-x) for each output cell.
+    weights are w1, w2, w3 and w_out of Parameter flattened and concatenated. shape is the shape of input.
+    The output cell (x, y) is at (x + 3, y + 3) of input.
+    """
+    traversability_filter_kernel = cp.ElementwiseKernel(
+            in_params='raw float32 input, raw float32 weights, raw int32 shape',
+            out_params='raw float32 out',
+            operation=\
+            '''
+            const int width = shape[1];
+            const int x = i / (width - 6) + 3;
+            const int y = i % (width - 6) + 3;
+            float result = 0;
+            for (int d = 1; d <= 3; d++) {
+                for (int c = 0; c < 4; c++) {
+                    const int w = ((d - 1) * 4 + c) * 9;
+                    float conv = 0;
+                    for (int dx = -1; dx <= 1; dx++) {
+                        for (int dy = -1; dy <= 1; dy++) {
+                            conv += weights[w + (dx + 1) * 3 + dy + 1] * input[(x + dx * d) * width + y + dy * d];
+                        }
+                    }
+                    result += weights[108 + (d - 1) * 4 + c] * fabs(conv);
+                }
+            }
+            out[i] = exp(-result);
+            ''',
+            name='traversability_filter_kernel')
+    return traversability_filter_kernel
+
+
 if __name__ == '__main__':
     for i in range(10):
         import random
@@ -5,30 +5,20 @@
 import os
 import numpy as np
 import threading
-import subprocess
-
-from traversability_filter import get_filter_chainer, get_filter_torch
-from parameter import Parameter
-from custom_kernels import add_points_kernel
-from custom_kernels import error_counting_kernel
-from custom_kernels import average_map_kernel
-from custom_kernels import dilation_filter_kernel
-from custom_kernels import normal_filter_kernel
-from custom_kernels import polygon_mask_kernel
+from concurrent.futures import ThreadPoolExecutor
+
+from traversability_filter import get_filter_native, get_filter_chainer, get_filter_torch
+from parameter import Parameter, expand_path, MAP_LAYER_INDEX, COMPACT_MAP_LAYER_INDEX
+import numpy_kernels
 from map_initializer import MapInitializer
+from tile_store import TileStore
+from ingest_queue import IngestQueue
+from map_export import ExportBuffer, ExportHandle
 from plugins.plugin_manager import PluginManger
+from backend import get_backend, get_array_module, asnumpy, cp
 
 from traversability_polygon import get_masked_traversability, is_traversable, calculate_area, transform_to_map_position, transform_to_map_index
 
-import cupy as cp
-import cupyx.scipy as csp
-import cupyx.scipy.ndimage
-
-xp = cp
-sp = csp
-pool = cp.cuda.MemoryPool(cp.cuda.malloc_managed)
-cp.cuda.set_allocator(pool.malloc)
-
 
 class ElevationMap(object):
     """  
@@ -36,31 +26,52 @@ class ElevationMap(object):
     """
     def __init__(self, param: Parameter):
         self.param = param
+        self.xp = get_backend(param.backend)
+        xp = self.xp
+        assert param.dtype in ["float32", "float64"], "dtype should be float32 or float64."
+        self.dtype = np.dtype(param.dtype)
 
         self.resolution = param.resolution
+        # The center is kept in double precision since it is in the world coordinate.
         self.center = xp.array([0, 0, 0], dtype=float)
         self.map_length = param.map_length
         # +2 is a border for outside map
         self.cell_n = int(round(self.map_length / self.resolution)) + 2
 
         self.map_lock = threading.Lock()
+        # Guards the export buffers, so that the map is not locked during the copy to the host.
+        self.export_lock = threading.Lock()
+        self.create_export_buffers()
 
         # layers: elevation, variance, is_valid, traversability, time, upper_bound, is_upper_bound
-        self.elevation_map = xp.zeros((7, self.cell_n, self.cell_n))
+        # The map layers and normal_map are ring buffers. The cell (i, j) of the map is stored at
+        # ((i + map_offset[0]) % cell_n, (j + map_offset[1]) % cell_n), so that moving the map only
+        # needs to clear the cells coming into the map.
         self.layer_names = ["elevation", "variance", "is_valid", "traversability", "time", "upper_bound", "is_upper_bound"]
+        self.map_offset = [0, 0]
+        self.map_offset_array = xp.zeros(2, dtype=xp.int32)
+        # Regions (x0, x1, y0, y1) of the map which were changed since the last update of the filters.
+        # The dilation, traversability and normal filters are only computed in these regions with their margins.
+        self.dirty_regions = [self.get_full_region()]
+        # Masks in the map layout shared by the getters. They are computed once after each map update.
+        self.masks = {}
+        # Incremented by every change of the map. Exported layers are cached with the version they were made from,
+        # so each layer is computed and copied from the device at most once per map change.
+        self.map_version = 0
+        self.layer_cache = {}
         # buffers
-        self.traversability_buffer = xp.full((self.cell_n, self.cell_n), xp.nan)
-        self.normal_map = xp.zeros((3, self.cell_n, self.cell_n))
+        self.traversability_buffer = xp.full((self.cell_n, self.cell_n), xp.nan, dtype=self.dtype)
+        self.normal_map = xp.zeros((3, self.cell_n, self.cell_n), dtype=self.dtype)
         # Initial variance
         self.initial_variance = param.initial_variance
-        self.elevation_map[1] += self.initial_variance
-        self.elevation_map[3] += 1.0
+        # values of the cells coming into the map
+        self.layer_initial_values = xp.array([0.0, self.initial_variance, 0.0, 0.0, 0.0, 0.0, 0.0],
+                                             dtype=self.dtype).reshape(7, 1, 1)
+        self.create_map()
+        self.map_layers[3] += 1.0
 
         # overlap clearance
-        cell_range = int(self.param.overlap_clear_range_xy / self.resolution)
-        cell_range = np.clip(cell_range, 0, self.cell_n)
-        self.cell_min = self.cell_n // 2 - cell_range // 2
-        self.cell_max = self.cell_n // 2 + cell_range // 2
+        self.set_overlap_clear_range()
 
         # Initial mean_error
         self.mean_error = 0.0
@@ -68,268 +79,873 @@ class ElevationMap(object):
 
         self.compile_kernels()
 
-        weight_file = subprocess.getoutput("echo \"" + param.weight_file + "\"")
-        param.load_weights(weight_file)
-
-        if param.use_chainer:
-            self.traversability_filter = get_filter_chainer(param.w1, param.w2, param.w3, param.w_out)
-        else:
-            self.traversability_filter = get_filter_torch(param.w1, param.w2, param.w3, param.w_out)
+        param.load_weights(expand_path(param.weight_file))
+        self.create_traversability_filter()
         self.untraversable_polygon = xp.zeros((1, 2))
 
         # Plugins
-        self.plugin_manager = PluginManger(cell_n=self.cell_n)
-        plugin_config_file = subprocess.getoutput("echo \"" + param.plugin_config_file + "\"")
-        self.plugin_manager.load_plugin_settings(plugin_config_file)
+        self.plugin_worker = None
+        self.plugin_future = None
+        self.create_plugin_worker()
+        self.load_plugins()
+
+        # Cells leaving the map are kept in the tile store and loaded again when they come back.
+        # The tiles have the 7 layers of the map and the 3 layers of the normal.
+        if param.enable_tile_store:
+            tile_store_path = None
+            if param.tile_store_path != "":
+                tile_store_path = expand_path(param.tile_store_path)
+            tile_initial_values = xp.concatenate([self.layer_initial_values, xp.zeros((3, 1, 1), dtype=self.dtype)])
+            self.tile_store = TileStore(10, param.tile_size, tile_initial_values, xp=self.xp, dtype=self.dtype,
+                                        path=tile_store_path)
+            if len(self.tile_store) > 0:
+                self.load_map_from_tiles()
+        else:
+            self.tile_store = None
 
         self.map_initializer = MapInitializer(self.initial_variance, param.initialized_variance,
-                                              xp=cp, method='points')
+                                              xp=self.xp, method='points')
+
+        # Point clouds are queued and processed by a background thread.
+        self.create_ingest_queue()
+
+    def create_map(self):
+        """
+        Allocate the layers of the map with their initial values. map_layers has a view of each layer in the order
+        of layer_names. elevation_map has the layers of dtype. With enable_compact_layers, is_valid is a float16
+        plane which is also the confidence of the visibility cleanup, and is_upper_bound is a uint8 plane.
+        """
+        xp = self.xp
+        n = self.cell_n
+        layer_index = COMPACT_MAP_LAYER_INDEX if self.param.enable_compact_layers else MAP_LAYER_INDEX
+        narrow_dtypes = {2: np.float16, 6: np.uint8}
+        self.float_layers = [i for i, idx in enumerate(layer_index) if idx is not None]
+        self.narrow_layers = [i for i, idx in enumerate(layer_index) if idx is None]
+        self.elevation_map = xp.zeros((len(self.float_layers), n, n), dtype=self.dtype)
+        self.map_layers = [self.elevation_map[idx] if idx is not None else xp.zeros((n, n), dtype=narrow_dtypes[i])
+                           for i, idx in enumerate(layer_index)]
+        self.fill_map_region(self.get_full_region())
+
+    def get_map_layers(self):
+        # All layers in the map layout as one dtype array, which is given to the plugins. This is a copy of the map.
+        if len(self.narrow_layers) == 0:
+            return self.to_map_layout(self.elevation_map)
+        return self.xp.stack([self.to_map_layout(layer).astype(self.dtype) for layer in self.map_layers])
+
+    def get_map_values(self, index):
+        # Values of all layers at the index (rows, cols) of the ring buffer as one dtype array.
+        if len(self.narrow_layers) == 0:
+            return self.elevation_map[(slice(None),) + index]
+        return self.xp.stack([layer[index].astype(self.dtype) for layer in self.map_layers])
+
+    def set_map_values(self, index, values):
+        if len(self.narrow_layers) == 0:
+            self.elevation_map[(slice(None),) + index] = values
+        else:
+            for layer, value in zip(self.map_layers, values):
+                layer[index] = value
+
+    def fill_map_region(self, region):
+        # Set the cells of the region to the initial values of the layers.
+        self.fill_region(self.elevation_map, region, self.layer_initial_values[self.float_layers])
+        for i in self.narrow_layers:
+            self.fill_region(self.map_layers[i], region, self.layer_initial_values[i])
+
+    def set_overlap_clear_range(self):
+        cell_range = int(self.param.overlap_clear_range_xy / self.resolution)
+        cell_range = np.clip(cell_range, 0, self.cell_n)
+        self.cell_min = self.cell_n // 2 - cell_range // 2
+        self.cell_max = self.cell_n // 2 + cell_range // 2
+
+    def create_traversability_filter(self):
+        # The filter is created on its first use, since importing torch or chainer takes time.
+        # The native filter does not need a deep learning framework.
+        param = self.param
+        self.traversability_filter = None
+        # If the sum of each convolution kernel is zero, traversability does not change by the shift of the height.
+        self.is_traversability_height_invariant = all(
+                np.abs(w.reshape(w.shape[0], -1).sum(axis=1)).max() < 1e-6 for w in [param.w1, param.w2, param.w3])
+
+    def create_export_buffers(self):
+        # The copies to the host run on their own stream, so that they overlap with the next update of the map.
+        stream = cp.cuda.Stream(non_blocking=True) if self.xp is cp else None
+        self.export_buffers = [ExportBuffer(self.xp, stream) for i in range(self.param.export_buffer_n)]
+        self.export_buffer_index = 0
+
+    def create_plugin_worker(self):
+        # With enable_background_plugins, the plugins run on this thread with a copy of the map.
+        if self.param.enable_background_plugins and self.plugin_worker is None:
+            self.plugin_worker = ThreadPoolExecutor(max_workers=1)
+
+    def close_plugin_worker(self):
+        # Wait for the running plugin update and stop the worker. Call without map_lock.
+        future = self.plugin_future
+        self.plugin_future = None
+        if self.plugin_worker is not None:
+            self.plugin_worker.shutdown(wait=True)
+            self.plugin_worker = None
+        if future is not None:
+            # Raise the error of the last update.
+            future.result()
+
+    def close(self):
+        # Process the queued point clouds and finish the plugin update, then stop the threads.
+        if self.ingest_queue is not None:
+            self.ingest_queue.close()
+            self.ingest_queue = None
+        self.close_plugin_worker()
+
+    def load_plugins(self):
+        self.plugin_manager = PluginManger(cell_n=self.cell_n, xp=self.xp, dtype=self.dtype,
+                                           thread_n=self.param.plugin_thread_n)
+        self.plugin_manager.load_plugin_settings(expand_path(self.param.plugin_config_file))
+
+    def get_traversability_filter(self):
+        if self.traversability_filter is None:
+            param = self.param
+            use_cupy = self.xp is cp
+            if param.use_native_traversability_filter:
+                self.traversability_filter = get_filter_native(param.w1, param.w2, param.w3, param.w_out,
+                                                               use_cupy=use_cupy)
+            elif param.use_chainer:
+                self.traversability_filter = get_filter_chainer(param.w1, param.w2, param.w3, param.w_out,
+                                                                use_cupy=use_cupy)
+            else:
+                self.traversability_filter = get_filter_torch(param.w1, param.w2, param.w3, param.w_out,
+                                                              use_cupy=use_cupy)
+        return self.traversability_filter
+
+    def create_ingest_queue(self):
+        if self.param.enable_async_ingest:
+            self.ingest_queue = IngestQueue(self.input_batch, self.param.ingest_queue_size,
+                                            self.param.ingest_drop_policy)
+        else:
+            self.ingest_queue = None
+
+    def update_parameters(self, **changes):
+        """
+        Change the parameters of the running map. Only the parts depending on the changed parameters are
+        created again, and the kernels are reused unless their sources change. (See compile_kernels)
+        If resolution or map_length changes, the layers are resampled to the new grid around the same center.
+        backend, dtype, enable_compact_layers and the tile store parameters can only be set when creating the map,
+        and resolution cannot be changed with the tile store.
+        """
+        names = self.param.get_names()
+        for name in changes:
+            assert name in names, "{} is not a parameter.".format(name)
+            assert name not in ["backend", "dtype", "enable_compact_layers", "enable_tile_store", "tile_size",
+                                "tile_store_path"], \
+                "{} cannot be changed after creating the map.".format(name)
+        changed = set(name for name, value in changes.items()
+                      if not np.array_equal(np.asarray(self.param.get_value(name)), np.asarray(value)))
+        if len(changed) == 0:
+            return
+        assert self.tile_store is None or "resolution" not in changed, \
+            "resolution cannot be changed with the tile store."
+        # Finish the queued point clouds with the old parameters.
+        self.wait_for_ingest()
+        old_resolution = self.resolution
+        with self.map_lock:
+            # An update of the map sees either the old or the new parameters.
+            for name in changed:
+                self.param.set_value(name, changes[name])
+            if "weight_file" in changed:
+                self.param.load_weights(expand_path(self.param.weight_file))
+            if "initial_variance" in changed:
+                self.initial_variance = self.param.initial_variance
+                self.layer_initial_values[1] = self.initial_variance
+                if self.tile_store is not None:
+                    self.tile_store.initial_values[1] = self.initial_variance
+            resized = bool(changed & {"resolution", "map_length"})
+            if resized:
+                self.resample_map(old_resolution)
+            if resized or changed & {"enable_edge_sharpen", "enable_visibility_cleanup", "ray_skip_block_size",
+                                     "enable_fused_ingest", "dilation_size", "dilation_size_initialize"}:
+                self.compile_kernels()
+            else:
+                self.kernel_params[...] = self.xp.asarray(self.param.get_kernel_params(), dtype=self.dtype)
+            if resized or "overlap_clear_range_xy" in changed:
+                self.set_overlap_clear_range()
+            filter_params = {"weight_file", "w1", "w2", "w3", "w_out", "use_native_traversability_filter", "use_chainer"}
+            if changed & filter_params:
+                self.create_traversability_filter()
+            if resized or changed & (filter_params | {"dilation_size"}):
+                self.add_dirty_region(self.get_full_region())
+            if resized or changed & {"plugin_config_file", "plugin_thread_n"}:
+                self.load_plugins()
+            if "enable_background_plugins" in changed:
+                self.create_plugin_worker()
+            if changed & {"initial_variance", "initialized_variance"}:
+                self.map_initializer = MapInitializer(self.initial_variance, self.param.initialized_variance,
+                                                      xp=self.xp, method='points')
+            self.notify_map_update()
+        if changed & {"enable_async_ingest", "ingest_queue_size", "ingest_drop_policy"}:
+            if self.ingest_queue is not None:
+                self.ingest_queue.close()
+            self.create_ingest_queue()
+        if "enable_background_plugins" in changed and not self.param.enable_background_plugins:
+            # No update is started after the parameter is changed.
+            self.close_plugin_worker()
+        if "export_buffer_n" in changed:
+            # The buffers in use are kept by their handles.
+            with self.export_lock:
+                self.create_export_buffers()
+
+    def resample_map(self, old_resolution):
+        # Resample the layers to the grid of the current resolution and map_length. Call with map_lock.
+        xp = self.xp
+        old_cell_n = self.cell_n
+        if self.tile_store is not None:
+            self.save_region_to_tiles(self.get_full_region(), self.get_map_origin())
+        old_map = self.get_map_layers()
+        self.resolution = self.param.resolution
+        self.map_length = self.param.map_length
+        self.cell_n = int(round(self.map_length / self.resolution)) + 2
+        # Nearest cell of the old map for each cell of the new map. The cells outside of the old map are initialized.
+        cells = xp.arange(self.cell_n)
+        idx = xp.rint((cells - self.cell_n // 2) * self.resolution / old_resolution).astype(int) + old_cell_n // 2
+        inside = (idx > 0) & (idx < old_cell_n - 1) & (cells > 0) & (cells < self.cell_n - 1)
+        idx = idx.clip(0, old_cell_n - 1)
+        resampled = old_map[:, idx.reshape(-1, 1), idx.reshape(1, -1)]
+        inside = inside.reshape(-1, 1) & inside.reshape(1, -1)
+        self.create_map()
+        self.set_map_values((slice(None), slice(None)), xp.where(inside, resampled, self.layer_initial_values))
+        self.normal_map = xp.zeros((3, self.cell_n, self.cell_n), dtype=self.dtype)
+        self.traversability_buffer = xp.full((self.cell_n, self.cell_n), xp.nan, dtype=self.dtype)
+        self.set_map_offset([0, 0])
+        if self.tile_store is not None:
+            # Cells which were not in the old map.
+            self.load_region_from_tiles(self.get_full_region(), self.get_map_origin())
+        self.dirty_regions = []
+        self.add_dirty_region(self.get_full_region())
 
-    def clear(self):
+    def clear(self, clear_tiles=True):
         with self.map_lock:
-            self.elevation_map *= 0.0
-            # Initial variance
-            self.elevation_map[1] += self.initial_variance
+            self.fill_map_region(self.get_full_region())
+            self.normal_map *= 0.0
+            self.set_map_offset([0, 0])
+            self.add_dirty_region(self.get_full_region())
+            self.notify_map_update()
+            if self.tile_store is not None and clear_tiles:
+                self.tile_store.clear()
         self.mean_error = 0.0
         self.additive_mean_error = 0.0
 
     def get_position(self, position):
-        position[0][:] = xp.asnumpy(self.center)
+        position[0][:] = asnumpy(self.center)
 
     def move(self, delta_position):
         # Shift map using delta position.
+        xp = self.xp
         delta_position = xp.asarray(delta_position)
         delta_pixel = xp.round(delta_position[:2] / self.resolution)
         delta_position_xy = delta_pixel * self.resolution
         self.center[:2] += xp.asarray(delta_position_xy)
         self.center[2] += xp.asarray(delta_position[2])
-        self.shift_map_xy(delta_pixel)
         self.shift_map_z(-delta_position[2])
+        self.shift_map_xy(delta_pixel)
 
     def move_to(self, position):
         # Shift map to the center of robot.
+        xp = self.xp
         position = xp.asarray(position)
         delta = position - self.center
         delta_pixel = xp.around(delta[:2] / self.resolution)
         delta_xy = delta_pixel * self.resolution
         self.center[:2] += delta_xy
         self.center[2] += delta[2]
-        self.shift_map_xy(-delta_pixel)
+        # Shift z first, so that the heights of the cells leaving the map are relative to the new center.
         self.shift_map_z(-delta[2])
+        self.shift_map_xy(-delta_pixel)
 
     def shift_map_xy(self, delta_pixel):
-        shift_value = delta_pixel
-        shift_fn = sp.ndimage.interpolation.shift
+        # Shift the ring buffer and clear only the rows and columns coming into the map.
+        shift_value = [int(v) for v in asnumpy(delta_pixel)]
+        if shift_value == [0, 0]:
+            return
+        # Regions of the map leaving the map (before the shift) and coming into the map (after the shift).
+        n = self.cell_n
+        leaving_regions = []
+        incoming_regions = []
+        for axis, shift in enumerate(shift_value):
+            if shift == 0:
+                continue
+            s = min(abs(shift), n)
+            leaving = (n - s, n) if shift > 0 else (0, s)
+            incoming = (0, s) if shift > 0 else (n - s, n)
+            leaving_regions.append(leaving + (0, n) if axis == 0 else (0, n) + leaving)
+            incoming_regions.append(incoming + (0, n) if axis == 0 else (0, n) + incoming)
         with self.map_lock:
-            # elevation
-            self.elevation_map[0] = shift_fn(self.elevation_map[0], shift_value,
-                                             cval=0.0)
-            # variance
-            self.elevation_map[1] = shift_fn(self.elevation_map[1], shift_value,
-                                             cval=self.initial_variance)
-            # is valid (1 is valid 0 is not valid)
-            self.elevation_map[2] = shift_fn(self.elevation_map[2], shift_value,
-                                             cval=0)
-            # upper bound
-            self.elevation_map[5] = shift_fn(self.elevation_map[5], shift_value,
-                                             cval=0)
-            # is upper bound
-            self.elevation_map[6] = shift_fn(self.elevation_map[6], shift_value,
-                                             cval=0)
+            if self.tile_store is not None:
+                # The contents of the map move by the shift, so the map origin before the shift is shifted back.
+                origin = self.get_map_origin()
+                previous_origin = [origin[i] + shift_value[i] for i in range(2)]
+                for region in leaving_regions:
+                    self.save_region_to_tiles(region, previous_origin)
+            self.set_map_offset([(self.map_offset[i] - shift_value[i]) % n for i in range(2)])
+            # Move the dirty regions with the map.
+            dirty_regions = self.dirty_regions
+            self.dirty_regions = []
+            for x0, x1, y0, y1 in dirty_regions:
+                self.add_dirty_region((x0 + shift_value[0], x1 + shift_value[0], y0 + shift_value[1], y1 + shift_value[1]))
+            for region in incoming_regions:
+                self.fill_map_region(region)
+                self.fill_region(self.normal_map, region, 0.0)
+                if self.tile_store is not None:
+                    self.load_region_from_tiles(region, origin)
+                self.add_dirty_region(region)
+            self.notify_map_update()
+
+    def get_map_origin(self):
+        # Index of the cell (0, 0) of the map in the world grid.
+        center_cell = np.round(asnumpy(self.center[:2]) / self.resolution).astype(int)
+        return [int(c) - self.cell_n // 2 for c in center_cell]
+
+    def save_region_to_tiles(self, region, origin):
+        index = self.get_region_index(region)
+        values = self.xp.concatenate([self.get_map_values(index), self.normal_map[(slice(None),) + index]])
+        # Heights are stored in the world frame.
+        values[[0, 5]] += self.center[2]
+        occupied = self.xp.logical_or(values[2] > 0.5, values[6] > 0.5)
+        self.tile_store.write(origin[0] + region[0], origin[1] + region[2], values, occupied)
+
+    def load_region_from_tiles(self, region, origin):
+        # The normals are restored too, so they are valid before the region is updated again.
+        index = self.get_region_index(region)
+        values = self.xp.concatenate([self.get_map_values(index), self.normal_map[(slice(None),) + index]])
+        values[[0, 5]] += self.center[2]
+        self.tile_store.read(origin[0] + region[0], origin[1] + region[2], values)
+        values[[0, 5]] -= self.center[2]
+        self.set_map_values(index, values[:7])
+        self.normal_map[(slice(None),) + index] = values[7:]
+
+    def save_map_to_tiles(self):
+        # Write the whole map to the tile store. Call this to keep the current map in the store on the disk.
+        with self.map_lock:
+            self.save_region_to_tiles(self.get_full_region(), self.get_map_origin())
+            self.tile_store.flush()
+
+    def load_map_from_tiles(self):
+        with self.map_lock:
+            self.load_region_from_tiles(self.get_full_region(), self.get_map_origin())
+            self.add_dirty_region(self.get_full_region())
+            self.notify_map_update()
+
+    def notify_map_update(self):
+        # Called when the map is changed.
+        self.map_version += 1
+        self.masks = {}
+        self.layer_cache = {}
+        self.plugin_manager.mark_dirty()
+
+    def get_valid_mask(self):
+        if "valid" not in self.masks:
+            self.masks["valid"] = self.to_map_layout(self.map_layers[2]) > 0.5
+        return self.masks["valid"]
+
+    def get_traversability_mask(self):
+        if "traversability" not in self.masks:
+            self.masks["traversability"] = self.to_map_layout(self.map_layers[2] + self.map_layers[6]) > 0.5
+        return self.masks["traversability"]
+
+    def get_upper_bound_mask(self):
+        if "upper_bound" not in self.masks:
+            xp = self.xp
+            valid = self.get_valid_mask()
+            is_upper_bound = self.to_map_layout(self.map_layers[6]) > 0.5
+            if self.param.use_only_above_for_upper_bound:
+                above = self.to_map_layout(self.map_layers[5]) > 0.0
+                self.masks["upper_bound"] = xp.logical_or(xp.logical_and(above, is_upper_bound), valid)
+            else:
+                self.masks["upper_bound"] = xp.logical_or(valid, is_upper_bound)
+        return self.masks["upper_bound"]
+
+    def set_map_offset(self, offset):
+        self.map_offset = list(offset)
+        self.map_offset_array[...] = self.xp.asarray(self.map_offset, dtype=self.xp.int32)
+
+    def to_map_layout(self, array):
+        # Convert ring buffer data to the map layout where the center of the map is at cell_n // 2.
+        return self.xp.roll(array, (-self.map_offset[0], -self.map_offset[1]), axis=(-2, -1))
+
+    def get_buffer_index(self, start, stop):
+        # Index of the ring buffer corresponding to the square [start:stop, start:stop] of the map.
+        return self.get_region_index((start, stop, start, stop))
+
+    def get_region_index(self, region):
+        # Index of the ring buffer corresponding to the region [x0:x1, y0:y1] of the map.
+        x0, x1, y0, y1 = region
+        rows = (self.xp.arange(x0, x1) + self.map_offset[0]) % self.cell_n
+        cols = (self.xp.arange(y0, y1) + self.map_offset[1]) % self.cell_n
+        return rows.reshape(-1, 1), cols.reshape(1, -1)
+
+    def get_region_array(self, region):
+        # Region argument of the kernels. [x0, y0, rows, cols]
+        x0, x1, y0, y1 = region
+        return self.xp.array([x0, y0, x1 - x0, y1 - y0], dtype=self.xp.int32)
+
+    def get_full_region(self):
+        return (0, self.cell_n, 0, self.cell_n)
+
+    def expand_region(self, region, margin, lower=0, upper=None):
+        if upper is None:
+            upper = self.cell_n
+        x0, x1, y0, y1 = region
+        return (max(x0 - margin, lower), min(x1 + margin, upper), max(y0 - margin, lower), min(y1 + margin, upper))
+
+    def add_dirty_region(self, region):
+        if not self.param.enable_dirty_region_update:
+            region = self.get_full_region()
+        x0, x1, y0, y1 = self.expand_region(region, 0)
+        if x0 >= x1 or y0 >= y1:
+            return
+        self.dirty_regions.append((x0, x1, y0, y1))
+        # Process the whole map if there are many regions or they cover a large area.
+        area = sum((r[1] - r[0]) * (r[3] - r[2]) for r in self.dirty_regions)
+        if len(self.dirty_regions) > 8 or area > self.cell_n * self.cell_n / 2:
+            self.dirty_regions = [self.get_full_region()]
+
+    def fill_region(self, array, region, value):
+        if region == self.get_full_region():
+            array[...] = value
+        else:
+            rows, cols = self.get_region_index(region)
+            array[..., rows, cols] = value
 
     def shift_map_z(self, delta_z):
         with self.map_lock:
             # elevation
-            self.elevation_map[0] += delta_z
+            self.shift_elevation(delta_z)
             # upper bound
-            self.elevation_map[5] += delta_z
+            self.map_layers[5] += delta_z
+            # The dilated upper bound is shifted in the same way.
+            self.traversability_input += delta_z
+            if not self.is_traversability_height_invariant:
+                self.add_dirty_region(self.get_full_region())
+            self.notify_map_update()
+
+    def shift_elevation(self, delta_z):
+        # Invalid cells keep the initial height. The average kernel resets them only in the updated region,
+        # and the new points are fused with the height they have.
+        self.map_layers[0] += delta_z
+        self.xp.copyto(self.map_layers[0], 0.0, where=self.map_layers[2] < 0.5)
 
     def compile_kernels(self):
-        # Compile custom cuda kernels.
-        self.new_map = cp.zeros((7, self.cell_n, self.cell_n))
-        self.traversability_input = cp.zeros((self.cell_n, self.cell_n))
-        self.traversability_mask_dummy = cp.zeros((self.cell_n, self.cell_n))
-        self.min_filtered = cp.zeros((self.cell_n, self.cell_n))
-        self.min_filtered_mask = cp.zeros((self.cell_n, self.cell_n))
-        self.mask = cp.zeros((self.cell_n, self.cell_n))
-        self.add_points_kernel = add_points_kernel(self.resolution,
-                                                   self.cell_n,
-                                                   self.cell_n,
-                                                   self.param.sensor_noise_factor,
-                                                   self.param.mahalanobis_thresh,
-                                                   self.param.outlier_variance,
-                                                   self.param.wall_num_thresh,
-                                                   self.param.max_ray_length,
-                                                   self.param.cleanup_step,
-                                                   self.param.min_valid_distance,
-                                                   self.param.max_height_range,
-                                                   self.param.cleanup_cos_thresh,
-                                                   self.param.ramped_height_range_a,
-                                                   self.param.ramped_height_range_b,
-                                                   self.param.ramped_height_range_c,
-                                                   self.param.enable_edge_sharpen,
-                                                   self.param.enable_visibility_cleanup)
-        self.error_counting_kernel = error_counting_kernel(self.resolution,
+        # Compile custom cuda kernels, or prepare their numpy versions for the numpy backend.
+        # The kernels are cached by their arguments, and cupy keeps the compiled binaries on disk.
+        # Tuning parameters are passed at runtime in kernel_params, so they are not part of the kernel sources.
+        xp = self.xp
+        if xp is np:
+            kernels = numpy_kernels
+        else:
+            import custom_kernels as kernels
+        self.new_map = xp.zeros((7, self.cell_n, self.cell_n), dtype=self.dtype)
+        self.traversability_input = xp.zeros((self.cell_n, self.cell_n), dtype=self.dtype)
+        self.traversability_mask_dummy = xp.zeros((self.cell_n, self.cell_n), dtype=self.dtype)
+        self.min_filtered = xp.zeros((self.cell_n, self.cell_n), dtype=self.dtype)
+        self.min_filtered_mask = xp.zeros((self.cell_n, self.cell_n), dtype=self.dtype)
+        self.mask = xp.zeros((self.cell_n, self.cell_n), dtype=self.dtype)
+        # center of the map in the map frame, used as kernel arguments.
+        self.zero_center = xp.zeros(1, dtype=self.dtype)
+        # Transformed points (x, y, z, noise) and their cells, shared by the fused ingest kernels.
+        self.transformed_points = xp.zeros((0, 4), dtype=self.dtype)
+        self.point_idx = xp.zeros(0, dtype=xp.int32)
+        # Empty skip map used when the ray skip is disabled.
+        self.no_skip_map = xp.zeros(1, dtype=self.dtype)
+        self.no_skip_region = xp.zeros(4, dtype=xp.int32)
+        # Sum and count of the height errors for the drift compensation.
+        self.drift_error = xp.zeros(1, dtype=xp.float32)
+        self.drift_error_cnt = xp.zeros(1, dtype=xp.float32)
+        # Runtime parameters of the kernels. (See Parameter.get_kernel_params)
+        self.kernel_params = xp.array(self.param.get_kernel_params(), dtype=self.dtype)
+        self.add_points_kernel = kernels.add_points_kernel(self.resolution,
                                                            self.cell_n,
                                                            self.cell_n,
-                                                           self.param.sensor_noise_factor,
-                                                           self.param.mahalanobis_thresh,
-                                                           self.param.drift_compensation_variance_inlier,
-                                                           self.param.traversability_inlier,
-                                                           self.param.min_valid_distance,
-                                                           self.param.max_height_range,
-                                                           self.param.ramped_height_range_a,
-                                                           self.param.ramped_height_range_b,
-                                                           self.param.ramped_height_range_c,
-                                                           )
-        self.average_map_kernel = average_map_kernel(self.cell_n, self.cell_n,
-                                                     self.param.max_variance, self.initial_variance)
-
-        self.dilation_filter_kernel = dilation_filter_kernel(self.cell_n, self.cell_n, self.param.dilation_size)
-        self.dilation_filter_kernel_initializer = dilation_filter_kernel(self.cell_n, self.cell_n, self.param.dilation_size_initialize)
-        self.polygon_mask_kernel = polygon_mask_kernel(self.cell_n, self.cell_n, self.resolution)
-        self.normal_filter_kernel = normal_filter_kernel(self.cell_n, self.cell_n, self.resolution)
+                                                           self.param.enable_edge_sharpen,
+                                                           self.param.enable_visibility_cleanup,
+                                                           self.param.ray_skip_block_size,
+                                                           self.param.enable_fused_ingest,
+                                                           self.param.enable_compact_layers)
+        self.error_counting_kernel = kernels.error_counting_kernel(self.resolution,
+                                                                   self.cell_n,
+                                                                   self.cell_n,
+                                                                   self.param.enable_fused_ingest,
+                                                                   self.param.enable_compact_layers)
+        self.average_map_kernel = kernels.average_map_kernel(self.cell_n, self.cell_n,
+                                                             self.param.enable_compact_layers)
+
+        self.dilation_filter_kernel = kernels.dilation_filter_kernel(self.cell_n, self.cell_n,
+                                                                     self.param.dilation_size)
+        self.dilation_filter_kernel_initializer = kernels.dilation_filter_kernel(self.cell_n, self.cell_n,
+                                                                                 self.param.dilation_size_initialize)
+        self.polygon_mask_kernel = kernels.polygon_mask_kernel(self.cell_n, self.cell_n, self.resolution)
+        self.normal_filter_kernel = kernels.normal_filter_kernel(self.cell_n, self.cell_n, self.resolution)
+
+    def update_kernel_params(self):
+        # Send the tuning parameters to the kernels after changing them in self.param.
+        with self.map_lock:
+            self.kernel_params[...] = self.xp.asarray(self.param.get_kernel_params(), dtype=self.dtype)
+
+    def warm_up(self):
+        """
+        Run each kernel and the traversability filter once on scratch buffers, so that the kernels are compiled
+        (or loaded from the kernel cache) before the first point cloud. The map is not changed.
+        """
+        xp = self.xp
+        with self.map_lock:
+            elevation_map = self.elevation_map.copy()
+            valid_map = self.map_layers[2].copy()
+            is_upper_bound_map = self.map_layers[6].copy()
+            new_map = xp.zeros_like(self.new_map)
+            layer = xp.zeros((self.cell_n, self.cell_n), dtype=self.dtype)
+            region = self.get_region_array((1, 2, 1, 2))
+            # The point is rejected by the kernels.
+            points = xp.full((1, 3), xp.nan, dtype=self.dtype)
+            R = xp.eye(3, dtype=self.dtype)
+            t = xp.zeros(3, dtype=self.dtype)
+            error = xp.zeros(1, dtype=xp.float32)
+            error_cnt = xp.zeros(1, dtype=xp.float32)
+            if self.param.enable_fused_ingest:
+                transformed = xp.zeros((1, 4), dtype=self.dtype)
+                point_idx = xp.zeros(1, dtype=xp.int32)
+                self.error_counting_kernel(elevation_map, valid_map, points, self.zero_center, self.zero_center, R, t,
+                                           self.map_offset_array, self.kernel_params, new_map, error, error_cnt,
+                                           transformed, point_idx, size=1)
+                self.add_points_kernel(transformed, point_idx, self.zero_center, self.zero_center, t,
+                                       self.normal_map, self.map_offset_array, self.no_skip_map, self.no_skip_region,
+                                       self.kernel_params, elevation_map, valid_map, is_upper_bound_map, new_map,
+                                       size=1)
+            else:
+                self.error_counting_kernel(elevation_map, valid_map, points, self.zero_center, self.zero_center, R, t,
+                                           self.map_offset_array, self.kernel_params, new_map, error, error_cnt,
+                                           size=1)
+                self.add_points_kernel(points, self.zero_center, self.zero_center, R, t, self.normal_map,
+                                       self.map_offset_array, self.no_skip_map, self.no_skip_region,
+                                       self.kernel_params, elevation_map, valid_map, is_upper_bound_map, new_map,
+                                       size=1)
+            self.average_map_kernel(new_map, self.map_offset_array, region, self.kernel_params,
+                                    elevation_map, valid_map, size=1)
+            for dilation_filter_kernel in [self.dilation_filter_kernel, self.dilation_filter_kernel_initializer]:
+                dilation_filter_kernel(layer, layer, self.map_offset_array, region, new_map[0], new_map[1], size=1)
+            self.normal_filter_kernel(layer, layer, self.map_offset_array, region, new_map[:3], size=1)
+            polygon = xp.zeros((3, 2), dtype=self.dtype)
+            self.polygon_mask_kernel(polygon, self.zero_center[0], self.zero_center[0], 3, polygon[0].repeat(2),
+                                     layer, size=1)
+            self.get_traversability_filter()(layer[:7, :7])
 
     def shift_translation_to_map_center(self, t):
         t -= self.center
 
     def update_map_with_kernel(self, points, R, t, position_noise, orientation_noise):
-        self.new_map *= 0.0
-        error = cp.array([0.0], dtype=cp.float32)
-        error_cnt = cp.array([0], dtype=cp.float32)
+        self.update_map_with_kernel_batch([points], [R], [t], position_noise, orientation_noise)
+
+    def get_point_buffers(self, point_ns):
+        # Views of the fused ingest buffers for each point cloud. The buffers grow when more points come.
+        xp = self.xp
+        total = sum(point_ns)
+        if self.point_idx.shape[0] < total:
+            self.transformed_points = xp.empty((total, 4), dtype=self.dtype)
+            self.point_idx = xp.empty(total, dtype=xp.int32)
+        starts = np.cumsum([0] + point_ns)
+        transformed_list = [self.transformed_points[s:e] for s, e in zip(starts[:-1], starts[1:])]
+        point_idx_list = [self.point_idx[s:e] for s, e in zip(starts[:-1], starts[1:])]
+        return transformed_list, point_idx_list
+
+    def get_points_region(self, points_list, R_list, t_list):
+        # Region of the map which can be changed by the points and the rays from the sensors.
+        # The region is read from the device, so the full map is used in the sync free ingest.
+        if not self.param.enable_dirty_region_update or self.param.enable_sync_free_ingest:
+            return self.get_full_region()
+        xp = self.xp
+        bounds = []
+        for points, R, t in zip(points_list, R_list, t_list):
+            # The points are already transformed if R is None.
+            xy = points[:, :2] if R is None else points @ R[:2].T + t[:2]
+            xy = xp.concatenate([xy, t[:2].reshape(1, 2)])
+            # Points with NaN are ignored by the kernels.
+            bounds.append(xp.concatenate([xp.nanmin(xy, axis=0), xp.nanmax(xy, axis=0)]))
+        bounds = asnumpy(xp.stack(bounds))
+        xy_min = bounds[:, :2].min(axis=0)
+        xy_max = bounds[:, 2:].max(axis=0)
+        if not (np.isfinite(xy_min).all() and np.isfinite(xy_max).all()):
+            return self.get_full_region()
+        # Clamp the bounds of all points and sensors together to the map.
+        idx_min = np.clip(np.floor(xy_min / self.resolution) + self.cell_n // 2 - 1, 0, self.cell_n).astype(int)
+        idx_max = np.clip(np.ceil(xy_max / self.resolution) + self.cell_n // 2 + 2, 0, self.cell_n).astype(int)
+        # Use the full map if the region is empty, e.g. the sensor and the points are out of the map.
+        if (idx_min >= idx_max).any():
+            return self.get_full_region()
+        return (idx_min[0], idx_max[0], idx_min[1], idx_max[1])
+
+    def update_map_with_kernel_batch(self, points_list, R_list, t_list, position_noise, orientation_noise):
+        # Scatter all point clouds into the map, then run the per-map processing once.
+        xp = self.xp
+        error = self.drift_error
+        error_cnt = self.drift_error_cnt
+        error.fill(0)
+        error_cnt.fill(0)
         with self.map_lock:
-            self.shift_translation_to_map_center(t)
-            self.error_counting_kernel(self.elevation_map, points,
-                                       cp.array([0.]), cp.array([0.]), R, t,
-                                       self.new_map, error, error_cnt,
-                                       size=(points.shape[0]))
+            for t in t_list:
+                self.shift_translation_to_map_center(t)
+            t_list = [t.astype(self.dtype) for t in t_list]
+            if self.param.enable_fused_ingest:
+                # Each point is transformed and validated once, and the result is reused by add_points_kernel.
+                transformed_list, point_idx_list = self.get_point_buffers([points.shape[0] for points in points_list])
+                for points, R, t, transformed, point_idx in zip(points_list, R_list, t_list,
+                                                                transformed_list, point_idx_list):
+                    self.error_counting_kernel(self.elevation_map, self.map_layers[2], points,
+                                               self.zero_center, self.zero_center, R, t, self.map_offset_array,
+                                               self.kernel_params, self.new_map, error, error_cnt,
+                                               transformed, point_idx,
+                                               size=(points.shape[0]))
+                region = self.get_points_region(transformed_list, [None] * len(t_list), t_list)
+            else:
+                region = self.get_points_region(points_list, R_list, t_list)
+                for points, R, t in zip(points_list, R_list, t_list):
+                    self.error_counting_kernel(self.elevation_map, self.map_layers[2], points,
+                                               self.zero_center, self.zero_center, R, t, self.map_offset_array,
+                                               self.kernel_params, self.new_map, error, error_cnt,
+                                               size=(points.shape[0]))
             if (self.param.enable_drift_compensation
-                    and error_cnt > self.param.min_height_drift_cnt
                     and (position_noise > self.param.position_noise_thresh
                          or orientation_noise > self.param.orientation_noise_thresh)):
-                self.mean_error = error / error_cnt
-                self.additive_mean_error += self.mean_error
-                if np.abs(self.mean_error) < self.param.max_drift:
-                    self.elevation_map[0] += self.mean_error * self.param.drift_compensation_alpha
-            self.add_points_kernel(points, cp.array([0.]), cp.array([0.]), R, t, self.normal_map,
-                                   self.elevation_map, self.new_map,
-                                   size=(points.shape[0]))
-            self.average_map_kernel(self.new_map, self.elevation_map,
-                                    size=(self.cell_n * self.cell_n))
+                self.compensate_drift(error, error_cnt)
+            skip_map, skip_region = self.get_ray_skip_map(region)
+            if self.param.enable_fused_ingest:
+                for t, transformed, point_idx in zip(t_list, transformed_list, point_idx_list):
+                    self.add_points_kernel(transformed, point_idx, self.zero_center, self.zero_center, t,
+                                           self.normal_map, self.map_offset_array, skip_map, skip_region,
+                                           self.kernel_params, self.elevation_map, self.map_layers[2],
+                                           self.map_layers[6], self.new_map,
+                                           size=(point_idx.shape[0]))
+            else:
+                for points, R, t in zip(points_list, R_list, t_list):
+                    self.add_points_kernel(points, self.zero_center, self.zero_center, R, t, self.normal_map,
+                                           self.map_offset_array, skip_map, skip_region,
+                                           self.kernel_params, self.elevation_map, self.map_layers[2],
+                                           self.map_layers[6], self.new_map,
+                                           size=(points.shape[0]))
+            x0, x1, y0, y1 = region
+            self.average_map_kernel(self.new_map, self.map_offset_array, self.get_region_array(region),
+                                    self.kernel_params, self.elevation_map, self.map_layers[2],
+                                    size=((x1 - x0) * (y1 - y0)))
+            self.fill_region(self.new_map, region, 0.0)
+            self.add_dirty_region(region)
 
             if self.param.enable_overlap_clearance:
-                self.clear_overlap_map(t)
+                # Use the mean sensor position if there are multiple point clouds.
+                self.clear_overlap_map(sum(t_list) / len(t_list))
 
-            # dilation before traversability_filter
-            self.traversability_input *= 0.0
-            self.dilation_filter_kernel(self.elevation_map[5],
-                                        self.elevation_map[2]+self.elevation_map[6],
-                                        self.traversability_input,
-                                        self.traversability_mask_dummy,
-                                        size=(self.cell_n * self.cell_n))
-            # calculate traversability
-            traversability = self.traversability_filter(self.traversability_input)
-            self.elevation_map[3][3:-3, 3:-3] = traversability.reshape((traversability.shape[2], traversability.shape[3]))
+            dirty_regions = self.dirty_regions
+            self.dirty_regions = []
+            self.update_traversability(dirty_regions)
+            self.notify_map_update()
 
         # calculate normal vectors
-        self.update_normal(self.traversability_input)
+        self.update_normal(self.traversability_input, dirty_regions)
+
+    def compensate_drift(self, error, error_cnt):
+        # Shift the heights by the mean error of the points to the map.
+        xp = self.xp
+        if self.param.enable_sync_free_ingest:
+            # Decide on the device, so that the host does not wait for the kernels.
+            enough = error_cnt > self.param.min_height_drift_cnt
+            mean_error = xp.where(enough, error / xp.maximum(error_cnt, 1), 0)
+            self.mean_error = xp.where(enough, mean_error, self.mean_error)
+            self.additive_mean_error = self.additive_mean_error + mean_error
+            drift = xp.where(xp.abs(mean_error) < self.param.max_drift, mean_error, 0)
+            self.shift_elevation((drift * self.param.drift_compensation_alpha).astype(self.dtype))
+        elif error_cnt > self.param.min_height_drift_cnt:
+            self.mean_error = error / error_cnt
+            self.additive_mean_error += self.mean_error
+            if np.abs(self.mean_error) < self.param.max_drift:
+                self.shift_elevation(self.mean_error * self.param.drift_compensation_alpha)
+
+    def get_ray_skip_map(self, region):
+        """
+        Coarse map of the region used to skip cells in the visibility cleanup.
+        Each block of ray_skip_block_size cells keeps the height above which a ray cannot change any of its cells,
+        so rays passing above it skip the whole block.
+        Returns the skip map and [x0, y0, block rows, block cols] of the skip map in the map.
+        """
+        xp = self.xp
+        block = self.param.ray_skip_block_size
+        if block <= 0 or not self.param.enable_visibility_cleanup:
+            return self.no_skip_map, self.no_skip_region
+        x0, x1, y0, y1 = region
+        m = self.get_map_values(self.get_region_index(region))
+        # A ray can penetrate a valid cell if it is lower than h + 0.04. (h + 0.01 - min(v, 1) * 0.05 in the kernel)
+        # Cells updated in this update are not changed.
+        valid_limit = xp.where(m[4] < 0.5, -xp.inf, m[0] + 0.04)
+        # A ray lowers the upper bound of an invalid cell if it is lower than the upper bound.
+        invalid_limit = xp.where(m[6] < 0.5, xp.inf, m[5])
+        limit = xp.where(m[2] < 0.5, invalid_limit, valid_limit)
+        rows = -(-(x1 - x0) // block)
+        cols = -(-(y1 - y0) // block)
+        padded = xp.full((rows * block, cols * block), -xp.inf, dtype=self.dtype)
+        padded[:x1 - x0, :y1 - y0] = limit
+        skip_map = padded.reshape(rows, block, cols, block).max(axis=(1, 3))
+        return skip_map, xp.array([x0, y0, rows, cols], dtype=xp.int32)
+
+    def update_traversability(self, regions):
+        # dilation before traversability_filter
+        margin = int(self.param.dilation_size)
+        mask = (self.map_layers[2] + self.map_layers[6]).astype(self.dtype, copy=False)
+        for region in regions:
+            region = self.expand_region(region, margin)
+            x0, x1, y0, y1 = region
+            self.dilation_filter_kernel(self.map_layers[5],
+                                        mask,
+                                        self.map_offset_array,
+                                        self.get_region_array(region),
+                                        self.traversability_input,
+                                        self.traversability_mask_dummy,
+                                        size=((x1 - x0) * (y1 - y0)))
+        # calculate traversability
+        # The filter needs 3 cells around each cell, and the traversability is not computed at the border.
+        for region in regions:
+            region = self.expand_region(region, margin + 3, 3, self.cell_n - 3)
+            x0, x1, y0, y1 = region
+            if x0 >= x1 or y0 >= y1:
+                continue
+            traversability = self.get_traversability_filter()(
+                    self.traversability_input[self.get_region_index(self.expand_region(region, 3))])
+            self.map_layers[3][self.get_region_index(region)] = \
+                traversability.reshape((traversability.shape[2], traversability.shape[3]))
 
     def clear_overlap_map(self, t):
         # Clear overlapping area around center
         height_min = t[2] - self.param.overlap_clear_range_z
         height_max = t[2] + self.param.overlap_clear_range_z
-        near_map = self.elevation_map[:, self.cell_min:self.cell_max, self.cell_min:self.cell_max]
-        valid_idx = ~cp.logical_or(near_map[0] < height_min, near_map[0] > height_max)
-        near_map[0] = cp.where(valid_idx, near_map[0], 0.0)
-        near_map[1] = cp.where(valid_idx, near_map[1], self.initial_variance)
-        near_map[2] = cp.where(valid_idx, near_map[2], 0.0)
-        valid_idx = ~cp.logical_or(near_map[5] < height_min, near_map[5] > height_max)
-        near_map[5] = cp.where(valid_idx, near_map[5], 0.0)
-        near_map[6] = cp.where(valid_idx, near_map[6], 0.0)
-        self.elevation_map[:, self.cell_min:self.cell_max, self.cell_min:self.cell_max] = near_map
+        xp = self.xp
+        index = self.get_buffer_index(self.cell_min, self.cell_max)
+        self.add_dirty_region((self.cell_min, self.cell_max, self.cell_min, self.cell_max))
+        near_map = self.get_map_values(index)
+        valid_idx = ~xp.logical_or(near_map[0] < height_min, near_map[0] > height_max)
+        near_map[0] = xp.where(valid_idx, near_map[0], 0.0)
+        near_map[1] = xp.where(valid_idx, near_map[1], self.initial_variance)
+        near_map[2] = xp.where(valid_idx, near_map[2], 0.0)
+        valid_idx = ~xp.logical_or(near_map[5] < height_min, near_map[5] > height_max)
+        near_map[5] = xp.where(valid_idx, near_map[5], 0.0)
+        near_map[6] = xp.where(valid_idx, near_map[6], 0.0)
+        self.set_map_values(index, near_map)
 
     def get_additive_mean_error(self):
-        return self.additive_mean_error
+        # The error is a device array after the drift compensation.
+        return float(asnumpy(self.xp.asarray(self.additive_mean_error)).reshape(-1)[0])
 
     def update_variance(self):
-        self.elevation_map[1] += self.param.time_variance * self.elevation_map[2]
+        with self.map_lock:
+            self.map_layers[1] += self.param.time_variance * self.map_layers[2].astype(self.dtype, copy=False)
+            self.notify_map_update()
 
     def update_time(self):
-        self.elevation_map[4] += self.param.time_interval
+        with self.map_lock:
+            self.map_layers[4] += self.param.time_interval
+            self.notify_map_update()
 
     def update_upper_bound_with_valid_elevation(self):
-        mask = self.elevation_map[2] > 0.5
-        self.elevation_map[5] = cp.where(mask, self.elevation_map[0], self.elevation_map[5])
-        self.elevation_map[6] = cp.where(mask, 0.0, self.elevation_map[6])
+        mask = self.map_layers[2] > 0.5
+        self.xp.copyto(self.map_layers[5], self.map_layers[0], where=mask)
+        self.xp.copyto(self.map_layers[6], 0, where=mask)
+        self.add_dirty_region(self.get_full_region())
+        self.notify_map_update()
 
     def input(self, raw_points, R, t, position_noise, orientation_noise):
         # Update elevation map using point cloud input.
-        raw_points = cp.asarray(raw_points)
-        raw_points = raw_points[~cp.isnan(raw_points).any(axis=1)]
-        self.update_map_with_kernel(raw_points, cp.asarray(R), cp.asarray(t), position_noise, orientation_noise)
+        xp = self.xp
+        if self.ingest_queue is not None:
+            # The arrays of the caller can be reused after the call, so they are copied.
+            self.ingest_queue.put(get_array_module(raw_points).array(raw_points), np.array(R), np.array(t),
+                                  position_noise, orientation_noise)
+            return
+        # Points with NaN are not removed here, since it needs the host to wait for the device.
+        # The kernels ignore them.
+        raw_points = xp.asarray(raw_points, dtype=self.dtype)
+        self.update_map_with_kernel(raw_points, xp.asarray(R, dtype=self.dtype), xp.array(t, dtype=float),
+                                    position_noise, orientation_noise)
+
+    def input_batch(self, raw_points_list, R_list, t_list, position_noise, orientation_noise):
+        # Update elevation map using multiple point clouds at once.
+        # The drift compensation, map averaging, traversability and normal are computed once for all clouds.
+        # The update is done in this call even if the async ingest is enabled.
+        xp = self.xp
+        if len(raw_points_list) == 0:
+            return
+        points_list = [xp.asarray(raw_points, dtype=self.dtype) for raw_points in raw_points_list]
+        R_list = [xp.asarray(R, dtype=self.dtype) for R in R_list]
+        t_list = [xp.array(t, dtype=float) for t in t_list]
+        self.update_map_with_kernel_batch(points_list, R_list, t_list, position_noise, orientation_noise)
+
+    def wait_for_ingest(self):
+        # Wait until the queued point clouds are processed.
+        if self.ingest_queue is not None:
+            self.ingest_queue.wait()
+
+    def get_ingest_statistics(self):
+        # Queue depth and counters of the async ingest. None if it is disabled.
+        if self.ingest_queue is None:
+            return None
+        return self.ingest_queue.get_statistics()
 
-    def update_normal(self, dilated_map):
+    def update_normal(self, dilated_map, regions=None):
+        if regions is None:
+            regions = [self.get_full_region()]
+        # The normal uses the next cells of the dilated map.
+        margin = int(self.param.dilation_size) + 1
         with self.map_lock:
-            self.normal_map *= 0.0
-            self.normal_filter_kernel(dilated_map, self.elevation_map[2], self.normal_map, size=(self.cell_n * self.cell_n))
+            for region in regions:
+                region = self.expand_region(region, margin)
+                x0, x1, y0, y1 = region
+                self.fill_region(self.normal_map, region, 0.0)
+                self.normal_filter_kernel(dilated_map, self.map_layers[2].astype(self.dtype, copy=False),
+                                          self.map_offset_array,
+                                          self.get_region_array(region), self.normal_map,
+                                          size=((x1 - x0) * (y1 - y0)))
+            self.notify_map_update()
 
-    def process_map_for_publish(self, input_map, fill_nan=False, add_z=False, xp=cp):
-        m = input_map.copy()
+    def process_map_for_publish(self, input_map, fill_nan=False, add_z=False, xp=None):
+        # input_map should be in the map layout. (not in the ring buffer layout)
+        if xp is None:
+            xp = self.xp
+        m = input_map
         if fill_nan:
-            m = xp.where(self.elevation_map[2] > 0.5,
-                    m, xp.nan)
+            m = xp.where(self.get_valid_mask(), m, xp.nan)
         if add_z:
-            m = m + self.center[2]
+            m = m + self.center[2].astype(m.dtype)
         return m[1:-1, 1:-1]
 
     def get_elevation(self):
-        return self.process_map_for_publish(self.elevation_map[0], fill_nan=True, add_z=True)
+        return self.process_map_for_publish(self.to_map_layout(self.map_layers[0]), fill_nan=True, add_z=True)
 
     def get_variance(self):
-        return self.process_map_for_publish(self.elevation_map[1], fill_nan=False, add_z=False)
+        return self.process_map_for_publish(self.to_map_layout(self.map_layers[1]), fill_nan=False, add_z=False)
 
     def get_traversability(self):
-        traversability = cp.where((self.elevation_map[2] + self.elevation_map[6]) > 0.5,
-                                  self.elevation_map[3].copy(), cp.nan)
+        traversability = self.xp.where(self.get_traversability_mask(),
+                                       self.to_map_layout(self.map_layers[3]), self.xp.nan)
         self.traversability_buffer[3:-3, 3: -3] = traversability[3:-3, 3:-3]
         traversability = self.traversability_buffer[1:-1, 1:-1]
         return traversability
 
     def get_time(self):
-        return self.process_map_for_publish(self.elevation_map[4], fill_nan=False, add_z=False)
+        return self.process_map_for_publish(self.to_map_layout(self.map_layers[4]), fill_nan=False, add_z=False)
 
     def get_upper_bound(self):
-        if self.param.use_only_above_for_upper_bound:
-            valid = cp.logical_or(cp.logical_and(self.elevation_map[5] > 0.0, self.elevation_map[6] > 0.5), self.elevation_map[2] > 0.5)
-        else:
-            valid = cp.logical_or(self.elevation_map[2] > 0.5, self.elevation_map[6] > 0.5)
-        upper_bound = cp.where(valid, self.elevation_map[5].copy(), cp.nan)
-        upper_bound = upper_bound[1:-1, 1:-1] + self.center[2]
+        xp = self.xp
+        upper_bound = xp.where(self.get_upper_bound_mask(), self.to_map_layout(self.map_layers[5]), xp.nan)
+        upper_bound = upper_bound[1:-1, 1:-1] + self.center[2].astype(upper_bound.dtype)
         return upper_bound
 
     def get_is_upper_bound(self):
-        if self.param.use_only_above_for_upper_bound:
-            valid = cp.logical_or(cp.logical_and(self.elevation_map[5] > 0.0, self.elevation_map[6] > 0.5), self.elevation_map[2] > 0.5)
-        else:
-            valid = cp.logical_or(self.elevation_map[2] > 0.5, self.elevation_map[6] > 0.5)
-        is_upper_bound = cp.where(valid, self.elevation_map[6].copy(), cp.nan)
+        xp = self.xp
+        is_upper_bound = self.to_map_layout(self.map_layers[6]).astype(self.dtype, copy=False)
+        is_upper_bound = xp.where(self.get_upper_bound_mask(), is_upper_bound, xp.nan)
         is_upper_bound = is_upper_bound[1:-1, 1:-1]
         return is_upper_bound
 
     def xp_of_array(self, array):
-        if type(array) == cp.ndarray:
-            return cp
-        elif type(array) == np.ndarray:
-            return np
-
-    def copy_to_cpu(self, array, data, stream=None):
-        if type(array) == np.ndarray:
-            data[...] = array.astype(np.float32)
-        elif type(array) == cp.ndarray:
-            if stream is not None:
-                data[...] = cp.asnumpy(array.astype(np.float32), stream=stream)
-            else:
-                data[...] = cp.asnumpy(array.astype(np.float32))
+        return get_array_module(array)
 
     def exists_layer(self, name):
         if name in self.layer_names:
@@ -339,66 +955,184 @@ class ElevationMap(object):
         else:
             return False
 
-    def get_map_with_name_ref(self, name, data):
-        use_stream = True
-        xp = cp
+    def get_layer_for_publish(self, name):
+        # The layer in the map layout without the border, or None if it is not in the map. Call with map_lock.
+        if name == "elevation":
+            return self.get_elevation()
+        elif name == "variance":
+            return self.get_variance()
+        elif name == "traversability":
+            return self.get_traversability()
+        elif name == "time":
+            return self.get_time()
+        elif name == "upper_bound":
+            return self.get_upper_bound()
+        elif name == "is_upper_bound":
+            return self.get_is_upper_bound()
+        elif name == "normal_x":
+            return self.to_map_layout(self.normal_map[0])[1:-1, 1:-1]
+        elif name == "normal_y":
+            return self.to_map_layout(self.normal_map[1])[1:-1, 1:-1]
+        elif name == "normal_z":
+            return self.to_map_layout(self.normal_map[2])[1:-1, 1:-1]
+        elif name in self.plugin_manager.layer_names:
+            if not self.param.enable_background_plugins:
+                self.update_plugin_layers([name])
+            m = self.plugin_manager.get_map_with_name(name)
+            p = self.plugin_manager.get_param_with_name(name)
+            xp = self.xp_of_array(m)
+            return self.process_map_for_publish(m, fill_nan=p.fill_nan, add_z=p.is_height_layer, xp=xp)
+        return None
+
+    def update_plugin_layers(self, names):
+        # Run the dirty plugins of the layers. Call with map_lock.
+        # Plugins work in the map layout, which is a copy of the map, so it is made only if a plugin runs.
+        if len(self.plugin_manager.get_update_indices(names)) > 0:
+            self.plugin_manager.update_with_names(names, self.get_map_layers(), self.layer_names)
+
+    def start_plugin_update(self, names):
+        """
+        Update the plugin layers on the plugin worker with a copy of the map. Call with map_lock.
+        Nothing is started while the previous update is running. The layers keep their last results until
+        the update is published, so they can be older than the map.
+        """
+        if self.plugin_future is not None:
+            if not self.plugin_future.done():
+                return
+            # Raise the error of the previous update.
+            future = self.plugin_future
+            self.plugin_future = None
+            future.result()
+        indices = self.plugin_manager.get_update_indices(names)
+        if len(indices) == 0:
+            return
+        # get_map_layers makes a copy, so the map can be changed during the update.
+        self.plugin_future = self.plugin_worker.submit(self.update_plugins, self.plugin_manager, indices,
+                                                       self.get_map_layers(),
+                                                       self.plugin_manager.layers.copy(), self.map_version)
+
+    def update_plugins(self, plugin_manager, indices, elevation_map, layers, version):
+        # Run on the plugin worker.
+        plugin_manager.run_plugins(indices, elevation_map, self.layer_names, layers)
         with self.map_lock:
-            if name == "elevation":
-                m = self.get_elevation()
-                use_stream = False
-            elif name == "variance":
-                m = self.get_variance()
-            elif name == "traversability":
-                m = self.get_traversability()
-            elif name == "time":
-                m = self.get_time()
-            elif name == "upper_bound":
-                m = self.get_upper_bound()
-            elif name == "is_upper_bound":
-                m = self.get_is_upper_bound()
-            elif name == "normal_x":
-                m = self.normal_map.copy()[0, 1:-1, 1:-1]
-            elif name == "normal_y":
-                m = self.normal_map.copy()[1, 1:-1, 1:-1]
-            elif name == "normal_z":
-                m = self.normal_map.copy()[2, 1:-1, 1:-1]
-            elif name in self.plugin_manager.layer_names:
-                self.plugin_manager.update_with_name(name, self.elevation_map, self.layer_names)
-                m = self.plugin_manager.get_map_with_name(name)
-                p = self.plugin_manager.get_param_with_name(name)
-                xp = self.xp_of_array(m)
-                m = self.process_map_for_publish(m, fill_nan=p.fill_nan, add_z=p.is_height_layer, xp=xp)
-            else:
-                # print("Layer {} is not in the map".format(name))
+            # The plugins may have been loaded again during the update.
+            if plugin_manager is not self.plugin_manager:
                 return
-        m = xp.flip(m, 0)
-        m = xp.flip(m, 1)
-        if use_stream:
-            stream = cp.cuda.Stream(non_blocking=False)
-        else:
-            stream = None
-        self.copy_to_cpu(m, data, stream=stream)
+            for idx in indices:
+                plugin_manager.layers[idx] = layers[idx]
+                # The layer is up to date only if the map did not change during the update.
+                if self.map_version == version:
+                    plugin_manager.dirty[idx] = False
+            # The exported layers change, but the plugins do not need to run again.
+            self.map_version += 1
+            self.layer_cache = {}
+
+    def wait_for_plugins(self):
+        # Wait until the running plugin update is published.
+        future = self.plugin_future
+        if future is not None:
+            future.result()
+
+    def get_export_buffer(self, layer_n):
+        # Export buffers are used in turn. A buffer is reused after the copy of its previous export is finished.
+        buffer = self.export_buffers[self.export_buffer_index]
+        self.export_buffer_index = (self.export_buffer_index + 1) % len(self.export_buffers)
+        buffer.synchronize()
+        buffer.reserve(layer_n, self.cell_n - 2)
+        # The handle of the previous export of the buffer becomes stale.
+        buffer.generation += 1
+        return buffer
+
+    def get_maps_async(self, names):
+        """
+        Start copying the layers to a page-locked host array and return an ExportHandle.
+        Its wait() returns the float32 layers of shape (len(names), cell_n - 2, cell_n - 2).
+        Each layer is flipped and cast into a stacked buffer on the device by one copy,
+        and the buffer is copied to the host at once. Layers which are not in the map are filled with nan.
+        The host array is reused after export_buffer_n exports, so copy it if it is kept longer.
+        A handle which is waited for after that raises a StaleExportError.
+        """
+        with self.export_lock:
+            return self.start_export(names)
+
+    def start_export(self, names):
+        # Write the layers to the next export buffer and start the copy. Call with export_lock.
+        buffer = self.get_export_buffer(len(names))
+        generation = buffer.generation
+        cached = []
+        computed = []
+        with self.map_lock:
+            version = self.map_version
+            layers = buffer.get_layers(len(names))
+            # The requested plugin layers are updated together, so that independent plugins run in parallel.
+            plugin_names = [name for name in names
+                            if name in self.plugin_manager.layer_names and name not in self.layer_cache]
+            if len(plugin_names) > 0 and self.param.enable_background_plugins:
+                self.start_plugin_update(plugin_names)
+            elif len(plugin_names) > 0:
+                self.update_plugin_layers(plugin_names)
+            for i, name in enumerate(names):
+                if name in self.layer_cache:
+                    # Cached layers are replaced but not changed, so they can be copied after the lock is released.
+                    cached.append((i, self.layer_cache[name]))
+                    continue
+                m = self.get_layer_for_publish(name)
+                if m is None:
+                    layers[i] = np.nan
+                    continue
+                m = self.xp.asarray(m) if self.xp is cp else asnumpy(m)
+                layers[i] = m[::-1, ::-1]
+                computed.append(i)
+            if len(cached) < len(names):
+                buffer.copy_to_host(len(names))
+
+        def finish(maps):
+            for i, layer in cached:
+                maps[i] = layer
+            with self.map_lock:
+                # The map may have been changed during the copy. A later export writes the buffer with map_lock,
+                # so the layers are not cached if the buffer was used again.
+                if self.map_version == version and buffer.generation == generation:
+                    for i in computed:
+                        self.layer_cache[names[i]] = maps[i].copy()
+
+        return ExportHandle(buffer, len(names), finish)
+
+    def get_maps(self, names, out):
+        """
+        Copy the layers to the float32 host array out of shape (len(names), cell_n - 2, cell_n - 2).
+        The shape (len(names) * (cell_n - 2), cell_n - 2) is also accepted.
+        """
+        n = self.cell_n - 2
+        assert out.dtype == np.float32, "out should be a float32 array."
+        assert out.size == len(names) * n * n, "out should have {} layers of {}x{} cells.".format(len(names), n, n)
+        # The buffer is not used by other exports until the layers are copied to out.
+        with self.export_lock:
+            out[...] = self.start_export(names).wait().reshape(out.shape)
+
+    def get_map_with_name_ref(self, name, data):
+        self.get_maps([name], data)
 
     def get_normal_maps(self):
-        normal = self.normal_map.copy()
+        normal = self.to_map_layout(self.normal_map)
         normal_x = normal[0, 1:-1, 1:-1]
         normal_y = normal[1, 1:-1, 1:-1]
         normal_z = normal[2, 1:-1, 1:-1]
-        maps = xp.stack([normal_x, normal_y, normal_z], axis=0)
-        maps = xp.flip(maps, 1)
-        maps = xp.flip(maps, 2)
-        maps = xp.asnumpy(maps)
+        maps = self.xp.stack([normal_x, normal_y, normal_z], axis=0)
+        maps = self.xp.flip(maps, 1)
+        maps = self.xp.flip(maps, 2)
+        maps = asnumpy(maps)
         return maps
 
     def get_normal_ref(self, normal_x_data, normal_y_data, normal_z_data):
-        maps = self.get_normal_maps()
-        self.stream = cp.cuda.Stream(non_blocking=True)
-        normal_x_data[...] = xp.asnumpy(maps[0], stream=self.stream)
-        normal_y_data[...] = xp.asnumpy(maps[1], stream=self.stream)
-        normal_z_data[...] = xp.asnumpy(maps[2], stream=self.stream)
+        maps = np.empty((3,) + normal_x_data.shape, dtype=np.float32)
+        self.get_maps(["normal_x", "normal_y", "normal_z"], maps)
+        normal_x_data[...] = maps[0]
+        normal_y_data[...] = maps[1]
+        normal_z_data[...] = maps[2]
 
     def get_polygon_traversability(self, polygon, result):
-        polygon = xp.asarray(polygon)
+        polygon = self.xp.asarray(polygon)
         area = calculate_area(polygon)
         pmin = self.center[:2] - self.map_length / 2 + self.resolution
         pmax = self.center[:2] + self.map_length / 2 - self.resolution
@@ -406,13 +1140,16 @@ class ElevationMap(object):
         polygon[:, 1] = polygon[:, 1].clip(pmin[1], pmax[1])
         polygon_min = polygon.min(axis=0)
         polygon_max = polygon.max(axis=0)
-        polygon_bbox = cp.concatenate([polygon_min, polygon_max]).flatten()
+        polygon_bbox = self.xp.concatenate([polygon_min, polygon_max]).flatten()
         polygon_n = polygon.shape[0]
         clipped_area = calculate_area(polygon)
-        self.polygon_mask_kernel(polygon, self.center[0], self.center[1],
+        polygon = polygon.astype(self.dtype)
+        polygon_bbox = polygon_bbox.astype(self.dtype)
+        center = self.center.astype(self.dtype)
+        self.polygon_mask_kernel(polygon, center[0], center[1],
                                  polygon_n, polygon_bbox, self.mask,
                                  size=(self.cell_n * self.cell_n))
-        masked, masked_isvalid = get_masked_traversability(self.elevation_map,
+        masked, masked_isvalid = get_masked_traversability([self.to_map_layout(layer) for layer in self.map_layers[:4]],
                                                            self.mask)
         if masked_isvalid.sum() > 0:
             t = masked.sum() / masked_isvalid.sum()
@@ -437,26 +1174,79 @@ class ElevationMap(object):
         return untraversable_polygon_num
 
     def get_untraversable_polygon(self, untraversable_polygon):
-        untraversable_polygon[...] = xp.asnumpy(self.untraversable_polygon)
+        untraversable_polygon[...] = asnumpy(self.untraversable_polygon)
+
+    def save_state(self, path):
+        """
+        Save the map to the directory.
+        The map, normal and plugin layers are saved in layers.npy which can be memory-mapped,
+        and the center and drift compensation state in state.npz.
+        """
+        os.makedirs(path, exist_ok=True)
+        with self.map_lock:
+            layers = self.xp.concatenate([self.get_map_layers(),
+                                          self.to_map_layout(self.normal_map),
+                                          self.plugin_manager.layers.astype(self.dtype, copy=False)])
+            np.save(os.path.join(path, "layers.npy"), asnumpy(layers))
+            np.savez(os.path.join(path, "state.npz"),
+                     center=asnumpy(self.center),
+                     mean_error=asnumpy(self.xp.asarray(self.mean_error)).reshape(-1)[0],
+                     additive_mean_error=asnumpy(self.xp.asarray(self.additive_mean_error)).reshape(-1)[0],
+                     resolution=self.resolution,
+                     cell_n=self.cell_n,
+                     plugin_layer_names=np.array(self.plugin_manager.layer_names, dtype=str),
+                     plugin_dirty=np.array(self.plugin_manager.dirty, dtype=bool))
+
+    def load_state(self, path):
+        # Load the map saved by save_state.
+        xp = self.xp
+        state = np.load(os.path.join(path, "state.npz"))
+        assert int(state["cell_n"]) == self.cell_n, "cell_n of the saved map is {}".format(int(state["cell_n"]))
+        assert np.isclose(float(state["resolution"]), self.resolution), \
+            "resolution of the saved map is {}".format(float(state["resolution"]))
+        layers = np.load(os.path.join(path, "layers.npy"), mmap_mode="r")
+        # The running plugin update is published before the saved plugin layers are restored.
+        self.wait_for_plugins()
+        with self.map_lock:
+            self.set_map_offset([0, 0])
+            self.set_map_values((slice(None), slice(None)), xp.asarray(layers[:7]))
+            self.normal_map[...] = xp.asarray(layers[7:10])
+            self.center[...] = xp.asarray(state["center"])
+            self.mean_error = float(state["mean_error"])
+            self.additive_mean_error = float(state["additive_mean_error"])
+            self.add_dirty_region(self.get_full_region())
+            self.notify_map_update()
+            # Plugin layers which were up to date are restored, so they are not computed again until the map changes.
+            for i, name in enumerate(state["plugin_layer_names"]):
+                if name in self.plugin_manager.layer_names and not state["plugin_dirty"][i]:
+                    idx = self.plugin_manager.layer_names.index(name)
+                    self.plugin_manager.layers[idx] = xp.asarray(layers[10 + i])
+                    self.plugin_manager.dirty[idx] = False
 
     def initialize_map(self, points, method='cubic'):
-        self.clear()
+        # clear() resets the ring buffer offset, so the buffer has the map layout here.
+        self.clear(clear_tiles=False)
         with self.map_lock:
-            points = cp.asarray(points)
+            points = self.xp.asarray(points)
             indices = transform_to_map_index(points[:, :2],
                                              self.center[:2],
                                              self.cell_n,
                                              self.resolution)
             points[:, :2] = indices.astype(points.dtype)
             points[:, 2] -= self.center[2]
-            self.map_initializer(self.elevation_map, points, method)
+            self.map_initializer(self.map_layers, points, method)
             if self.param.dilation_size_initialize > 0:
+                # The dilation runs on a dtype copy of is_valid in the compact layout.
+                valid = self.map_layers[2].astype(self.dtype, copy=False)
                 for i in range(2):
-                    self.dilation_filter_kernel_initializer(self.elevation_map[0],
-                                                            self.elevation_map[2],
-                                                            self.elevation_map[0],
-                                                            self.elevation_map[2],
+                    self.dilation_filter_kernel_initializer(self.map_layers[0],
+                                                            valid,
+                                                            self.map_offset_array,
+                                                            self.get_region_array(self.get_full_region()),
+                                                            self.map_layers[0],
+                                                            valid,
                                                             size=(self.cell_n * self.cell_n))
+                self.map_layers[2][...] = valid
             self.update_upper_bound_with_valid_elevation()
 
 
@@ -464,10 +1254,10 @@ if __name__ == '__main__':
     #  Test script for profiling.
     #  $ python -m cProfile -o profile.stats elevation_mapping.py
     #  $ snakeviz profile.stats
-    xp.random.seed(123)
-    points = xp.random.rand(100000, 3)
-    R = xp.random.rand(3, 3)
-    t = xp.random.rand(3)
+    np.random.seed(123)
+    points = np.random.rand(100000, 3)
+    R = np.random.rand(3, 3)
+    t = np.random.rand(3)
     print(R, t)
     param = Parameter(use_chainer=False)
     param.load_weights('../config/weights.dat')
@@ -476,7 +1266,7 @@ if __name__ == '__main__':
     data = np.zeros((elevation.cell_n - 2, elevation.cell_n - 2), dtype=np.float32)
     for i in range(500):
         elevation.input(points, R, t, 0, 0)
-        elevation.update_normal(elevation.elevation_map[0])
+        elevation.update_normal(elevation.map_layers[0])
         for layer in layers:
             elevation.get_map_with_name_ref(layer, data)
         print(i)
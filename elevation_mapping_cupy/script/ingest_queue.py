@@ -0,0 +1,119 @@
+#
+# Copyright (c) 2022, Takahiro Miki. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for details.
+#
+import collections
+import threading
+
+DROP_POLICIES = ["block", "drop_oldest", "downsample_oldest"]
+
+
+class IngestQueue(object):
+    """
+    Bounded queue of point clouds processed by a background thread.
+    All clouds queued while an update is running are merged into the next update.
+    When the queue is full, the policy decides what happens to the new cloud.
+        block: the caller waits until the worker takes the queued clouds.
+        drop_oldest: the oldest queued cloud is dropped.
+        downsample_oldest: every other point of the oldest queued clouds is dropped,
+                           and they are merged with the next queued clouds to make room.
+    """
+    def __init__(self, process, max_size, policy="drop_oldest"):
+        """
+        Args:
+        process: function called with (points_list, R_list, t_list, position_noise, orientation_noise).
+        max_size: number of queued entries. Clouds merged by downsample_oldest count as one entry.
+        """
+        assert policy in DROP_POLICIES, "ingest_drop_policy should be chosen from {}".format(DROP_POLICIES)
+        assert max_size > 0, "ingest_queue_size should be positive."
+        self.process = process
+        self.max_size = max_size
+        self.policy = policy
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        self.busy = False
+        self.closed = False
+        self.error = None
+        self.statistics = dict(queued_clouds=0, processed_clouds=0, updates=0, dropped_clouds=0,
+                               downsampled_clouds=0, max_queue_depth=0)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, points, R, t, position_noise, orientation_noise):
+        # Queue a cloud. The arrays should not be changed by the caller afterwards.
+        with self.condition:
+            self.raise_error()
+            while len(self.queue) >= self.max_size:
+                if self.policy == "block":
+                    self.condition.wait()
+                    self.raise_error()
+                elif self.policy == "downsample_oldest" and len(self.queue) > 1:
+                    oldest = self.queue.popleft()
+                    following = self.queue.popleft()
+                    self.queue.appendleft(([points[::2] for points in oldest[0]] + following[0],
+                                           oldest[1] + following[1],
+                                           oldest[2] + following[2],
+                                           max(oldest[3], following[3]),
+                                           max(oldest[4], following[4])))
+                    self.statistics["downsampled_clouds"] += len(oldest[0])
+                else:
+                    self.statistics["dropped_clouds"] += len(self.queue.popleft()[0])
+            self.queue.append(([points], [R], [t], position_noise, orientation_noise))
+            self.statistics["queued_clouds"] += 1
+            self.statistics["max_queue_depth"] = max(self.statistics["max_queue_depth"], len(self.queue))
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.queue) == 0 and not self.closed:
+                    self.condition.wait()
+                if len(self.queue) == 0:
+                    return
+                entries = list(self.queue)
+                self.queue.clear()
+                self.busy = True
+                self.condition.notify_all()
+            # Merge the queued clouds into one update. The noise of the merged update is the largest one.
+            points_list = [points for entry in entries for points in entry[0]]
+            R_list = [R for entry in entries for R in entry[1]]
+            t_list = [t for entry in entries for t in entry[2]]
+            position_noise = max(entry[3] for entry in entries)
+            orientation_noise = max(entry[4] for entry in entries)
+            try:
+                self.process(points_list, R_list, t_list, position_noise, orientation_noise)
+            except Exception as e:
+                # Raised to the caller on the next put or wait.
+                with self.condition:
+                    self.error = e
+            with self.condition:
+                self.busy = False
+                self.statistics["processed_clouds"] += len(points_list)
+                self.statistics["updates"] += 1
+                self.condition.notify_all()
+
+    def raise_error(self):
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+
+    def get_statistics(self):
+        with self.condition:
+            statistics = dict(self.statistics)
+            statistics["queue_depth"] = len(self.queue)
+        return statistics
+
+    def wait(self):
+        # Wait until all queued clouds are processed.
+        with self.condition:
+            while len(self.queue) > 0 or self.busy:
+                self.condition.wait()
+            self.raise_error()
+
+    def close(self):
+        # Process the queued clouds and stop the thread.
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
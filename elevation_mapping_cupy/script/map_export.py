@@ -0,0 +1,107 @@
+#
+# Copyright (c) 2022, Takahiro Miki. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for details.
+#
+import numpy as np
+
+from backend import cp
+
+
+class StaleExportError(RuntimeError):
+    """The export buffer of an ExportHandle was used again by a later export before the handle was waited for."""
+
+
+class ExportBuffer(object):
+    """
+    Stacked float32 layers on the device and the page-locked host array they are copied to.
+    The copy runs on its own stream, so it does not wait for the kernels launched after the layers are written.
+    With the numpy backend, the layers are written to the host array directly.
+    """
+    def __init__(self, xp, stream=None):
+        self.xp = xp
+        self.stream = stream
+        self.device = None
+        self.host = None
+        self.host_memory = None
+        self.written = None
+        self.copied = None
+        # Incremented each time the buffer is used for an export.
+        self.generation = 0
+
+    def reserve(self, layer_n, n):
+        # The arrays grow to the largest number of requested layers.
+        if self.host is not None and self.host.shape[0] >= layer_n and self.host.shape[1] == n:
+            return
+        shape = (layer_n, n, n)
+        if self.xp is cp:
+            self.device = cp.empty(shape, dtype=np.float32)
+            self.host_memory = cp.cuda.alloc_pinned_memory(self.device.nbytes)
+            self.host = np.frombuffer(self.host_memory, np.float32, self.device.size).reshape(shape)
+            self.written = cp.cuda.Event()
+            self.copied = cp.cuda.Event()
+        else:
+            self.host = np.empty(shape, dtype=np.float32)
+
+    def get_layers(self, layer_n):
+        # Array the layers are written to.
+        if self.xp is cp:
+            return self.device[:layer_n]
+        return self.host[:layer_n]
+
+    def copy_to_host(self, layer_n):
+        # Start the copy of the layers written on the current stream.
+        if self.xp is not cp:
+            return
+        self.written.record()
+        self.stream.wait_event(self.written)
+        layers = self.device[:layer_n]
+        cp.cuda.runtime.memcpyAsync(self.host.ctypes.data, layers.data.ptr, layers.nbytes,
+                                    cp.cuda.runtime.memcpyDeviceToHost, self.stream.ptr)
+        self.copied.record(self.stream)
+
+    def is_copied(self):
+        return self.copied is None or self.copied.done
+
+    def synchronize(self):
+        if self.copied is not None:
+            self.copied.synchronize()
+
+
+class ExportHandle(object):
+    """
+    Layers requested by ElevationMap.get_maps_async. They are copied to the host in the background.
+    The host array belongs to the export buffer and is overwritten when the buffer is used again.
+    """
+    def __init__(self, buffer, layer_n, finish):
+        """
+        Args:
+        finish: function called once with the host array after the copy, before it is returned by wait.
+        """
+        self.buffer = buffer
+        self.generation = buffer.generation
+        self.host = buffer.host[:layer_n]
+        self.finish = finish
+        self.finished = False
+
+    def is_stale(self):
+        # The buffer was used again by a later export, so the host array was overwritten.
+        return self.generation != self.buffer.generation
+
+    def done(self):
+        return self.finished or self.is_stale() or self.buffer.is_copied()
+
+    def check_stale(self):
+        if self.is_stale():
+            raise StaleExportError("The export buffer was reused. Wait for the handle before export_buffer_n more "
+                                   "exports.")
+
+    def wait(self):
+        # Wait for the copy and return the layers of shape (layer_n, cell_n - 2, cell_n - 2).
+        self.check_stale()
+        if not self.finished:
+            self.buffer.synchronize()
+            self.finish(self.host)
+            self.finished = True
+        # The buffer may have been used again during the wait.
+        self.check_stale()
+        return self.host
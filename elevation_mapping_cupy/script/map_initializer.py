@@ -2,9 +2,8 @@
 # Copyright (c) 2022, Takahiro Miki. All rights reserved.
 # Licensed under the MIT license. See LICENSE file in the project root for details.
 #
-from scipy.interpolate import griddata
 import numpy as np
-import cupy as cp
+from backend import cp
 
 
 class MapInitializer(object):
@@ -26,14 +25,14 @@ class MapInitializer(object):
         """
         Initialize the map using interpolation between given poitns
         Args:
-        elevation_map: elevation_map data.
+        elevation_map: layers of the map. (ElevationMap.map_layers)
         points: points used to interpolate.
         method: method for interpolation. (nearest, linear, cubic)
         """
 
         # points from existing map.
         points_idx = self.xp.where(elevation_map[2] > 0.5)
-        values = elevation_map[0, points_idx[0], points_idx[1]]
+        values = elevation_map[0][points_idx[0], points_idx[1]]
 
         # Add external points for interpolation.
         points_idx = self.xp.stack(points_idx).T
@@ -43,24 +42,24 @@ class MapInitializer(object):
         assert points_idx.shape[0] > 3, "Initialization points must be more than 3."
 
         # Interpolation using griddata function.
-        w = elevation_map.shape[1]
-        h = elevation_map.shape[2]
+        from scipy.interpolate import griddata
+        w, h = elevation_map[0].shape
         grid_x, grid_y = np.mgrid[0:w, 0:h]
-        if self.xp == cp:
+        if self.xp is cp:
             points_idx = cp.asnumpy(points_idx)
             values = cp.asnumpy(values)
         interpolated = griddata(points_idx, values, (grid_x, grid_y), method=method)
-        if self.xp == cp:
+        if self.xp is cp:
             interpolated = cp.asarray(interpolated)
         
         # Update elevation map.
-        elevation_map[0] = self.xp.nan_to_num(interpolated)
-        elevation_map[1] = self.xp.where(self.xp.invert(self.xp.isnan(interpolated)),
-                                         self.new_variance,
-                                         self.initial_variance)
-        elevation_map[2] = self.xp.where(self.xp.invert(self.xp.isnan(interpolated)),
-                                         1.0,
-                                         0.0)
+        elevation_map[0][...] = self.xp.nan_to_num(interpolated)
+        elevation_map[1][...] = self.xp.where(self.xp.invert(self.xp.isnan(interpolated)),
+                                              self.new_variance,
+                                              self.initial_variance)
+        elevation_map[2][...] = self.xp.where(self.xp.invert(self.xp.isnan(interpolated)),
+                                              1.0,
+                                              0.0)
         return
 
 
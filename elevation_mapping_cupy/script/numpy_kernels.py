@@ -0,0 +1,464 @@
+#
+# Copyright (c) 2022, Takahiro Miki. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for details.
+#
+# Vectorized numpy versions of the kernels in custom_kernels.py.
+# Each factory has the same arguments as its cuda counterpart and returns a callable
+# that takes the same arguments as the compiled cupy.ElementwiseKernel (size is ignored).
+#
+from collections import namedtuple
+import numpy as np
+
+from parameter import KERNEL_PARAMS, MAP_LAYER_INDEX, COMPACT_MAP_LAYER_INDEX
+
+# point_idx of the points which are not valid in the fused kernels.
+INVALID_POINT = -2
+
+# Runtime parameters of the params kernel argument by name.
+KernelParams = namedtuple("KernelParams", KERNEL_PARAMS)
+
+
+def _scalar(x):
+    return float(np.asarray(x).reshape(-1)[0])
+
+
+def _params(params):
+    return KernelParams(*np.asarray(params, dtype=float).reshape(-1).tolist())
+
+
+def _round(x):
+    # Same rounding as the cuda kernels. (round half away from zero)
+    return np.trunc(x) + np.trunc(2 * (x - np.trunc(x)))
+
+
+def _region_cells(region, offset, width, height, margin=0):
+    # Map indices of the region [x0, y0, rows, cols] expanded by margin, and their ring buffer indices.
+    x0, y0, rows, cols = (int(v) for v in np.asarray(region).reshape(-1)[:4])
+    xs = np.arange(x0 - margin, x0 + rows + margin)
+    ys = np.arange(y0 - margin, y0 + cols + margin)
+    bx = ((xs + int(offset[0])) % width).reshape(-1, 1)
+    by = ((ys + int(offset[1])) % height).reshape(1, -1)
+    return xs, ys, bx, by
+
+
+def _inside_region(xs, ys, width, height):
+    return ((xs > 0) & (xs < width - 1)).reshape(-1, 1) & ((ys > 0) & (ys < height - 1)).reshape(1, -1)
+
+
+class MapUtils(object):
+    """
+    numpy version of map_utils in custom_kernels.py.
+    """
+    def __init__(self, resolution, width, height):
+        self.resolution = resolution
+        self.width = width
+        self.height = height
+
+    def get_idx(self, x, y, center_x, center_y):
+        idx_x = np.clip(_round((x - center_x) / self.resolution) + self.width // 2, 0, self.width - 1)
+        idx_y = np.clip(_round((y - center_y) / self.resolution) + self.height // 2, 0, self.height - 1)
+        # Points with NaN get an arbitrary index. They are rejected by is_valid.
+        with np.errstate(invalid="ignore"):
+            return idx_x.astype(np.int64), idx_y.astype(np.int64)
+
+    def is_inside(self, idx_x, idx_y):
+        return (idx_x > 0) & (idx_x < self.width - 1) & (idx_y > 0) & (idx_y < self.height - 1)
+
+    def get_buffer_idx(self, idx_x, idx_y, offset):
+        # Convert the index in the map to the index in the ring buffer.
+        return (idx_x + offset[0]) % self.width, (idx_y + offset[1]) % self.height
+
+    def transform_points(self, p, R, t):
+        points = p.reshape(-1, 3)
+        R = R.reshape(3, 3)
+        transformed = points @ R.T + t.reshape(1, 3)
+        return transformed[:, 0], transformed[:, 1], transformed[:, 2], points[:, 2]
+
+    def z_noise(self, z, params):
+        return params.sensor_noise_factor * z * z
+
+    def is_valid(self, x, y, z, sx, sy, sz, params):
+        d = (x - sx) ** 2 + (y - sy) ** 2 + (z - sz) ** 2
+        dxy = np.maximum(np.sqrt(x * x + y * y) - params.ramped_height_range_b, 0.0)
+        valid = d >= params.min_valid_distance ** 2
+        valid &= z - sz <= dxy * params.ramped_height_range_a + params.ramped_height_range_c
+        valid &= z - sz <= params.max_height_range
+        return valid
+
+
+def add_points_kernel(resolution, width, height,
+                      enable_edge_shaped=True, enable_visibility_cleanup=True, ray_skip_block_size=0, fused=False,
+                      compact=False):
+
+    utils = MapUtils(resolution, width, height)
+    layer_index = COMPACT_MAP_LAYER_INDEX if compact else MAP_LAYER_INDEX
+    time_layer = layer_index[4]
+    upper_bound_layer = layer_index[5]
+    # Number of ray cells processed at once in the visibility cleanup.
+    ray_chunk_size = 2 ** 22
+
+    def traverse_rays(u, du, ray_length, crossing_n):
+        """
+        Cells crossed by the rays starting from u in grid units, where the cell i covers [i, i + 1).
+        Same cells as the traversal of Amanatides and Woo in the cuda kernel.
+        crossing_n is the maximum number of cell borders crossed by a ray along each axis.
+        Returns the cells (ray n, 2 * crossing_n + 1, 2), the ray parameters at the middle of the cells,
+        and whether the ray is in the cell.
+        """
+        step = np.sign(du)
+        first_border = np.floor(u) + (step > 0)
+        k = np.arange(crossing_n)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            crossing = (first_border[:, :, None] + step[:, :, None] * k - u[:, :, None]) / du[:, :, None]
+        crossing[np.broadcast_to(step[:, :, None] == 0, crossing.shape)] = np.inf
+        crossing = np.sort(crossing.reshape(len(u), -1), axis=1)
+        s = np.concatenate([np.zeros((len(u), 1)), np.minimum(crossing, ray_length[:, None])], axis=1)
+        s_enter = s
+        s_exit = np.concatenate([s[:, 1:], ray_length[:, None]], axis=1)
+        s_mid = (s_enter + s_exit) / 2
+        cells = np.floor(u[:, None, :] + du[:, None, :] * s_mid[:, :, None]).astype(np.int64)
+        return cells, s_mid, s_exit > s_enter
+
+    def visibility_cleanup(x, y, z, t, center_x, center_y, norm_map, offset, skip_map, skip_region, params,
+                           elevation_map, valid_map, is_upper_bound_map, newmap):
+        ray = np.stack([x - t[0], y - t[1], z - t[2]], axis=1)
+        norm = np.linalg.norm(ray, axis=1)
+        ray = np.divide(ray, norm[:, None], out=np.zeros_like(ray), where=norm[:, None] > 0)
+        ray_length = np.minimum(norm, params.max_ray_length)
+        u0 = np.array([(t[0] - center_x) / resolution + width // 2 + 0.5,
+                       (t[1] - center_y) / resolution + height // 2 + 0.5])
+        if len(x) == 0:
+            return
+        crossing_n = int(np.ceil(ray_length.max() / resolution)) + 1
+        chunk = max(ray_chunk_size // (2 * crossing_n + 1), 1)
+        layer_size = width * height
+        flat_map = elevation_map.reshape(-1)
+        flat_valid = valid_map.reshape(-1)
+        flat_is_upper = is_upper_bound_map.reshape(-1)
+        flat_norm = norm_map.reshape(-1)
+        flat_newmap = newmap.reshape(-1)
+        # The compact layout lowers the confidence through newmap layer 5 as the cuda kernel.
+        flat_cleanup, cleanup_offset = (flat_newmap, 5 * layer_size) if compact else (flat_valid, 0)
+        skip_region = np.asarray(skip_region).reshape(-1)
+        for start in range(0, len(x), chunk):
+            sl = slice(start, start + chunk)
+            u = np.broadcast_to(u0, (ray[sl].shape[0], 2))
+            cells, s_mid, active = traverse_rays(u, ray[sl, :2] / resolution, ray_length[sl], crossing_n)
+            idx_x = cells[:, :, 0]
+            idx_y = cells[:, :, 1]
+            active &= utils.is_inside(idx_x, idx_y)
+            point_id = np.broadcast_to(np.arange(start, start + idx_x.shape[0])[:, None], idx_x.shape)[active]
+            idx_x = idx_x[active]
+            idx_y = idx_y[active]
+            s_mid = s_mid[active]
+            # Check the ray at the middle of the cell.
+            nx = t[0] + ray[point_id, 0] * s_mid
+            ny = t[1] + ray[point_id, 1] * s_mid
+            nz = t[2] + ray[point_id, 2] * s_mid
+            # If point is close or is farther away than ray length, skip.
+            active = (x[point_id] - nx) ** 2 + (y[point_id] - ny) ** 2 + (z[point_id] - nz) ** 2 >= 0.1
+            if ray_skip_block_size > 0:
+                # Skip the cells if the ray is higher than any cell it can change in the block.
+                bx = np.floor_divide(idx_x - skip_region[0], ray_skip_block_size)
+                by = np.floor_divide(idx_y - skip_region[1], ray_skip_block_size)
+                in_grid = (bx >= 0) & (by >= 0) & (bx < skip_region[2]) & (by < skip_region[3])
+                skip = np.zeros_like(active)
+                skip[in_grid] = nz[in_grid] >= skip_map.reshape(skip_region[2], skip_region[3])[bx[in_grid], by[in_grid]]
+                active &= ~skip
+            idx_x, idx_y = utils.get_buffer_idx(idx_x[active], idx_y[active], offset)
+            nidx = idx_x * height + idx_y
+            point_id = point_id[active]
+            nz = nz[active]
+            nmap_h = flat_map[nidx]
+            nmap_v = flat_map[layer_size + nidx]
+            nmap_valid = flat_valid[nidx]
+            non_updated_t = flat_map[time_layer * layer_size + nidx]
+
+            # If invalid, only do upper bound check.
+            upper_update = nmap_valid < 0.5
+            # If updated recently, skip.
+            penetrated = ~upper_update & (non_updated_t >= 0.5)
+            penetrated &= nmap_h > nz + 0.01 - np.minimum(nmap_v, 1.0) * 0.05
+            # If ray and norm is vertical, skip.
+            product = (ray[point_id, 0] * flat_norm[nidx]
+                       + ray[point_id, 1] * flat_norm[layer_size + nidx]
+                       + ray[point_id, 2] * flat_norm[2 * layer_size + nidx])
+            penetrated &= np.abs(product) >= params.cleanup_cos_thresh
+            num_points = flat_newmap[3 * layer_size + nidx]
+            penetrated &= ~((num_points > params.wall_num_thresh) & (non_updated_t < 1.0))
+
+            # Finally, these cells are penetrated by the ray.
+            np.add.at(flat_cleanup, cleanup_offset + nidx[penetrated],
+                      -params.cleanup_step / (ray_length[point_id[penetrated]] / params.max_ray_length))
+            np.add.at(flat_map, layer_size + nidx[penetrated], params.outlier_variance)
+
+            # Upper bound check. The lowest ray point is kept if several rays pass the same cell.
+            upper_update |= penetrated
+            upper_idx = nidx[upper_update]
+            upper_z = nz[upper_update]
+            not_upper = upper_idx[flat_is_upper[upper_idx] < 0.5]
+            flat_map[upper_bound_layer * layer_size + not_upper] = np.inf
+            flat_is_upper[upper_idx] = 1
+            np.minimum.at(flat_map, upper_bound_layer * layer_size + upper_idx, upper_z)
+
+    def add_points(x, y, z, v, valid, update, idx_x, idx_y, t, center_x, center_y, norm_map, offset,
+                   skip_map, skip_region, params, elevation_map, valid_map, is_upper_bound_map, newmap):
+        # idx_x and idx_y are the cells in the ring buffer of the points to update.
+        pz = z[update]
+        pv = v[update]
+        map_h = elevation_map[0, idx_x, idx_y]
+        map_v = elevation_map[1, idx_x, idx_y]
+        num_points = newmap[4, idx_x, idx_y]
+
+        outlier = np.abs(map_h - pz) > map_v * params.mahalanobis_thresh
+        np.add.at(elevation_map[1], (idx_x[outlier], idx_y[outlier]), params.outlier_variance)
+        inlier = ~outlier
+        if enable_edge_shaped:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                inlier &= ~((num_points > params.wall_num_thresh)
+                            & (pz < map_h - map_v * params.mahalanobis_thresh / num_points))
+        idx = (idx_x[inlier], idx_y[inlier])
+        map_h = map_h[inlier]
+        map_v = map_v[inlier]
+        pz = pz[inlier]
+        pv = pv[inlier]
+        new_h = (map_h * pv + pz * map_v) / (map_v + pv)
+        new_v = (map_v * pv) / (map_v + pv)
+        np.add.at(newmap[0], idx, new_h)
+        np.add.at(newmap[1], idx, new_v)
+        np.add.at(newmap[2], idx, 1.0)
+        # is Valid
+        valid_map[idx] = 1
+        # Time layer
+        elevation_map[time_layer][idx] = 0.0
+        # Upper bound
+        elevation_map[upper_bound_layer][idx] = new_h
+        is_upper_bound_map[idx] = 0
+
+        if enable_visibility_cleanup:
+            visibility_cleanup(x[valid], y[valid], z[valid], t, center_x, center_y, norm_map, offset,
+                               skip_map, skip_region, params, elevation_map, valid_map, is_upper_bound_map, newmap)
+
+    def kernel(p, center_x, center_y, R, t, norm_map, offset, skip_map, skip_region, params,
+               elevation_map, valid_map, is_upper_bound_map, newmap, size=None):
+        params = _params(params)
+        center_x = _scalar(center_x)
+        center_y = _scalar(center_y)
+        t = t.reshape(-1)
+        x, y, z, rz = utils.transform_points(p, R, t)
+        v = utils.z_noise(rz, params)
+        valid = utils.is_valid(x, y, z, t[0], t[1], t[2], params)
+        idx_x, idx_y = utils.get_idx(x, y, center_x, center_y)
+        update = valid & utils.is_inside(idx_x, idx_y)
+        idx_x, idx_y = utils.get_buffer_idx(idx_x[update], idx_y[update], offset)
+        add_points(x, y, z, v, valid, update, idx_x, idx_y, t, center_x, center_y, norm_map, offset,
+                   skip_map, skip_region, params, elevation_map, valid_map, is_upper_bound_map, newmap)
+
+    def fused_kernel(p, point_idx, center_x, center_y, t, norm_map, offset, skip_map, skip_region, params,
+                     elevation_map, valid_map, is_upper_bound_map, newmap, size=None):
+        # Use the transformed points and their cells stored by the fused error counting kernel.
+        p = p.reshape(-1, 4)
+        valid = point_idx != INVALID_POINT
+        update = point_idx >= 0
+        add_points(p[:, 0], p[:, 1], p[:, 2], p[:, 3], valid, update,
+                   point_idx[update] // height, point_idx[update] % height, t.reshape(-1),
+                   _scalar(center_x), _scalar(center_y), norm_map, offset, skip_map, skip_region, _params(params),
+                   elevation_map, valid_map, is_upper_bound_map, newmap)
+
+    return fused_kernel if fused else kernel
+
+
+def error_counting_kernel(resolution, width, height, fused=False, compact=False):
+
+    utils = MapUtils(resolution, width, height)
+    traversability_layer = (COMPACT_MAP_LAYER_INDEX if compact else MAP_LAYER_INDEX)[3]
+
+    def kernel(elevation_map, valid_map, p, center_x, center_y, R, t, offset, params, newmap, error, error_cnt,
+               points=None, point_idx=None, size=None):
+        params = _params(params)
+        t = t.reshape(-1)
+        x, y, z, rz = utils.transform_points(p, R, t)
+        valid = utils.is_valid(x, y, z, t[0], t[1], t[2], params)
+        idx_x, idx_y = utils.get_idx(x, y, _scalar(center_x), _scalar(center_y))
+        inside = utils.is_inside(idx_x, idx_y)
+        idx_x, idx_y = utils.get_buffer_idx(idx_x, idx_y, offset)
+        if fused:
+            points.reshape(-1, 4)[:] = np.stack([x, y, z, utils.z_noise(rz, params)], axis=1)
+            point_idx[:] = np.where(valid, np.where(inside, idx_x * height + idx_y, -1), INVALID_POINT)
+        valid &= inside
+        idx_x = idx_x[valid]
+        idx_y = idx_y[valid]
+        z = z[valid]
+        map_h = elevation_map[0, idx_x, idx_y]
+        map_v = elevation_map[1, idx_x, idx_y]
+        map_valid = valid_map[idx_x, idx_y]
+        map_t = elevation_map[traversability_layer, idx_x, idx_y]
+        inlier = ((map_valid > 0.5) & (np.abs(map_h - z) < map_v * params.mahalanobis_thresh)
+                  & (map_v < params.drift_compensation_variance_inlier / 2.0)
+                  & (map_t > params.traversability_inlier))
+        error[0] += (z - map_h)[inlier].sum()
+        error_cnt[0] += inlier.sum()
+        np.add.at(newmap[3], (idx_x[inlier], idx_y[inlier]), 1.0)
+        np.add.at(newmap[4], (idx_x, idx_y), 1.0)
+
+    return kernel
+
+
+def average_map_kernel(width, height, compact=False):
+
+    def kernel(newmap, offset, region, params, elevation_map, valid_map, size=None):
+        params = _params(params)
+        _, _, bx, by = _region_cells(region, offset, width, height)
+        m = elevation_map[:2, bx, by]
+        valid = valid_map[bx, by].astype(m.dtype)
+        new_h = newmap[0, bx, by]
+        new_v = newmap[1, bx, by]
+        new_cnt = newmap[2, bx, by]
+        updated = new_cnt > 0
+        if compact:
+            # The cleanup of the compact layout. Cells with new points are valid again as in add_points.
+            valid = np.where(updated, valid, valid + newmap[5, bx, by])
+        m_valid = valid.copy()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean_h = new_h / new_cnt
+            mean_v = new_v / new_cnt
+        rejected = updated & (mean_v > params.max_variance)
+        accepted = updated & ~rejected
+        m[0] = np.where(accepted, mean_h, m[0])
+        m[1] = np.where(accepted, mean_v, m[1])
+        m_valid = np.where(accepted, 1.0, m_valid)
+        reset = rejected | (valid < 0.5)
+        m[0][reset] = 0.0
+        m[1][reset] = params.initial_variance
+        m_valid[reset] = 0.0
+        elevation_map[:2, bx, by] = m
+        valid_map[bx, by] = m_valid
+
+    return kernel
+
+
+def dilation_filter_kernel(width, height, dilation_size):
+    dilation_size = int(dilation_size)
+
+    def kernel(elevation, mask, offset, region, newmap, newmask, size=None):
+        # Filter the region with its margin gathered from the ring buffer.
+        d = dilation_size
+        xs, ys, bx, by = _region_cells(region, offset, width, height, d)
+        elevation = elevation.reshape(width, height)[bx, by]
+        valid = mask.reshape(width, height)[bx, by] > 0.5
+        padded_valid = valid & _inside_region(xs, ys, width, height)
+        rows = len(xs) - 2 * d
+        cols = len(ys) - 2 * d
+        distance = np.full((rows, cols), 100.0)
+        near_value = np.zeros((rows, cols), dtype=elevation.dtype)
+        for dy in range(-d, d + 1):
+            for dx in range(-d, d + 1):
+                sx = slice(d + dy, d + dy + rows)
+                sy = slice(d + dx, d + dx + cols)
+                closer = padded_valid[sx, sy] & (dx + dy < distance)
+                distance[closer] = dx + dy
+                near_value[closer] = elevation[sx, sy][closer]
+        fill = ~valid[d:d + rows, d:d + cols] & (distance < 100)
+        bx = bx[d:d + rows]
+        by = by[:, d:d + cols]
+        newmap = newmap.reshape(width, height)
+        newmask = newmask.reshape(width, height)
+        newmap[bx, by] = np.where(fill, near_value, elevation[d:d + rows, d:d + cols])
+        newmask[bx, by] = np.where(fill, 1.0, newmask[bx, by])
+
+    return kernel
+
+
+def normal_filter_kernel(width, height, resolution):
+
+    def kernel(elevation, mask, offset, region, newmap, size=None):
+        # Compute the region with a margin of one cell gathered from the ring buffer.
+        xs, ys, bx, by = _region_cells(region, offset, width, height, 1)
+        inside = _inside_region(xs, ys, width, height)
+        elevation = elevation.reshape(width, height)[bx, by]
+        valid = mask.reshape(width, height)[bx[1:-1], by[:, 1:-1]] > 0.5
+        target = valid & inside[2:, 1:-1] & inside[1:-1, 2:]
+        dzdx = elevation[1:-1, 2:] - elevation[1:-1, 1:-1]
+        dzdy = elevation[2:, 1:-1] - elevation[1:-1, 1:-1]
+        nx = -dzdy / resolution
+        ny = -dzdx / resolution
+        norm = np.sqrt(nx * nx + ny * ny + 1)
+        normal = np.stack([nx / norm, ny / norm, 1.0 / norm])
+        bx = bx[1:-1]
+        by = by[:, 1:-1]
+        newmap[:, bx, by] = np.where(target, normal, newmap[:, bx, by])
+
+    return kernel
+
+
+def traversability_filter_kernel():
+
+    def kernel(input, weights, shape, out, size=None):
+        # Accumulate each convolution into the output, without the intermediate 12 channels.
+        rows, cols = (int(v) for v in np.asarray(shape).reshape(-1)[:2])
+        input = input.reshape(rows, cols)
+        result = np.zeros((rows - 6, cols - 6), dtype=np.float32)
+        for d in range(1, 4):
+            for c in range(4):
+                w = weights[((d - 1) * 4 + c) * 9:((d - 1) * 4 + c + 1) * 9].reshape(3, 3)
+                conv = np.zeros_like(result)
+                for dx in range(-1, 2):
+                    for dy in range(-1, 2):
+                        conv += w[dx + 1, dy + 1] * input[3 + dx * d:rows - 3 + dx * d, 3 + dy * d:cols - 3 + dy * d]
+                result += weights[108 + (d - 1) * 4 + c] * np.abs(conv)
+        out.reshape(rows - 6, cols - 6)[...] = np.exp(-result)
+
+    return kernel
+
+
+def polygon_mask_kernel(width, height, resolution):
+    utils = MapUtils(resolution, width, height)
+
+    def orientation(p, q, r):
+        val = (q[1] - p[1]) * (r[0] - q[0]) - (q[0] - p[0]) * (r[1] - q[1])
+        return np.where(val == 0, 0, np.where(val > 0, 1, 2))
+
+    def on_segment(p, q, r):
+        return ((q[0] <= np.maximum(p[0], r[0])) & (q[0] >= np.minimum(p[0], r[0]))
+                & (q[1] <= np.maximum(p[1], r[1])) & (q[1] >= np.minimum(p[1], r[1])))
+
+    def do_intersect(p1, q1, p2, q2):
+        o1 = orientation(p1, q1, p2)
+        o2 = orientation(p1, q1, q2)
+        o3 = orientation(p2, q2, p1)
+        o4 = orientation(p2, q2, q1)
+        return (((o1 != o2) & (o3 != o4))
+                | ((o1 == 0) & on_segment(p1, p2, q1))
+                | ((o2 == 0) & on_segment(p1, q2, q1))
+                | ((o3 == 0) & on_segment(p2, p1, q2))
+                | ((o4 == 0) & on_segment(p2, q1, q2)))
+
+    def kernel(polygon, center_x, center_y, polygon_n, polygon_bbox, mask, size=None):
+        center_x = _scalar(center_x)
+        center_y = _scalar(center_y)
+        polygon = np.asarray(polygon).reshape(-1, 2)
+        polygon_n = int(_scalar(polygon_n))
+        polygon_bbox = np.asarray(polygon_bbox).reshape(-1)
+        vertices = np.stack(utils.get_idx(polygon[:, 0], polygon[:, 1], center_x, center_y), axis=1)
+        bmin = utils.get_idx(polygon_bbox[0], polygon_bbox[1], center_x, center_y)
+        bmax = utils.get_idx(polygon_bbox[2], polygon_bbox[3], center_x, center_y)
+
+        px, py = np.meshgrid(np.arange(width), np.arange(height), indexing="ij")
+        in_bbox = (px >= bmin[0]) & (px <= bmax[0]) & (py >= bmin[1]) & (py <= bmax[1])
+        p = (px[in_bbox], py[in_bbox])
+        extreme = (np.full_like(p[0], 100000), p[1])
+        on_edge = np.zeros(p[0].shape, dtype=bool)
+        intersect_cnt = np.zeros(p[0].shape, dtype=np.int64)
+        for j in range(polygon_n):
+            p1 = vertices[j]
+            p2 = vertices[(j + 1) % polygon_n]
+            intersect = do_intersect(p1, p2, p, extreme)
+            colinear = orientation(p1, p, p2) == 0
+            on_edge |= intersect & colinear & on_segment(p1, p, p2)
+            crossing = ((p1[1] <= p[1]) & (p2[1] > p[1])) | ((p1[1] > p[1]) & (p2[1] <= p[1]))
+            intersect_cnt += intersect & ~colinear & crossing
+        result = np.zeros((width, height))
+        result[in_bbox] = (on_edge | (intersect_cnt % 2 == 1)).astype(float)
+        mask.reshape(width, height)[...] = result
+
+    return kernel
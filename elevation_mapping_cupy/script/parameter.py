@@ -2,10 +2,46 @@
 # Copyright (c) 2022, Takahiro Miki. All rights reserved.
 # Licensed under the MIT license. See LICENSE file in the project root for details.
 #
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+import functools
 import pickle
 import numpy as np
 import os
+import re
+import subprocess
+
+# Parameters passed to the kernels at runtime, in the order of the kernel params array.
+# Changing them does not compile the kernels again.
+KERNEL_PARAMS = ["sensor_noise_factor", "mahalanobis_thresh", "outlier_variance", "drift_compensation_variance_inlier",
+                 "traversability_inlier", "wall_num_thresh", "max_ray_length", "cleanup_step", "cleanup_cos_thresh",
+                 "min_valid_distance", "max_height_range", "ramped_height_range_a", "ramped_height_range_b",
+                 "ramped_height_range_c", "max_variance", "initial_variance"]
+
+# Index of each map layer in the float map. In the compact layout, is_valid and is_upper_bound are kept in
+# their own narrow planes and are not in the float map. (See ElevationMap.create_map)
+MAP_LAYER_INDEX = [0, 1, 2, 3, 4, 5, 6]
+COMPACT_MAP_LAYER_INDEX = [0, 1, None, 2, 3, 4, None]
+
+
+@functools.lru_cache(maxsize=None)
+def find_ros_package(name):
+    try:
+        import rospkg
+    except ImportError:
+        return subprocess.check_output(["rospack", "find", name], text=True).strip()
+    return rospkg.RosPack().get_path(name)
+
+
+def expand_path(path):
+    """
+    Expand $(rospack find <package>), environment variables and ~ in a path parameter without a shell.
+    Other command substitutions are still expanded by the shell.
+    """
+    path = re.sub(r"\$\(rospack find ([^)\s]+)\)", lambda m: find_ros_package(m.group(1)), path)
+    if "$(" in path or "`" in path:
+        return subprocess.getoutput("echo \"" + path + "\"")
+    return os.path.expanduser(os.path.expandvars(path))
+
 
 @dataclass
 class Parameter:
@@ -29,6 +65,7 @@ class Parameter:
     min_height_drift_cnt:float = 100
 
     max_ray_length:float = 2.0
+    ray_skip_block_size:int = 8
     cleanup_step:float = 0.01
     cleanup_cos_thresh:float = 0.5
     min_valid_distance:float = 0.3
@@ -49,24 +86,42 @@ class Parameter:
     overlap_clear_range_xy:float = 4.0
     overlap_clear_range_z:float = 2.0
 
+    ingest_queue_size:int = 6
+    ingest_drop_policy:str = "drop_oldest"
+    export_buffer_n:int = 2
+
+    tile_size:int = 32
+    tile_store_path:str = ""
+
     enable_edge_sharpen:bool = True
     enable_drift_compensation:bool = True
     enable_visibility_cleanup:bool = True
     enable_overlap_clearance:bool = True
+    enable_dirty_region_update:bool = True
+    enable_fused_ingest:bool = False
+    enable_sync_free_ingest:bool = False
+    enable_async_ingest:bool = False
+    enable_tile_store:bool = False
+    enable_background_plugins:bool = False
     use_only_above_for_upper_bound: bool = True
+    use_native_traversability_filter:bool = True
     use_chainer:bool = True
+    backend:str = "cupy"
+    dtype:str = "float64"
+    enable_compact_layers:bool = False
     position_noise_thresh:float = 0.1
     orientation_noise_thresh:float = 0.1
 
     plugin_config_file: str = "config/plugin_config.yaml"
+    plugin_thread_n:int = 1
     weight_file: str = "config/weights.dat"
 
     initial_variance:float = 10.0
     initialized_variance:float = 10.0
-    w1:np.ndarray = np.zeros((4, 1, 3, 3))
-    w2:np.ndarray = np.zeros((4, 1, 3, 3))
-    w3:np.ndarray = np.zeros((4, 1, 3, 3))
-    w_out:np.ndarray = np.zeros((1, 12, 1, 1))
+    w1:np.ndarray = field(default_factory=lambda: np.zeros((4, 1, 3, 3)))
+    w2:np.ndarray = field(default_factory=lambda: np.zeros((4, 1, 3, 3)))
+    w3:np.ndarray = field(default_factory=lambda: np.zeros((4, 1, 3, 3)))
+    w_out:np.ndarray = field(default_factory=lambda: np.zeros((1, 12, 1, 1)))
 
     def load_weights(self, filename):
         with open(filename,'rb') as file:
@@ -88,6 +143,9 @@ class Parameter:
     def get_value(self, name):
         return getattr(self, name)
 
+    def get_kernel_params(self):
+        return [float(getattr(self, name)) for name in KERNEL_PARAMS]
+
 
 if __name__ == "__main__":
     param = Parameter()
@@ -98,3 +156,4 @@ if __name__ == "__main__":
 
     print('names ', param.get_names())
     print('types ', param.get_types())
+    print('kernel params ', dict(zip(KERNEL_PARAMS, param.get_kernel_params())))
@@ -2,18 +2,16 @@
 # Copyright (c) 2022, Takahiro Miki. All rights reserved.
 # Licensed under the MIT license. See LICENSE file in the project root for details.
 #
-import cupy as cp
 from typing import List
-import cupyx.scipy.ndimage as ndimage
 import numpy as np
-import cv2 as cv
 
 
+from backend import ndarray, asnumpy
 from .plugin_manager import PluginBase
 
 
 class Inpainting(PluginBase):
-    """  This is a filter to smoothen
+    """  This fills the invalid cells of the elevation.
 
     ...
 
@@ -21,26 +19,227 @@ class Inpainting(PluginBase):
     ----------
     cell_n: int
         width and height of the elevation map.
+    method: str
+        laplace: solves the Laplace equation in the invalid regions with multigrid on the array backend.
+        telea or ns: uses opencv on the host with 8 bit heights.
+    block_size: int
+        The invalid regions are found in blocks of this size, and the Laplace equation is only solved
+        in their bounding boxes. (laplace)
+    iteration_n: int
+        The number of smoothing iterations before and after the correction on each level of the multigrid. (laplace)
+    cycle_n: int
+        The number of conjugate gradient iterations, each with one multigrid cycle. (laplace)
     """
-    def __init__(self, cell_n:int=100, method:str="telea", **kwargs):
+    def __init__(self, cell_n:int=100, method:str="telea", block_size:int=16, iteration_n:int=1, cycle_n:int=8,
+                 xp=np, **kwargs):
         super().__init__()
-        if method == "telea":
-            self.method = cv.INPAINT_TELEA
-        elif method == "ns":  # Navier-Stokes
-            self.method = cv.INPAINT_NS
-        else:  # default method
-            self.method = cv.INPAINT_TELEA
-
-    def __call__(self, elevation_map: cp.ndarray, layer_names: List[str],
-            plugin_layers: cp.ndarray, plugin_layer_names: List[str])->cp.ndarray:
-        mask = cp.asnumpy((elevation_map[2] < 0.5).astype('uint8'))
+        assert method in ["laplace", "telea", "ns"], "method should be laplace, telea or ns."
+        self.xp = xp
+        # opencv is imported when the plugin is first used.
+        self.method = method
+        self.block_size = block_size
+        self.iteration_n = iteration_n
+        self.cycle_n = cycle_n
+
+    def __call__(self, elevation_map: ndarray, layer_names: List[str],
+            plugin_layers: ndarray, plugin_layer_names: List[str], out: ndarray = None)->ndarray:
+        if out is None:
+            out = self.xp.empty_like(elevation_map[0])
+        if self.method == "laplace":
+            return self.inpaint_laplace(elevation_map[0], elevation_map[2] > 0.5, out)
+        return self.inpaint_opencv(elevation_map, out)
+
+    def inpaint_opencv(self, elevation_map: ndarray, out: ndarray)->ndarray:
+        import cv2 as cv
+        if self.method == "ns":  # Navier-Stokes
+            method = cv.INPAINT_NS
+        else:  # telea
+            method = cv.INPAINT_TELEA
+        mask = asnumpy((elevation_map[2] < 0.5).astype('uint8'))
         if (mask < 1).any():
             h = elevation_map[0]
             h_max = float(h[mask < 1].max())
             h_min = float(h[mask < 1].min())
-            h = cp.asnumpy((elevation_map[0] - h_min) * 255 / (h_max - h_min)).astype('uint8')
-            dst = np.array(cv.inpaint(h, mask, 1, self.method))
+            h = asnumpy((elevation_map[0] - h_min) * 255 / (h_max - h_min)).astype('uint8')
+            dst = np.array(cv.inpaint(h, mask, 1, method))
             h_inpainted = dst.astype(np.float32) * (h_max - h_min) / 255 + h_min
-            return cp.asarray(h_inpainted).astype(np.float64)
+            out[...] = self.xp.asarray(h_inpainted)
         else:
-            return elevation_map[0]
+            out[...] = elevation_map[0]
+        return out
+
+    def inpaint_laplace(self, h: ndarray, valid: ndarray, out: ndarray)->ndarray:
+        xp = self.xp
+        out[...] = h
+        b = self.block_size
+        rows = -(-h.shape[0] // b)
+        cols = -(-h.shape[1] // b)
+        padded = xp.zeros((2, rows * b, cols * b), dtype=bool)
+        padded[0, :h.shape[0], :h.shape[1]] = ~valid
+        padded[1, :h.shape[0], :h.shape[1]] = valid
+        # The only transfer to the host.
+        blocks = asnumpy(padded.reshape(2, rows, b, cols, b).any(axis=(2, 4)))
+        if not blocks[0].any() or not blocks[1].any():
+            return out
+        for r0, r1, c0, c1 in self.get_regions(blocks[0]):
+            x0, x1 = r0 * b, min(r1 * b, h.shape[0])
+            y0, y1 = c0 * b, min(c1 * b, h.shape[1])
+            out[x0:x1, y0:y1] = self.solve_laplace(h[x0:x1, y0:y1], valid[x0:x1, y0:y1])
+        return out
+
+    def get_regions(self, invalid_blocks: np.ndarray)->List[List[int]]:
+        """
+        Bounding boxes (r0, r1, c0, c1) in blocks of the connected invalid blocks with a margin of one block.
+        Overlapping boxes are merged, so each box contains whole invalid regions surrounded by valid cells
+        (or the border of the map), and the boxes can be solved separately.
+        """
+        import scipy.ndimage as ndimage
+        labels, _ = ndimage.label(invalid_blocks, structure=np.ones((3, 3)))
+        boxes = []
+        for s in ndimage.find_objects(labels):
+            boxes.append([max(s[0].start - 1, 0), min(s[0].stop + 1, invalid_blocks.shape[0]),
+                          max(s[1].start - 1, 0), min(s[1].stop + 1, invalid_blocks.shape[1])])
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(boxes)):
+                for j in range(i + 1, len(boxes)):
+                    a, b = boxes[i], boxes[j]
+                    if a[0] < b[1] and b[0] < a[1] and a[2] < b[3] and b[2] < a[3]:
+                        boxes[i] = [min(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3])]
+                        del boxes[j]
+                        merged = True
+                        break
+                if merged:
+                    break
+        return boxes
+
+    def solve_laplace(self, h: ndarray, valid: ndarray)->ndarray:
+        """
+        Solve the Laplace equation in the invalid cells with the valid cells as the boundary.
+        The initial value is the mean of the valid cells on coarse grids (pull-push),
+        and it is corrected by conjugate gradient iterations with a multigrid V-cycle as the preconditioner.
+        """
+        xp = self.xp
+        operators = [self.get_fine_operator(valid, h.dtype)]
+        while max(operators[-1][0].shape) > 2:
+            operators.append(self.get_coarse_operator(*operators[-1][:3]))
+        # Pull: average the valid cells down to the coarse grids.
+        sums = [xp.where(valid, h, 0)]
+        weights = [valid.astype(h.dtype)]
+        for level in range(1, len(operators)):
+            sums.append(self.restrict(sums[-1]))
+            weights.append(self.restrict(weights[-1]))
+        # Push: fill the cells without valid cells with the coarser value.
+        u = xp.where(weights[-1] > 0, sums[-1] / xp.maximum(weights[-1], 1e-6), sums[-1].sum() / weights[-1].sum())
+        for level in range(len(operators) - 2, -1, -1):
+            coarse = self.prolong(u, sums[level].shape)
+            u = xp.where(weights[level] > 0, sums[level] / xp.maximum(weights[level], 1e-6), coarse)
+        u = xp.where(valid, h, u)
+        # The step sizes are kept on the device, so that the host does not wait for the device.
+        d, cx, cy = operators[0][:3]
+        unknown = d > 0
+        r = xp.where(unknown, self.neighbor_sum(u, cx, cy) - d * u, 0)
+        z = self.v_cycle(xp.zeros_like(r), r, operators, 0)
+        p = z
+        rz = (r * z).sum()
+        for i in range(self.cycle_n):
+            # The corrections are 0 at the valid cells, so the couplings to the valid cells are not used.
+            ap = xp.where(unknown, d * p - self.neighbor_sum(p, cx, cy), 0)
+            pap = (p * ap).sum()
+            alpha = xp.where(pap > 0, rz / xp.where(pap > 0, pap, 1), 0)
+            u = u + alpha * p
+            r = r - alpha * ap
+            z = self.v_cycle(xp.zeros_like(r), r, operators, 0)
+            rz_next = (r * z).sum()
+            beta = xp.where(rz > 0, rz_next / xp.where(rz > 0, rz, 1), 0)
+            p = z + beta * p
+            rz = rz_next
+        return u
+
+    def get_fine_operator(self, valid: ndarray, dtype):
+        """
+        The Laplace equation d u - (sum of c u of the neighbors) = f in the invalid cells as
+        (d, c between the rows, c between the columns). d is 0 at the valid cells.
+        The border is mirrored, so the cells on the border have fewer neighbors.
+        The red and black cells for the Gauss-Seidel iterations are appended.
+        """
+        xp = self.xp
+        neighbor_n = xp.full(valid.shape, 4, dtype=dtype)
+        neighbor_n[0] -= 1
+        neighbor_n[-1] -= 1
+        neighbor_n[:, 0] -= 1
+        neighbor_n[:, -1] -= 1
+        d = xp.where(valid, 0, neighbor_n)
+        return self.add_colors(d, xp.ones((valid.shape[0] - 1, valid.shape[1]), dtype=dtype),
+                               xp.ones((valid.shape[0], valid.shape[1] - 1), dtype=dtype))
+
+    def get_coarse_operator(self, d: ndarray, cx: ndarray, cy: ndarray):
+        # Galerkin operator of the next level for the piecewise constant prolongation to the unknown cells.
+        xp = self.xp
+        unknown = d > 0
+        cx = cx * (unknown[:-1] & unknown[1:])
+        cy = cy * (unknown[:, :-1] & unknown[:, 1:])
+        pad = ((0, d.shape[0] % 2), (0, d.shape[1] % 2))
+        d = xp.pad(d, pad)
+        cx = xp.pad(cx, pad)
+        cy = xp.pad(cy, pad)
+        n0 = d.shape[0] // 2
+        n1 = d.shape[1] // 2
+        # Couplings inside a coarse cell are cancelled, and the couplings across coarse cells are summed.
+        inner_x = cx[0::2].reshape(n0, n1, 2).sum(axis=2)
+        inner_y = cy[:, 0::2].reshape(n0, 2, n1).sum(axis=1)
+        coarse_cx = cx[1::2].reshape(n0 - 1, n1, 2).sum(axis=2)
+        coarse_cy = cy[:, 1::2].reshape(n0, 2, n1 - 1).sum(axis=1)
+        return self.add_colors(self.restrict(d) - 2 * (inner_x + inner_y), coarse_cx, coarse_cy)
+
+    def add_colors(self, d: ndarray, cx: ndarray, cy: ndarray):
+        # (d, cx, cy, d without zeros, [red unknown cells, black unknown cells])
+        xp = self.xp
+        unknown = d > 0
+        checker = (xp.arange(d.shape[0])[:, None] + xp.arange(d.shape[1])[None, :]) % 2 == 0
+        return d, cx, cy, xp.where(unknown, d, 1), [unknown & checker, unknown & ~checker]
+
+    def v_cycle(self, u: ndarray, f: ndarray, operators, level: int)->ndarray:
+        # Improve the solution u of the equation of the level. The smoothing after the correction is
+        # the reverse of the one before it, so that the cycle is a symmetric preconditioner.
+        xp = self.xp
+        d, cx, cy = operators[level][:3]
+        if level + 1 == len(operators):
+            u = self.relax(u, f, operators[level], 4 * self.iteration_n)
+            return self.relax(u, f, operators[level], 4 * self.iteration_n, reverse=True)
+        u = self.relax(u, f, operators[level], self.iteration_n)
+        residual = xp.where(d > 0, f - d * u + self.neighbor_sum(u, cx, cy), 0)
+        f_coarse = self.restrict(residual)
+        correction = self.v_cycle(xp.zeros_like(f_coarse), f_coarse, operators, level + 1)
+        # The piecewise constant correction is too small for the Laplace equation, so it is scaled up.
+        u = u + 1.5 * xp.where(d > 0, self.prolong(correction, u.shape), 0)
+        return self.relax(u, f, operators[level], self.iteration_n, reverse=True)
+
+    def relax(self, u: ndarray, f: ndarray, operator, iteration_n: int, reverse: bool = False)->ndarray:
+        # Red-black Gauss-Seidel iterations.
+        xp = self.xp
+        _, cx, cy, safe_d, colors = operator
+        if reverse:
+            colors = colors[::-1]
+        for i in range(iteration_n):
+            for color in colors:
+                u = xp.where(color, (f + self.neighbor_sum(u, cx, cy)) / safe_d, u)
+        return u
+
+    def neighbor_sum(self, u: ndarray, cx: ndarray, cy: ndarray)->ndarray:
+        s = self.xp.zeros_like(u)
+        s[:-1] += cx * u[1:]
+        s[1:] += cx * u[:-1]
+        s[:, :-1] += cy * u[:, 1:]
+        s[:, 1:] += cy * u[:, :-1]
+        return s
+
+    def restrict(self, array: ndarray)->ndarray:
+        # Sum of 2x2 cells. Odd sizes are padded with zeros.
+        pad = ((0, array.shape[0] % 2), (0, array.shape[1] % 2))
+        array = self.xp.pad(array, pad)
+        return array.reshape(array.shape[0] // 2, 2, array.shape[1] // 2, 2).sum(axis=(1, 3))
+
+    def prolong(self, array: ndarray, shape)->ndarray:
+        return self.xp.repeat(self.xp.repeat(array, 2, axis=0), 2, axis=1)[:shape[0], :shape[1]]
@@ -2,10 +2,11 @@
 # Copyright (c) 2022, Takahiro Miki. All rights reserved.
 # Licensed under the MIT license. See LICENSE file in the project root for details.
 #
-import cupy as cp
+import numpy as np
 import string
 from typing import List
 
+from backend import ndarray
 from .plugin_manager import PluginBase
 
 
@@ -24,70 +25,127 @@ class MinFilter(PluginBase):
         The size of the patch to search for minimum value for each iteration.
     iteration_n: int
         The number of iteration to repeat the same filter.
+    fill_mode: str
+        iterative runs the filter iteration_n times.
+        window fills each invalid cell with the minimum of the valid cells within iteration_n * dilation_size
+        in one separable min filter, without a host sync. Unlike the iterations, values also pass
+        through valid cells, and the radius does not shrink when the holes are filled early.
     """
-    def __init__(self, cell_n:int=100, dilation_size:int=5, iteration_n:int=5, **kwargs):
+    def __init__(self, cell_n:int=100, dilation_size:int=5, iteration_n:int=5, fill_mode:str="iterative", xp=np,
+                 **kwargs):
         super().__init__()
+        assert fill_mode in ["iterative", "window"], "Unknown fill_mode {}.".format(fill_mode)
         self.iteration_n = iteration_n
+        self.fill_mode = fill_mode
         self.width = cell_n
         self.height = cell_n
-        self.min_filtered = cp.zeros((self.width, self.height))
-        self.min_filtered_mask = cp.zeros((self.width, self.height))
-        self.min_filter_kernel = cp.ElementwiseKernel(
-                in_params='raw U map, raw U mask',
-                out_params='raw U newmap, raw U newmask',
-                preamble=\
-                string.Template('''
-                __device__ int get_map_idx(int idx, int layer_n) {
-                    const int layer = ${width} * ${height};
-                    return layer * layer_n + idx;
-                }
+        self.dilation_size = dilation_size
+        self.xp = xp
+        # Scratch arrays reused across calls. They get the dtype of the map on the first call.
+        self.min_filtered = xp.zeros((self.width, self.height))
+        self.min_filtered_mask = xp.zeros((self.width, self.height))
+        self.invalid = xp.zeros((self.width, self.height), dtype=bool)
+        if fill_mode == "window":
+            self.inside = xp.zeros((self.width, self.height), dtype=bool)
+            self.inside[1:-1, 1:-1] = True
+        if xp is np:
+            self.min_filter_kernel = self.min_filter_numpy
+        else:
+            self.min_filter_kernel = xp.ElementwiseKernel(
+                    in_params='raw U map, raw U mask',
+                    out_params='raw U newmap, raw U newmask',
+                    preamble=\
+                    string.Template('''
+                    __device__ int get_map_idx(int idx, int layer_n) {
+                        const int layer = ${width} * ${height};
+                        return layer * layer_n + idx;
+                    }
 
-                __device__ int get_relative_map_idx(int idx, int dx, int dy, int layer_n) {
-                    const int layer = ${width} * ${height};
-                    const int relative_idx = idx + ${width} * dy + dx;
-                    return layer * layer_n + relative_idx;
-                }
-                __device__ bool is_inside(int idx) {
-                    int idx_x = idx / ${width};
-                    int idx_y = idx % ${width};
-                    if (idx_x <= 0 || idx_x >= ${width} - 1) {
-                        return false;
+                    __device__ int get_relative_map_idx(int idx, int dx, int dy, int layer_n) {
+                        const int layer = ${width} * ${height};
+                        const int relative_idx = idx + ${width} * dy + dx;
+                        return layer * layer_n + relative_idx;
                     }
-                    if (idx_y <= 0 || idx_y >= ${height} - 1) {
-                        return false;
+                    __device__ bool is_inside(int idx) {
+                        int idx_x = idx / ${width};
+                        int idx_y = idx % ${width};
+                        if (idx_x <= 0 || idx_x >= ${width} - 1) {
+                            return false;
+                        }
+                        if (idx_y <= 0 || idx_y >= ${height} - 1) {
+                            return false;
+                        }
+                        return true;
                     }
-                    return true;
-                }
-                ''').substitute(width=self.width, height=self.height),
-                operation=\
-                string.Template('''
-                U h = map[get_map_idx(i, 0)];
-                U valid = mask[get_map_idx(i, 0)];
-                if (valid < 0.5) {
-                    U min_value = 1000000.0;
-                    for (int dy = -${dilation_size}; dy <= ${dilation_size}; dy++) {
-                        for (int dx = -${dilation_size}; dx <= ${dilation_size}; dx++) {
-                            int idx = get_relative_map_idx(i, dx, dy, 0);
-                            if (!is_inside(idx)) {continue;}
-                            U valid = newmask[idx];
-                            U value = newmap[idx];
-                            if(valid > 0.5 && value < min_value) {
-                                min_value = value;
+                    ''').substitute(width=self.width, height=self.height),
+                    operation=\
+                    string.Template('''
+                    U h = map[get_map_idx(i, 0)];
+                    U valid = mask[get_map_idx(i, 0)];
+                    if (valid < 0.5) {
+                        U min_value = 1000000.0;
+                        for (int dy = -${dilation_size}; dy <= ${dilation_size}; dy++) {
+                            for (int dx = -${dilation_size}; dx <= ${dilation_size}; dx++) {
+                                int idx = get_relative_map_idx(i, dx, dy, 0);
+                                if (!is_inside(idx)) {continue;}
+                                U valid = newmask[idx];
+                                U value = newmap[idx];
+                                if(valid > 0.5 && value < min_value) {
+                                    min_value = value;
+                                }
                             }
                         }
+                        if (min_value < 1000000 - 1) {
+                            newmap[get_map_idx(i, 0)] = min_value;
+                            newmask[get_map_idx(i, 0)] = 0.6;
+                        }
                     }
-                    if (min_value < 1000000 - 1) {
-                        newmap[get_map_idx(i, 0)] = min_value;
-                        newmask[get_map_idx(i, 0)] = 0.6;
-                    }
-                }
-                ''').substitute(dilation_size=dilation_size),
-                name='min_filter_kernel')
+                    ''').substitute(dilation_size=dilation_size),
+                    name='min_filter_kernel')
+
+    def min_filter_numpy(self, elevation, mask, newmap, newmask, size=None):
+        # numpy version of min_filter_kernel.
+        import scipy.ndimage as ndimage
+        inside = np.zeros((self.width, self.height), dtype=bool)
+        inside[1:-1, 1:-1] = True
+        candidates = np.where((newmask > 0.5) & inside, newmap, np.inf)
+        min_value = ndimage.minimum_filter(candidates, size=2 * self.dilation_size + 1,
+                                           mode="constant", cval=np.inf)
+        fill = (mask < 0.5) & np.isfinite(min_value)
+        newmap[fill] = min_value[fill]
+        newmask[fill] = 0.6
+
+    def fill_window(self, elevation_map: ndarray, out: ndarray):
+        xp = self.xp
+        if xp is np:
+            import scipy.ndimage as ndimage
+        else:
+            import cupyx.scipy.ndimage as ndimage
+        elevation = elevation_map[0]
+        valid = elevation_map[2] > 0.5
+        invalid = elevation_map[2] < 0.5
+        # Same candidates as min_filter_kernel: valid cells off the border of the map.
+        values = xp.where(valid & self.inside, elevation, xp.inf)
+        # The square filter runs as one 1D min filter per axis.
+        size = 2 * self.dilation_size * self.iteration_n + 1
+        filled = ndimage.minimum_filter(values, size=size, mode="constant", cval=xp.inf)
+        xp.copyto(filled, xp.nan, where=~invalid | xp.isinf(filled))
+        xp.copyto(filled, elevation, where=valid)
+        out[...] = filled
 
-    def __call__(self, elevation_map: cp.ndarray, layer_names: List[str],
-            plugin_layers: cp.ndarray, plugin_layer_names: List[str])->cp.ndarray:
-        self.min_filtered = elevation_map[0].copy()
-        self.min_filtered_mask = elevation_map[2].copy()
+    def __call__(self, elevation_map: ndarray, layer_names: List[str],
+            plugin_layers: ndarray, plugin_layer_names: List[str], out: ndarray = None)->ndarray:
+        xp = self.xp
+        if self.fill_mode == "window":
+            if out is None:
+                out = xp.empty_like(elevation_map[0])
+            self.fill_window(elevation_map, out)
+            return out
+        if self.min_filtered.dtype != elevation_map.dtype:
+            self.min_filtered = xp.empty_like(elevation_map[0])
+            self.min_filtered_mask = xp.empty_like(elevation_map[2])
+        self.min_filtered[...] = elevation_map[0]
+        self.min_filtered_mask[...] = elevation_map[2]
         for i in range(self.iteration_n):
             self.min_filter_kernel(elevation_map[0],
                                    elevation_map[2],
@@ -97,6 +155,9 @@ class MinFilter(PluginBase):
             # If there's no more mask, break
             if (self.min_filtered_mask > 0.5).all():
                 break
-        min_filtered = cp.where(self.min_filtered_mask > 0.5,
-                                self.min_filtered.copy(), cp.nan)
-        return min_filtered
+        if out is None:
+            out = xp.empty_like(self.min_filtered)
+        out[...] = self.min_filtered
+        xp.less_equal(self.min_filtered_mask, 0.5, out=self.invalid)
+        xp.copyto(out, xp.nan, where=self.invalid)
+        return out
@@ -3,12 +3,14 @@
 # Licensed under the MIT license. See LICENSE file in the project root for details.
 #
 from abc import ABC
-import cupy as cp
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from typing import List, Dict
 import importlib
 import inspect
 from dataclasses import dataclass
-from ruamel.yaml import YAML
+
+from backend import ndarray
 
 
 @dataclass
@@ -31,10 +33,10 @@ class PluginBase(ABC):
             The parameter of callback
         """
 
-    def __call__(self, elevation_map: cp.ndarray, layer_names: List[str],
-            plugin_layers: cp.ndarray, plugin_layer_names: List[str])->cp.ndarray:
+    def __call__(self, elevation_map: ndarray, layer_names: List[str],
+            plugin_layers: ndarray, plugin_layer_names: List[str], out: ndarray = None)->ndarray:
         """
-        This gets the elevation map data and plugin layers as a cupy array. 
+        This gets the elevation map data and plugin layers as a cupy (or numpy with the numpy backend) array. 
         Run your processing here and return the result.
         layer of elevation_map  0: elevation
                                 1: variance
@@ -44,16 +46,30 @@ class PluginBase(ABC):
                                 5: upper_bound
                                 6: is_upper_bound
         You can also access to the other plugins' layer with plugin_layers and plugin_layer_names
+        If the plugin accepts out, it gets the layer of the plugin as out. Write the result to it and return it,
+        so that no new layer is allocated. Scratch arrays should be kept in the plugin and reused.
+        Plugins without out should return a new array.
         """
         pass
 
+    def get_input_layer_names(self)->List[str]:
+        """
+        Return the names of the plugin layers read by this plugin.
+        These plugins are updated before this plugin.
+        """
+        return []
+
 
 class PluginManger(object):
     """  
     This manages the plugins.
     """
-    def __init__(self, cell_n: int):
+    def __init__(self, cell_n: int, xp=np, dtype=np.float64, thread_n: int = 1):
         self.cell_n = cell_n
+        self.xp = xp
+        self.dtype = dtype
+        # Plugins which do not depend on each other run in parallel if thread_n > 1.
+        self.executor = ThreadPoolExecutor(max_workers=thread_n) if thread_n > 1 else None
 
     def init(self, plugin_params: List[PluginParams], extra_params: List[Dict]):
         self.plugin_params = plugin_params
@@ -65,15 +81,23 @@ class PluginManger(object):
                 if (inspect.isclass(obj) and
                         issubclass(obj, PluginBase) and
                         name != "PluginBase"):
-                    # Add cell_n to params
+                    # Add cell_n and the array module to params
                     extra_param["cell_n"] = self.cell_n
+                    extra_param["xp"] = self.xp
                     self.plugins.append(obj(**extra_param))
+        # Plugins accepting out write their results to their layers directly.
+        self.accepts_out = ["out" in inspect.signature(plugin.__call__).parameters for plugin in self.plugins]
 
-        self.layers = cp.zeros((len(self.plugins), self.cell_n, self.cell_n))
+        self.layers = self.xp.zeros((len(self.plugins), self.cell_n, self.cell_n), dtype=self.dtype)
+        # Plugin layers are only recomputed when the map has changed since their last update.
+        self.dirty = [True] * len(self.plugins)
         self.layer_names = self.get_layer_names()
         self.plugin_names = self.get_plugin_names()
+        self.dependencies = self.get_dependencies()
+        self.order = self.get_topological_order()
 
     def load_plugin_settings(self, file_path: str):
+        from ruamel.yaml import YAML
         print("Start loading plugins...")
         cfg = YAML().load(open(file_path, 'r'))
         plugin_params = []
@@ -120,12 +144,89 @@ class PluginManger(object):
             print("Error with layer {}: {}".format(name, e))
             return None
 
-    def update_with_name(self, name: str, elevation_map: cp.ndarray, layer_names: List[str]):
-        idx = self.get_layer_index_with_name(name)
-        if idx is not None:
-            self.layers[idx] = self.plugins[idx](elevation_map, layer_names, self.layers, self.layer_names)
+    def get_dependencies(self)->List[List[int]]:
+        # Indices of the plugins whose layers are read by each plugin.
+        dependencies = []
+        for plugin in self.plugins:
+            names = plugin.get_input_layer_names()
+            dependencies.append([self.layer_names.index(name) for name in names if name in self.layer_names])
+        return dependencies
+
+    def get_topological_order(self)->List[int]:
+        # Indices of the plugins ordered so that each plugin comes after the plugins it reads.
+        order = []
+        state = [0] * len(self.plugins)  # 0: not visited, 1: visiting, 2: done
+
+        def visit(idx):
+            if state[idx] == 2:
+                return
+            assert state[idx] == 0, "Plugin layer {} depends on its own output.".format(self.layer_names[idx])
+            state[idx] = 1
+            for dependency in self.dependencies[idx]:
+                visit(dependency)
+            state[idx] = 2
+            order.append(idx)
+
+        for idx in range(len(self.plugins)):
+            visit(idx)
+        return order
+
+    def get_update_indices(self, names: List[str])->List[int]:
+        # Dirty plugins needed for the layers, including the plugin layers they read, in topological order.
+        needed = set()
+        stack = [self.layer_names.index(name) for name in names if name in self.layer_names]
+        while len(stack) > 0:
+            idx = stack.pop()
+            if idx not in needed:
+                needed.add(idx)
+                stack.extend(self.dependencies[idx])
+        return [idx for idx in self.order if idx in needed and self.dirty[idx]]
+
+    def run_plugins(self, indices: List[int], elevation_map: ndarray, layer_names: List[str], layers: ndarray):
+        """
+        Run the plugins of indices (in topological order) and write their results to layers.
+        layers is self.layers or a copy of it.
+        """
+        def run(idx):
+            if self.accepts_out[idx]:
+                result = self.plugins[idx](elevation_map, layer_names, layers, self.layer_names, out=layers[idx])
+                if result is not None and result is not layers[idx]:
+                    layers[idx] = result
+            else:
+                layers[idx] = self.plugins[idx](elevation_map, layer_names, layers, self.layer_names)
+
+        if self.executor is None:
+            for idx in indices:
+                run(idx)
+            return
+        pending = list(indices)
+        while len(pending) > 0:
+            # Plugins whose inputs are up to date run together.
+            ready = [idx for idx in pending if not any(d in pending for d in self.dependencies[idx])]
+            futures = [self.executor.submit(run, idx) for idx in ready]
+            for future in futures:
+                future.result()
+            pending = [idx for idx in pending if idx not in ready]
+
+    def update_with_names(self, names: List[str], elevation_map: ndarray, layer_names: List[str]):
+        """
+        Update the plugin layers and the plugin layers they read.
+        Each plugin runs after its inputs, and only if the map has changed since its last update.
+        """
+        indices = self.get_update_indices(names)
+        self.run_plugins(indices, elevation_map, layer_names, self.layers)
+        for idx in indices:
+            self.dirty[idx] = False
+
+    def update_with_name(self, name: str, elevation_map: ndarray, layer_names: List[str]):
+        if self.get_layer_index_with_name(name) is not None:
+            self.update_with_names([name], elevation_map, layer_names)
+
+    def mark_dirty(self):
+        # Called when the elevation map is changed.
+        self.dirty = [True] * len(self.plugins)
 
-    def get_map_with_name(self, name: str)->cp.ndarray:
+    def get_map_with_name(self, name: str)->ndarray:
         idx = self.get_layer_index_with_name(name)
         if idx is not None:
             return self.layers[idx]
@@ -137,6 +238,7 @@ class PluginManger(object):
 
 
 if __name__ == '__main__':
+    import cupy as cp
     plugins = [
                 PluginParams(name="min_filter", layer_name="min_filter"),
                 PluginParams(name="smooth_filter", layer_name="smooth"),
@@ -145,7 +247,7 @@ if __name__ == '__main__':
             {"dilation_size": 5, "iteration_n": 5},
             {"input_layer_name": "elevation2"}
             ]
-    manager = PluginManger(200)
+    manager = PluginManger(200, xp=cp)
     manager.load_plugin_settings('config/plugin_config.yaml')
     print(manager.layer_names)
     print(manager.plugin_names)
@@ -2,10 +2,10 @@
 # Copyright (c) 2022, Takahiro Miki. All rights reserved.
 # Licensed under the MIT license. See LICENSE file in the project root for details.
 #
-import cupy as cp
+import numpy as np
 from typing import List
-import cupyx.scipy.ndimage as ndimage
 
+from backend import ndarray
 from .plugin_manager import PluginBase
 
 
@@ -19,12 +19,20 @@ class SmoothFilter(PluginBase):
     cell_n: int
         width and height of the elevation map.
     """
-    def __init__(self, cell_n:int=100, input_layer_name:str="elevation", **kwargs):
+    def __init__(self, cell_n:int=100, input_layer_name:str="elevation", xp=np, **kwargs):
         super().__init__()
         self.input_layer_name = input_layer_name
+        self.xp = xp
+        # The ndimage module is imported when the plugin is first used.
+        self.ndimage = None
+        # Result of the first filter, reused across calls.
+        self.smoothed = None
 
-    def __call__(self, elevation_map: cp.ndarray, layer_names: List[str],
-            plugin_layers: cp.ndarray, plugin_layer_names: List[str])->cp.ndarray:
+    def get_input_layer_names(self)->List[str]:
+        return [self.input_layer_name]
+
+    def __call__(self, elevation_map: ndarray, layer_names: List[str],
+            plugin_layers: ndarray, plugin_layer_names: List[str], out: ndarray = None)->ndarray:
         if self.input_layer_name in layer_names:
             idx = layer_names.index(self.input_layer_name)
             h = elevation_map[idx]
@@ -34,6 +42,16 @@ class SmoothFilter(PluginBase):
         else:
             print("layer name {} was not found. Using elevation layer.".format(self.input_layer_name))
             h = elevation_map[0]
-        hs1 = ndimage.uniform_filter(h, size=3)
-        hs1 = ndimage.uniform_filter(hs1, size=3)
-        return hs1
+        if self.ndimage is None:
+            if self.xp is np:
+                import scipy.ndimage as ndimage
+            else:
+                import cupyx.scipy.ndimage as ndimage
+            self.ndimage = ndimage
+        if out is None:
+            out = self.xp.empty_like(h)
+        if self.smoothed is None or self.smoothed.shape != h.shape or self.smoothed.dtype != h.dtype:
+            self.smoothed = self.xp.empty_like(h)
+        self.ndimage.uniform_filter(h, size=3, output=self.smoothed)
+        self.ndimage.uniform_filter(self.smoothed, size=3, output=out)
+        return out
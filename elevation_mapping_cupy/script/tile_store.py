@@ -0,0 +1,144 @@
+#
+# Copyright (c) 2022, Takahiro Miki. All rights reserved.
+# Licensed under the MIT license. See LICENSE file in the project root for details.
+#
+import os
+import numpy as np
+
+from backend import asnumpy
+
+
+class TileStore(object):
+    """
+    Sparse storage of map layers in fixed size square tiles.
+    The cell (i, j) of the world grid is stored in the tile (i // tile_size, j // tile_size).
+    Tiles are only allocated where the written cells are occupied, so the memory grows with the observed area.
+    If path is given, tiles are kept in a memory-mapped file in the directory instead of the array backend memory.
+    The tiles in the directory are loaded again when the store is created with the same path.
+    """
+    def __init__(self, layer_n, tile_size, initial_values, xp=np, dtype=np.float64, capacity=16, path=None):
+        """
+        Args:
+        layer_n: number of layers of each tile.
+        tile_size: number of cells of a side of a tile.
+        initial_values: value of each layer for the cells which are not observed. (layer_n, 1, 1)
+        capacity: number of tiles allocated at first. It is doubled when all tiles are used.
+        path: directory of the memory-mapped store. If None, tiles are kept in the memory of xp.
+        """
+        self.xp = xp
+        self.layer_n = layer_n
+        self.tile_size = tile_size
+        self.dtype = np.dtype(dtype)
+        self.path = path
+        self.index = {}
+        if path is None:
+            self.storage_xp = xp
+            self.initial_values = initial_values
+            self.tiles = xp.empty((capacity, layer_n, tile_size, tile_size), dtype=self.dtype)
+        else:
+            self.storage_xp = np
+            self.initial_values = asnumpy(initial_values)
+            os.makedirs(path, exist_ok=True)
+            self.tile_file = os.path.join(path, "tiles.dat")
+            self.index_file = os.path.join(path, "index.npz")
+            if os.path.exists(self.index_file):
+                self.load_index()
+                capacity = max(capacity, len(self.index))
+            self.tiles = None
+            self.resize(capacity)
+
+    def __len__(self):
+        return len(self.index)
+
+    def clear(self):
+        self.index = {}
+        self.flush()
+
+    def load_index(self):
+        data = np.load(self.index_file)
+        assert int(data["tile_size"]) == self.tile_size, "tile_size of the store is {}".format(int(data["tile_size"]))
+        assert int(data["layer_n"]) == self.layer_n, "layer_n of the store is {}".format(int(data["layer_n"]))
+        assert str(data["dtype"]) == self.dtype.name, "dtype of the store is {}".format(str(data["dtype"]))
+        self.index = {(int(tx), int(ty)): int(slot) for tx, ty, slot in data["index"]}
+
+    def flush(self):
+        # Write the index and the tiles to the disk.
+        if self.path is None:
+            return
+        index = np.array([[tx, ty, slot] for (tx, ty), slot in self.index.items()], dtype=np.int64).reshape(-1, 3)
+        np.savez(self.index_file, index=index, tile_size=self.tile_size, layer_n=self.layer_n, dtype=self.dtype.name)
+        self.tiles.flush()
+
+    def resize(self, capacity):
+        shape = (capacity, self.layer_n, self.tile_size, self.tile_size)
+        if self.path is None:
+            tiles = self.xp.empty(shape, dtype=self.dtype)
+            tiles[:self.tiles.shape[0]] = self.tiles
+            self.tiles = tiles
+        else:
+            # Extend the file and map it again.
+            if self.tiles is not None:
+                self.tiles.flush()
+                self.tiles = None
+            size = int(np.prod(shape)) * self.dtype.itemsize
+            with open(self.tile_file, "ab") as f:
+                if f.tell() < size:
+                    f.truncate(size)
+            self.tiles = np.memmap(self.tile_file, dtype=self.dtype, mode="r+", shape=shape)
+
+    def get_slot(self, key):
+        # Return the storage slot of the tile, allocating it if needed.
+        if key not in self.index:
+            if len(self.index) == self.tiles.shape[0]:
+                self.resize(2 * self.tiles.shape[0])
+            slot = len(self.index)
+            self.tiles[slot] = self.initial_values
+            self.index[key] = slot
+        return self.index[key]
+
+    def get_blocks(self, x0, y0, rows, cols):
+        # Split the rectangle [x0:x0 + rows, y0:y0 + cols] of the world grid by the tiles.
+        # Yields the tile key, the slice in the tile and the slice in the rectangle.
+        t = self.tile_size
+        for tx in range(x0 // t, (x0 + rows - 1) // t + 1):
+            bx0 = max(x0, tx * t)
+            bx1 = min(x0 + rows, (tx + 1) * t)
+            for ty in range(y0 // t, (y0 + cols - 1) // t + 1):
+                by0 = max(y0, ty * t)
+                by1 = min(y0 + cols, (ty + 1) * t)
+                yield ((tx, ty),
+                       (slice(bx0 - tx * t, bx1 - tx * t), slice(by0 - ty * t, by1 - ty * t)),
+                       (slice(bx0 - x0, bx1 - x0), slice(by0 - y0, by1 - y0)))
+
+    def write(self, x0, y0, values, occupied):
+        """
+        Write the rectangle of the world grid starting from the cell (x0, y0).
+        Args:
+        values: layers of the rectangle. (layer_n, rows, cols)
+        occupied: cells which have data. (rows, cols) A tile is allocated only if one of its cells is occupied.
+        """
+        if self.storage_xp is np:
+            values = asnumpy(values)
+            occupied = asnumpy(occupied)
+        blocks = list(self.get_blocks(x0, y0, values.shape[1], values.shape[2]))
+        has_data = [occupied[block].any() for _, _, block in blocks]
+        if len(has_data) > 0:
+            # Check all tiles with one synchronization.
+            has_data = self.storage_xp.stack(has_data).tolist()
+        tile_n = len(self.index)
+        for (key, tile_block, block), data in zip(blocks, has_data):
+            if key in self.index or data:
+                slot = self.get_slot(key)
+                self.tiles[slot][(slice(None),) + tile_block] = values[(slice(None),) + block]
+        if len(self.index) > tile_n:
+            self.flush()
+
+    def read(self, x0, y0, values):
+        """
+        Read the rectangle of the world grid starting from the cell (x0, y0) into values.
+        Cells in tiles which are not allocated are not changed.
+        """
+        for key, tile_block, block in self.get_blocks(x0, y0, values.shape[1], values.shape[2]):
+            if key in self.index:
+                tile = self.tiles[self.index[key]][(slice(None),) + tile_block]
+                values[(slice(None),) + block] = self.xp.asarray(tile)
@@ -2,7 +2,8 @@
 # Copyright (c) 2022, Takahiro Miki. All rights reserved.
 # Licensed under the MIT license. See LICENSE file in the project root for details.
 #
-import cupy as cp
+import numpy as np
+from backend import cp
 
 
 def get_filter_torch(*args, **kwargs):
@@ -10,7 +11,7 @@ def get_filter_torch(*args, **kwargs):
     import torch.nn as nn
 
     class TraversabilityFilter(nn.Module):
-        def __init__(self, w1, w2, w3, w_out, device='cuda', use_bias=False):
+        def __init__(self, w1, w2, w3, w_out, device='cuda', use_bias=False, use_cupy=True):
             super(TraversabilityFilter, self).__init__()
             self.conv1 = nn.Conv2d(1, 4, 3, dilation=1, padding=0, bias=use_bias)
             self.conv2 = nn.Conv2d(1, 4, 3, dilation=2, padding=0, bias=use_bias)
@@ -22,10 +23,11 @@ def get_filter_torch(*args, **kwargs):
             self.conv2.weight = nn.Parameter(torch.from_numpy(w2).float())
             self.conv3.weight = nn.Parameter(torch.from_numpy(w3).float())
             self.conv_out.weight = nn.Parameter(torch.from_numpy(w_out).float())
+            self.use_cupy = use_cupy
 
         def __call__(self, elevation_cupy):
             # Convert cupy tensor to pytorch.
-            elevation_cupy = elevation_cupy.astype(cp.float32)
+            elevation_cupy = elevation_cupy.astype(np.float32, copy=False)
             elevation = torch.as_tensor(elevation_cupy, device=self.conv1.weight.device)
 
             with torch.no_grad():
@@ -45,11 +47,42 @@ def get_filter_torch(*args, **kwargs):
                 # out = F.concat((out1, out2, out3), axis=1)
                 out = self.conv_out(out.abs())
                 out = torch.exp(-out)
-                out_cupy = cp.asarray(out)
+                if self.use_cupy:
+                    out_cupy = cp.asarray(out)
+                else:
+                    out_cupy = out.numpy()
 
             return out_cupy
 
-    traversability_filter = TraversabilityFilter(*args, **kwargs).cuda().eval()
+    traversability_filter = TraversabilityFilter(*args, **kwargs)
+    if traversability_filter.use_cupy:
+        traversability_filter = traversability_filter.cuda()
+    traversability_filter = traversability_filter.eval()
+    return traversability_filter
+
+
+def get_filter_native(w1, w2, w3, w_out, use_cupy=True):
+    """
+    The same filter as get_filter_torch and get_filter_chainer without a deep learning framework.
+    The network is computed by one kernel. (See traversability_filter_kernel in custom_kernels.py)
+    """
+    if use_cupy:
+        import custom_kernels as kernels
+        xp = cp
+    else:
+        import numpy_kernels as kernels
+        xp = np
+    weights = xp.asarray(np.concatenate([w.reshape(-1) for w in [w1, w2, w3, w_out]]), dtype=np.float32)
+    assert weights.shape[0] == 120, "The traversability filter needs 4 filters of 3x3 for each dilation."
+    kernel = kernels.traversability_filter_kernel()
+
+    def traversability_filter(elevation):
+        elevation = xp.ascontiguousarray(elevation, dtype=np.float32)
+        rows, cols = elevation.shape
+        out = xp.empty((1, 1, rows - 6, cols - 6), dtype=np.float32)
+        kernel(elevation, weights, xp.array([rows, cols], dtype=np.int32), out, size=(rows - 6) * (cols - 6))
+        return out
+
     return traversability_filter
 
 
@@ -103,19 +136,17 @@ def get_filter_chainer(*args, **kwargs):
 
 
 if __name__ == '__main__':
-    import cupy as cp
+    # Check the native filter against torch.
+    import os
     from parameter import Parameter
-    elevation = cp.random.randn(202, 202, dtype=cp.float32)
-    print('elevation ', elevation.shape)
+    use_cupy = cp is not None
+    xp = cp if use_cupy else np
     param = Parameter()
-    fc = get_filter_chainer(param.w1,
-                             param.w2,
-                             param.w3,
-                             param.w_out)
-    print('chainer ', fc(elevation))
-
-    ft = get_filter_torch(param.w1,
-                             param.w2,
-                             param.w3,
-                             param.w_out)
-    print('torch ', ft(elevation))
+    param.load_weights(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "config", "weights.dat"))
+    elevation = xp.asarray(np.random.randn(202, 202), dtype=np.float32)
+    ft = get_filter_torch(param.w1, param.w2, param.w3, param.w_out, use_cupy=use_cupy)
+    fn = get_filter_native(param.w1, param.w2, param.w3, param.w_out, use_cupy=use_cupy)
+    out_torch = ft(elevation)
+    out_native = fn(elevation)
+    print('torch ', out_torch.shape, ' native ', out_native.shape)
+    print('max difference ', float(xp.abs(out_torch - out_native).max()))
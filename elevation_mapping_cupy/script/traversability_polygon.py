@@ -2,18 +2,17 @@
 # Copyright (c) 2022, Takahiro Miki. All rights reserved.
 # Licensed under the MIT license. See LICENSE file in the project root for details.
 #
-import numpy as np
-import cupy as cp
-from shapely.geometry import Polygon, MultiPoint
+from backend import get_array_module
 
 
 def get_masked_traversability(map_array, mask):
     traversability = map_array[3][1:-1, 1:-1]
     is_valid = map_array[2][1:-1, 1:-1]
     mask = mask[1:-1, 1:-1]
+    xp = get_array_module(traversability)
 
     # invalid place is 0 traversability value
-    untraversability = cp.where(is_valid > 0.5, 1 - traversability, 0)
+    untraversability = xp.where(is_valid > 0.5, 1 - traversability, 0)
     masked = untraversability * mask
     masked_isvalid = is_valid * mask
     return masked, masked_isvalid
@@ -22,7 +21,8 @@ def get_masked_traversability(map_array, mask):
 def is_traversable(masked_untraversability, thresh, min_thresh, max_over_n):
     untraversable_thresh = 1 - thresh
     max_thresh = 1 - min_thresh
-    over_thresh = cp.where(masked_untraversability > untraversable_thresh, 1, 0)
+    xp = get_array_module(masked_untraversability)
+    over_thresh = xp.where(masked_untraversability > untraversable_thresh, 1, 0)
     polygon = calculate_untraversable_polygon(over_thresh)
     max_untraversability = masked_untraversability.max()
     if over_thresh.sum() > max_over_n:
@@ -44,13 +44,15 @@ def calculate_area(polygon):
 
 
 def calculate_untraversable_polygon(over_thresh):
-    x, y = cp.where(over_thresh > 0.5)
-    points = cp.stack([x, y]).T
+    from shapely.geometry import MultiPoint
+    xp = get_array_module(over_thresh)
+    x, y = xp.where(over_thresh > 0.5)
+    points = xp.stack([x, y]).T
     convex_hull = MultiPoint(points).convex_hull
     if convex_hull.is_empty or convex_hull.geom_type == "Point" or convex_hull.geom_type == "LineString":
         return None
     else:
-        return cp.array(convex_hull.exterior.coords)
+        return xp.array(convex_hull.exterior.coords)
 
 
 def transform_to_map_position(polygon, center, cell_n, resolution):
@@ -59,12 +61,13 @@ def transform_to_map_position(polygon, center, cell_n, resolution):
 
 
 def transform_to_map_index(points, center, cell_n, resolution):
-    indices = ((points - center.reshape(1, 2)) / resolution + cell_n / 2).astype(cp.int)
+    indices = ((points - center.reshape(1, 2)) / resolution + cell_n / 2).astype(int)
     return indices
 
 
 
 if __name__ == '__main__':
+    import cupy as cp
     polygon = [[0, 0], [2, 0], [0, 2]]
     print(calculate_area(polygon))
 
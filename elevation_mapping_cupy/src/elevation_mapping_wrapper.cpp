@@ -34,6 +34,8 @@ void ElevationMappingWrapper::initialize(ros::NodeHandle& nh) {
   param_ = parameter.attr("Parameter")();
   setParameters(nh);
   map_ = elevation_mapping.attr("ElevationMap")(param_);
+  // Compile the kernels before the first point cloud.
+  map_.attr("warm_up")();
 }
 
 /**
@@ -133,21 +135,21 @@ void ElevationMappingWrapper::get_grid_map(grid_map::GridMap& gridMap, const std
   grid_map::Position position(pos(0, 0), pos(0, 1));
   grid_map::Length length(map_length_, map_length_);
   gridMap.setGeometry(length, resolution_, position);
-  std::vector<Eigen::MatrixXf> maps;
 
+  if (enable_normal_color_) {
+    layerNames.push_back("normal_x");
+    layerNames.push_back("normal_y");
+    layerNames.push_back("normal_z");
+  }
+  // All layers are copied from the device at once, stacked along the rows.
+  py::list names;
   for (const auto& layerName : layerNames) {
-    RowMatrixXf map(map_n_, map_n_);
-    map_.attr("get_map_with_name_ref")(layerName, Eigen::Ref<RowMatrixXf>(map));
-    gridMap.add(layerName, map);
+    names.append(layerName);
   }
-  if (enable_normal_color_) {
-    RowMatrixXf normal_x(map_n_, map_n_);
-    RowMatrixXf normal_y(map_n_, map_n_);
-    RowMatrixXf normal_z(map_n_, map_n_);
-    map_.attr("get_normal_ref")(Eigen::Ref<RowMatrixXf>(normal_x), Eigen::Ref<RowMatrixXf>(normal_y), Eigen::Ref<RowMatrixXf>(normal_z));
-    gridMap.add("normal_x", normal_x);
-    gridMap.add("normal_y", normal_y);
-    gridMap.add("normal_z", normal_z);
+  RowMatrixXf maps(map_n_ * layerNames.size(), map_n_);
+  map_.attr("get_maps")(names, Eigen::Ref<RowMatrixXf>(maps));
+  for (size_t i = 0; i < layerNames.size(); i++) {
+    gridMap.add(layerNames[i], maps.block(i * map_n_, 0, map_n_, map_n_));
   }
   gridMap.setBasicLayers(basicLayerNames);
   if (enable_normal_color_) {